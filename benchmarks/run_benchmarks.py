@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+"""
+Measures the hot paths of the corefacility-checker without the root privileges and the real hardware.
+
+The external utilities are replaced by the fake ones located in the 'fakes' folder: they are put at the beginning of
+PATH, so sensors, smartctl, dd, memtester and logger print canned output instead of touching the hardware. The POSIX
+log is a synthetic syslog file and the mails are delivered to the local SMTP sink. The following benchmarks are
+available:
+'log_scanning' - looking for the records written during the disk reading test in a large POSIX log, when the whole log
+	is read (the log position is unknown) and when only its tail is read;
+'output_capture' - capturing a large output of the command by the CommandLineTest, with ordinary lines and with
+	the progress spinners drawn by backspaces;
+'smart_polling' - polling the self-test progress of several drives by the SmartTest, with the wait times scaled down;
+'mail_encoding' - sending a large file as the mail attachment to the SMTP sink, in a single mail and split into parts;
+'whole_run' - the whole run of the checker by its main() function with a configuration where all tests use the fake
+	utilities;
+'health_sampling' - taking an hour of health samples (one per second) from the real hwmon, /proc and /sys files of
+	this machine, as the health sampler does between the tests.
+
+Each benchmark is run --repeat times, each time in a fresh Python interpreter, and the median values are reported.
+The results are compared to the baseline: a benchmark regresses when its median time exceeds the baseline time by more
+than --tolerance. The baseline is specific to the machine and is kept in results/<host name>.json unless --baseline
+is given. Use --save to make the current results the new baseline.
+
+Usage: python benchmarks/run_benchmarks.py [benchmark ...] [--repeat N] [--save] [--output results.json]
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import resource
+import statistics
+import subprocess
+from pathlib import Path
+
+
+BENCHMARK_PATH = Path(__file__).absolute().parent
+SOURCE_PATH = str(BENCHMARK_PATH.parent / "src")
+FAKES_PATH = str(BENCHMARK_PATH / "fakes")
+RESULTS_PATH = BENCHMARK_PATH / "results"
+DEFAULT_WORK_FOLDER = "/tmp/corefacility-checker-benchmarks"
+BENCHMARKS = ['log_scanning', 'output_capture', 'smart_polling', 'mail_encoding', 'whole_run', 'health_sampling']
+SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+SYSLOG_PROCESSES = ["systemd[1]", "CRON[%d]", "sshd[%d]", "kernel", "postgres[%d]", "gunicorn[%d]"]
+SYSLOG_MESSAGES = [
+	"Started Session %d of user root.",
+	"(root) CMD (command -v debian-sa1 > /dev/null && debian-sa1 1 1)",
+	"Accepted publickey for admin from 192.168.0.%d port 52344 ssh2",
+	"[%d.123456] ata%d: SATA link up 6.0 Gbps (SStatus 133 SControl 300)",
+	"LOG:  checkpoint complete: wrote %d buffers (0.1%%); 0 WAL file(s) added",
+	"[INFO] Booting worker with pid: %d",
+]
+ATA_ERROR_RECORD = "kernel: [%d.654321] ata%d.00: exception Emask 0x0 SAct 0x40 SErr 0x0 action 0x0"
+TEST_ID = "benchmark"
+TAIL_SIZE = 1 << 20
+
+
+def parse_size(size):
+	"""
+	Converts the size like '512M' or '4G' to number of bytes
+
+	:param size: the size given in the command line
+	:return: number of bytes
+	"""
+	size = size.strip().upper()
+	if size[-1] in SIZE_SUFFIXES:
+		return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+	return int(size)
+
+
+def generate_syslog(filename, size, records_during_test=10000):
+	"""
+	Generates the synthetic POSIX log. The records written during the disk reading test are at the end of the log.
+	The log is generated once and is reused by the following runs
+
+	:param filename: the log file
+	:param size: approximate size of the log in bytes
+	:param records_during_test: number of records between the start and the end marks. Every thousandth of them
+		reports the ATA error
+	"""
+	if os.path.isfile(filename) and os.stat(filename).st_size >= size:
+		return
+	host = socket.gethostname()
+	lines = list()
+	for index in range(20000):
+		process = SYSLOG_PROCESSES[index % len(SYSLOG_PROCESSES)]
+		message = SYSLOG_MESSAGES[index % len(SYSLOG_MESSAGES)]
+		lines.append("Oct 17 03:%02d:%02d %s %s: %s\n" % (index // 60 % 60, index % 60, host,
+			process.replace("%d", str(1000 + index)), message.replace("%d", str(index % 256))))
+	block = "".join(lines).encode('utf-8')
+	with open(filename + ".tmp", 'wb') as log_file:
+		for _ in range(max(-(-size // len(block)), 1)):
+			log_file.write(block)
+		log_file.write(("Oct 17 04:00:00 %s root: disk_physical_reading START %s\n" % (host, TEST_ID)).encode('utf-8'))
+		for index in range(records_during_test):
+			if index % 1000 == 999:
+				record = ATA_ERROR_RECORD % (index, index % 4)
+			else:
+				record = "kernel: " + SYSLOG_MESSAGES[3] % (index, index % 4)
+			log_file.write(("Oct 17 04:%02d:%02d %s %s\n" % (index // 60 % 60, index % 60, host, record))
+				.encode('utf-8'))
+		log_file.write(("Oct 17 05:00:00 %s root: disk_physical_reading END %s\n" % (host, TEST_ID)).encode('utf-8'))
+	os.rename(filename + ".tmp", filename)
+
+
+def benchmark_log_scanning(work_folder, options):
+	"""
+	Looks for the records written during the disk reading test in the synthetic POSIX log
+
+	:param work_folder: the folder for the benchmark files
+	:param options: the command line arguments
+	:return: the measured values
+	"""
+	from ru.ihna.kozhukhov.corefacility_checker.disk_reading_test import DiskReadingTest
+	log_file = os.path.join(work_folder, "syslog-%d" % options.syslog_size)
+	generate_syslog(log_file, options.syslog_size)
+	DiskReadingTest.posix_log = log_file
+	log_stat = os.stat(log_file)
+	start_mark = "disk_physical_reading START %s" % TEST_ID
+	end_mark = "disk_physical_reading END %s" % TEST_ID
+	start_time = time.perf_counter()
+	log_data = DiskReadingTest._read_posix_logs(start_mark, end_mark)
+	fail_number = DiskReadingTest._search_ata_fails(log_data)
+	full_time = time.perf_counter() - start_time
+	start_time = time.perf_counter()
+	log_position = (log_stat.st_ino, max(log_stat.st_size - TAIL_SIZE, 0))
+	tail_data = DiskReadingTest._read_posix_logs(start_mark, end_mark, log_position)
+	DiskReadingTest._search_ata_fails(tail_data)
+	tail_time = time.perf_counter() - start_time
+	if tail_data != log_data or fail_number == 0:
+		raise RuntimeError("The log records written during the test have not been found")
+	return {
+		'seconds': full_time,
+		'tail_seconds': tail_time,
+		'log_bytes': log_stat.st_size,
+		'megabytes_per_second': log_stat.st_size / full_time / 1e6,
+		'records': log_data.count(b"\n"),
+		'ata_errors': fail_number,
+	}
+
+
+def benchmark_output_capture(work_folder, options):
+	"""
+	Captures a large output of the command by the CommandLineTest
+
+	:param work_folder: the folder for the benchmark files
+	:param options: the command line arguments
+	:return: the measured values
+	"""
+	from ru.ihna.kozhukhov.corefacility_checker.command_line_test import CommandLineTest
+	size = options.output_size
+	start_time = time.perf_counter()
+	CommandLineTest.run(command="yes 'Processing inode 1234567: checking blocks and extents' | head -c %d" % size)
+	lines_time = time.perf_counter() - start_time
+	start_time = time.perf_counter()
+	CommandLineTest.run(command="yes 'testing 123' | tr '\\n' '\\b' | head -c %d" % size)
+	spinner_time = time.perf_counter() - start_time
+	return {
+		'seconds': lines_time + spinner_time,
+		'lines_seconds': lines_time,
+		'spinner_seconds': spinner_time,
+		'output_bytes': size,
+		'megabytes_per_second': 2 * size / (lines_time + spinner_time) / 1e6,
+	}
+
+
+def scale_smart_test(smart_test):
+	"""
+	Scales down the S.M.A.R.T. wait times to make them comparable with the duration of the fake self-test
+
+	:param smart_test: the SmartTest class
+	"""
+	smart_test.SMART_MIN_WAIT_TIME = 0.1
+	smart_test.SMART_WAIT_TIME = 0.3
+	smart_test.SMART_MAX_WAIT_TIME = 3
+
+
+def benchmark_smart_polling(work_folder, options):
+	"""
+	Runs the S.M.A.R.T. test for several fake drives and counts the smartctl calls
+
+	:param work_folder: the folder for the benchmark files
+	:param options: the command line arguments
+	:return: the measured values
+	"""
+	from ru.ihna.kozhukhov.corefacility_checker.smart_test import SmartTest
+	scale_smart_test(SmartTest)
+	state_folder = os.environ['FAKE_SMART_STATE']
+	history_database = os.path.join(work_folder, "smart_history.sqlite3")
+	if os.path.isfile(history_database):
+		os.unlink(history_database)
+	devices = ["/dev/fake%d" % index for index in range(options.drives)]
+	start_time = time.perf_counter()
+	SmartTest.run(devices=devices, test_type="short", history_database=history_database)
+	elapsed_time = time.perf_counter() - start_time
+	with open(os.path.join(state_folder, "calls"), 'r') as calls_file:
+		calls = calls_file.readlines()
+	self_test_duration = float(os.environ['FAKE_SMART_DURATION'])
+	return {
+		'seconds': elapsed_time,
+		'overhead_seconds': elapsed_time - self_test_duration,
+		'drives': len(devices),
+		'smartctl_calls': len(calls),
+		'progress_polls': len([call for call in calls if call.startswith("-j -c")]),
+	}
+
+
+def get_mail_options(port):
+	"""
+	Returns the mailing options for the SMTP sink
+
+	:param port: the port the SMTP sink listens on
+	:return: the 'mailing' section of the configuration file
+	"""
+	return {
+		"server": "127.0.0.1",
+		"port": port,
+		"login": "benchmark@localhost",
+		"password": "benchmark",
+		"sender": "benchmark@localhost",
+		"recipient": "admin@localhost",
+		"use_ssl": False,
+		"use_tls": False,
+	}
+
+
+def benchmark_mail_encoding(work_folder, options):
+	"""
+	Sends a large file as the mail attachment to the SMTP sink
+
+	:param work_folder: the folder for the benchmark files
+	:param options: the command line arguments
+	:return: the measured values
+	"""
+	from smtp_sink import SmtpSink
+	from ru.ihna.kozhukhov.corefacility_checker.mail_handler import MailHandler
+	attachment_file = os.path.join(work_folder, "attachment-%d" % options.attachment_size)
+	if not os.path.isfile(attachment_file):
+		with open(attachment_file, 'wb') as output_file:
+			for _ in range(options.attachment_size >> 20):
+				output_file.write(os.urandom(1 << 20))
+			output_file.write(os.urandom(options.attachment_size & ((1 << 20) - 1)))
+	sink = SmtpSink()
+	MailHandler.mail_options = get_mail_options(sink.start())
+	try:
+		start_time = time.perf_counter()
+		MailHandler.send_file("Benchmark", "The attachment is sent by the benchmark", attachment_file)
+		single_time = time.perf_counter() - start_time
+		part_size = -(-options.attachment_size // 4)
+		parts = [(offset, min(part_size, options.attachment_size - offset))
+			for offset in range(0, options.attachment_size, part_size)]
+		start_time = time.perf_counter()
+		MailHandler.send_file("Benchmark", "The attachment is sent by the benchmark", attachment_file, parts)
+		parts_time = time.perf_counter() - start_time
+	finally:
+		sink.stop()
+	return {
+		'seconds': single_time + parts_time,
+		'single_mail_seconds': single_time,
+		'parts_seconds': parts_time,
+		'attachment_bytes': options.attachment_size,
+		'mails': sink.mail_number,
+		'sent_bytes': sink.received_bytes,
+		'megabytes_per_second': 2 * options.attachment_size / (single_time + parts_time) / 1e6,
+	}
+
+
+def benchmark_whole_run(work_folder, options):
+	"""
+	Runs the whole checker with the configuration where all tests use the fake utilities
+
+	:param work_folder: the folder for the benchmark files
+	:param options: the command line arguments
+	:return: the measured values
+	"""
+	from smtp_sink import SmtpSink
+	import ru.ihna.kozhukhov.corefacility_checker as checker
+	from ru.ihna.kozhukhov.corefacility_checker.smart_test import SmartTest
+	scale_smart_test(SmartTest)
+	sink = SmtpSink()
+	config = {
+		"posix_log": os.environ['FAKE_SYSLOG'],
+		"logging": {
+			"version": 1,
+			"disable_existing_loggers": False,
+			"formatters": {"mail_formatter": {"format": "[%(asctime)s] (%(levelname)s) %(message)s"}},
+			"handlers": {
+				"stream_handler": {"class": "logging.StreamHandler", "level": "DEBUG", "formatter": "mail_formatter"},
+				"mail_handler": {
+					"class": "ru.ihna.kozhukhov.corefacility_checker.mail_handler.MailHandler",
+					"level": "INFO",
+					"formatter": "mail_formatter",
+				},
+			},
+			"loggers": {
+				"django.corefacility.checker": {
+					"level": "DEBUG",
+					"propagate": False,
+					"handlers": ["stream_handler", "mail_handler"],
+				},
+			},
+		},
+		"mailing": get_mail_options(sink.start()),
+		"metrics": {
+			"textfile_folder": os.path.join(work_folder, "metrics"),
+			"history_file": os.path.join(work_folder, "history.jsonl"),
+		},
+		"parallel": options.parallel,
+		"set_up": ["true"],
+		"tests": {
+			"network": {"class": "posix_command", "command": "echo ping"},
+			"cpu": {"class": "cpu_test", "duration": 0.05},
+			"memory": {"class": "memory_test", "memory_size": "512M", "workers": 2, "numa": False},
+			"dd_zero": {"class": "disk_physical_reading", "device": "/dev/zero", "count": 4, "kernel_monitor": False},
+			"smart": {"class": "smart_test", "devices": ["/dev/fake0", "/dev/fake1"], "test_type": "short"},
+			"failed": {"class": "posix_command", "command": "false"},
+		},
+		"tear_down": ["true"],
+	}
+	config_file = os.path.join(work_folder, "checker.json")
+	with open(config_file, 'w') as output_file:
+		json.dump(config, output_file, indent=4)
+	checker._check_requirements = lambda: None
+	sys.argv = ["corefacility-checker", "--config", config_file]
+	try:
+		start_time = time.perf_counter()
+		checker.main()
+		elapsed_time = time.perf_counter() - start_time
+	finally:
+		sink.stop()
+	with open(config['metrics']['history_file'], 'r') as history_file:
+		records = [json.loads(line) for line in history_file]
+	if len(records) != len(config['tests']):
+		raise RuntimeError("Not all tests have been run: %d records in the history file" % len(records))
+	return {
+		'seconds': elapsed_time,
+		'tests': len(records),
+		'failed_tests': len([record for record in records if not record['success']]),
+		'test_seconds': sum([record['duration'] for record in records]),
+		'mails': sink.mail_number,
+	}
+
+
+def benchmark_health_sampling(work_folder, options):
+	"""
+	Takes an hour of health samples without waiting between them and measures the CPU time they take
+
+	:param work_folder: the folder for the benchmark files
+	:param options: the command line arguments
+	:return: the measured values
+	"""
+	from ru.ihna.kozhukhov.corefacility_checker.health_sampler import HealthSampler
+	sampler = HealthSampler(os.path.join(work_folder, "health.ring"))
+	channel_number = sampler.open()
+	sample_number = 3600
+	start_time = time.time() - sample_number
+	try:
+		start_cpu_time = time.thread_time()
+		for index in range(sample_number):
+			sampler.sample(start_time + index)
+		cpu_time = time.thread_time() - start_cpu_time
+	finally:
+		sampler.close()
+	return {
+		'seconds': cpu_time,
+		'channels': channel_number,
+		'microseconds_per_sample': cpu_time / sample_number * 1e6,
+		'cpu_percent_at_1_hz': cpu_time / sample_number * 100,
+	}
+
+
+def run_worker(benchmark, work_folder, options):
+	"""
+	Runs a single benchmark in the current interpreter and prints the measured values as JSON
+
+	:param benchmark: the benchmark name
+	:param work_folder: the folder for the benchmark files
+	:param options: the command line arguments
+	"""
+	sys.path.insert(0, SOURCE_PATH)
+	sys.path.insert(0, str(BENCHMARK_PATH))
+	os.makedirs(work_folder, exist_ok=True)
+	values = globals()["benchmark_" + benchmark](work_folder, options)
+	values['max_rss_megabytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+	print(json.dumps(values))
+
+
+def measure(benchmark, work_folder, options):
+	"""
+	Runs a single benchmark in a fresh interpreter with the fake utilities on PATH
+
+	:param benchmark: the benchmark name
+	:param work_folder: the folder for the benchmark files
+	:param options: the command line arguments
+	:return: the measured values
+	"""
+	run_folder = os.path.join(work_folder, benchmark)
+	smart_folder = os.path.join(run_folder, "smart")
+	os.makedirs(smart_folder, exist_ok=True)
+	for filename in os.listdir(smart_folder):
+		os.unlink(os.path.join(smart_folder, filename))
+	environment = dict(os.environ)
+	environment['PATH'] = os.pathsep.join([FAKES_PATH, environment.get('PATH', "")])
+	environment['PYTHONPATH'] = os.pathsep.join(filter(None, [SOURCE_PATH, environment.get('PYTHONPATH')]))
+	environment['PYTHONDONTWRITEBYTECODE'] = "1"
+	environment['FAKE_SYSLOG'] = os.path.join(run_folder, "syslog")
+	environment['FAKE_SMART_STATE'] = smart_folder
+	environment['FAKE_SMART_DURATION'] = str(options.smart_duration)
+	environment.setdefault('FAKE_DD_SECONDS', "0.2")
+	environment.setdefault('FAKE_MEMTESTER_SECONDS', "0.5")
+	with open(environment['FAKE_SYSLOG'], 'w'):
+		pass
+	arguments = [sys.executable, __file__, "--worker", benchmark, "--work-folder", work_folder,
+		"--syslog-size", str(options.syslog_size), "--output-size", str(options.output_size),
+		"--attachment-size", str(options.attachment_size), "--drives", str(options.drives)]
+	if options.parallel:
+		arguments.append("--parallel")
+	result = subprocess.run(arguments, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=run_folder, env=environment)
+	if result.returncode != 0:
+		sys.stderr.write(result.stderr.decode('utf-8', errors='replace'))
+		raise RuntimeError("The benchmark '%s' exited with status code %d" % (benchmark, result.returncode))
+	return json.loads(result.stdout.decode('utf-8').splitlines()[-1])
+
+
+def compare(results, baseline, tolerance):
+	"""
+	Compares the results with the baseline
+
+	:param results: the median values of each benchmark
+	:param baseline: the baseline values of each benchmark
+	:param tolerance: maximum allowed relative increase of the benchmark time
+	:return: list of the regressed benchmarks
+	"""
+	regressions = list()
+	print("\n%-16s %12s %12s %9s" % ("Benchmark", "baseline, s", "current, s", "change"))
+	for benchmark, values in results.items():
+		if benchmark not in baseline:
+			print("%-16s %12s %12.3f %9s" % (benchmark, "-", values['seconds'], "new"))
+			continue
+		baseline_time = baseline[benchmark]['seconds']
+		change = values['seconds'] / baseline_time - 1
+		is_regressed = change > tolerance
+		if is_regressed:
+			regressions.append(benchmark)
+		print("%-16s %12.3f %12.3f %+8.1f%%%s" % (benchmark, baseline_time, values['seconds'], change * 100,
+			" REGRESSION" if is_regressed else ""))
+	return regressions
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Measures the hot paths of the corefacility-checker")
+	parser.add_argument('benchmark', nargs='*', help="benchmarks to run: %s. All benchmarks by default" %
+		", ".join(BENCHMARKS))
+	parser.add_argument('--repeat', type=int, default=3, help="number of runs of each benchmark")
+	parser.add_argument('--work-folder', default=DEFAULT_WORK_FOLDER,
+		help="folder for the synthetic logs, attachments and other benchmark files")
+	parser.add_argument('--syslog-size', type=parse_size, default=parse_size("2G"),
+		help="size of the synthetic POSIX log, like '512M' or '4G'")
+	parser.add_argument('--output-size', type=parse_size, default=parse_size("64M"),
+		help="size of the command output captured by the CommandLineTest")
+	parser.add_argument('--attachment-size', type=parse_size, default=parse_size("256M"),
+		help="size of the file sent as the mail attachment")
+	parser.add_argument('--drives', type=int, default=8, help="number of fake drives polled by the S.M.A.R.T. test")
+	parser.add_argument('--smart-duration', type=float, default=3, help="duration of the fake self-test, seconds")
+	parser.add_argument('--parallel', action='store_true', help="run the tests concurrently in the 'whole_run'")
+	parser.add_argument('--baseline', help="the baseline file, results/<host name>.json by default")
+	parser.add_argument('--tolerance', type=float, default=0.2,
+		help="maximum allowed relative increase of the benchmark time")
+	parser.add_argument('--save', action='store_true', help="save the results as the new baseline")
+	parser.add_argument('--output', help="JSON file where the results will be saved")
+	parser.add_argument('--worker', help=argparse.SUPPRESS)
+	arguments = parser.parse_args()
+	if arguments.worker is not None:
+		run_worker(arguments.worker, arguments.work_folder, arguments)
+		return
+	benchmarks = arguments.benchmark or BENCHMARKS
+	for benchmark in benchmarks:
+		if benchmark not in BENCHMARKS:
+			parser.error("unknown benchmark: %s" % benchmark)
+	results = dict()
+	print("%-16s %12s %12s %12s" % ("Benchmark", "median, s", "min, s", "max RSS, MB"))
+	for benchmark in benchmarks:
+		samples = [measure(benchmark, arguments.work_folder, arguments) for _ in range(arguments.repeat)]
+		results[benchmark] = {name: statistics.median([sample[name] for sample in samples]) for name in samples[0]}
+		results[benchmark]['min_seconds'] = min([sample['seconds'] for sample in samples])
+		print("%-16s %12.3f %12.3f %12.1f" % (benchmark, results[benchmark]['seconds'],
+			results[benchmark]['min_seconds'], results[benchmark]['max_rss_megabytes']))
+	if arguments.output is not None:
+		with open(arguments.output, 'w') as output_file:
+			json.dump(results, output_file, indent=4)
+	baseline_file = arguments.baseline or str(RESULTS_PATH / ("%s.json" % socket.gethostname()))
+	regressions = list()
+	if os.path.isfile(baseline_file):
+		with open(baseline_file, 'r') as input_file:
+			regressions = compare(results, json.load(input_file), arguments.tolerance)
+	else:
+		print("\nNo baseline has been found in %s" % baseline_file)
+	if arguments.save:
+		baseline = dict()
+		if os.path.isfile(baseline_file):
+			with open(baseline_file, 'r') as input_file:
+				baseline = json.load(input_file)
+		baseline.update(results)
+		os.makedirs(os.path.dirname(os.path.abspath(baseline_file)), exist_ok=True)
+		with open(baseline_file, 'w') as output_file:
+			json.dump(baseline, output_file, indent=4)
+		print("The results have been saved as the baseline to %s" % baseline_file)
+	elif len(regressions) > 0:
+		print("\nThe following benchmarks have regressed: %s" % ", ".join(regressions))
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
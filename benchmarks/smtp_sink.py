@@ -0,0 +1,119 @@
+"""
+A local SMTP server that accepts all mails and throws them away.
+
+The sink understands the commands sent by the MailHandler: EHLO/HELO, AUTH (any credentials are accepted), MAIL,
+RCPT, DATA, RSET, NOOP and QUIT. STARTTLS is not supported, so the mailing options must have 'use_ssl' and 'use_tls'
+set to false. The sink counts the delivered mails and their sizes but doesn't keep the mails themselves, so it is able
+to receive attachments of any size.
+"""
+import threading
+import socketserver
+
+
+class SmtpSinkHandler(socketserver.StreamRequestHandler):
+	"""
+	Serves a single SMTP connection
+	"""
+
+	DATA_TERMINATOR = b"\r\n.\r\n"
+
+	def handle(self):
+		self._reply("220 localhost SMTP sink ready")
+		while True:
+			line = self.rfile.readline()
+			if len(line) == 0:
+				return
+			command = line.decode('ascii', errors='replace').strip().split(" ", 1)[0].upper()
+			if command == "EHLO":
+				self._reply("250-localhost\r\n250-AUTH PLAIN LOGIN\r\n250-8BITMIME\r\n250 SIZE 0")
+			elif command == "AUTH":
+				self._reply("235 Authentication successful")
+			elif command == "DATA":
+				self._reply("354 End data with <CR><LF>.<CR><LF>")
+				self.server.sink.add_mail(self._receive_data())
+				self._reply("250 OK")
+			elif command == "QUIT":
+				self._reply("221 Bye")
+				return
+			elif command in ("HELO", "MAIL", "RCPT", "RSET", "NOOP"):
+				self._reply("250 OK")
+			else:
+				self._reply("502 Command not implemented")
+
+	def _receive_data(self):
+		"""
+		Reads the mail until the terminating line is received
+
+		:return: size of the mail in bytes
+		"""
+		size = 0
+		tail = b"\r\n"
+		while True:
+			chunk = self.rfile.read1(1 << 16)
+			if len(chunk) == 0:
+				raise ConnectionError("The client closed the connection within the DATA command")
+			size += len(chunk)
+			tail = (tail + chunk)[-len(self.DATA_TERMINATOR):]
+			if tail == self.DATA_TERMINATOR:
+				return size - len(self.DATA_TERMINATOR) + 2
+
+	def _reply(self, text):
+		self.wfile.write((text + "\r\n").encode('ascii'))
+
+
+class SmtpSink:
+	"""
+	Runs the SMTP sink in a background thread.
+
+	Usage:
+		sink = SmtpSink()
+		port = sink.start()
+		...
+		sink.stop()
+		print(sink.mail_number, sink.received_bytes)
+	"""
+
+	def __init__(self, host="127.0.0.1", port=0):
+		"""
+		Initializes the sink
+
+		:param host: the address to listen on
+		:param port: the port to listen on, 0 for any free port
+		"""
+		self.address = (host, port)
+		self.server = None
+		self.thread = None
+		self.lock = threading.Lock()
+		self.mail_number = 0
+		self.received_bytes = 0
+
+	def start(self):
+		"""
+		Starts the sink
+
+		:return: the port the sink listens on
+		"""
+		self.server = socketserver.ThreadingTCPServer(self.address, SmtpSinkHandler)
+		self.server.daemon_threads = True
+		self.server.sink = self
+		self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+		self.thread.start()
+		return self.server.server_address[1]
+
+	def stop(self):
+		"""
+		Stops the sink
+		"""
+		self.server.shutdown()
+		self.server.server_close()
+		self.thread.join()
+
+	def add_mail(self, size):
+		"""
+		Counts the received mail
+
+		:param size: size of the mail in bytes
+		"""
+		with self.lock:
+			self.mail_number += 1
+			self.received_bytes += size
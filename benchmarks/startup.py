@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Measures the cold-start time and the memory footprint of the corefacility-checker for each test class.
+
+Each measurement is made in a fresh Python interpreter that imports the corefacility-checker and loads the tester
+class the same way as the checker does before it runs the test. Two modes are compared:
+'lazy' - the tester is resolved by the TesterRegistry, so only its own module and dependencies are imported;
+'eager' - all standard tester modules and the scientific libraries are imported at start, as the checker did when it
+resolved testers by the static STANDARD_TESTERS dictionary and the CPU test imported numpy, scipy and psutil at the
+module level.
+
+Usage: python benchmarks/startup.py [--repeat N] [--output results.json]
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+from pathlib import Path
+
+
+SOURCE_PATH = str(Path(__file__).absolute().parent.parent / "src")
+EAGER_MODULES = ["numpy", "numpy.random", "scipy.signal", "scipy.fftpack", "psutil", "django.utils.module_loading"]
+MEASUREMENT_SCRIPT = """
+import sys
+import time
+import resource
+import importlib
+start_time = time.perf_counter()
+import ru.ihna.kozhukhov.corefacility_checker as checker
+from ru.ihna.kozhukhov.corefacility_checker.registry import STANDARD_TESTERS
+if sys.argv[2] == 'eager':
+	for module_name in sys.argv[3:]:
+		try:
+			importlib.import_module(module_name)
+		except ImportError:
+			pass
+	for path in STANDARD_TESTERS.values():
+		importlib.import_module(path.partition(':')[0])
+checker._load_tester(sys.argv[1])
+elapsed_time = time.perf_counter() - start_time
+print(elapsed_time, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, len(sys.modules))
+"""
+
+
+def measure(test_type, mode):
+	"""
+	Runs a single measurement in a fresh interpreter
+
+	:param test_type: value of the 'class' test property
+	:param mode: 'lazy' or 'eager'
+	:return: a tuple (load time in seconds, maximum RSS in kilobytes, number of imported modules)
+	"""
+	environment = dict(os.environ)
+	environment['PYTHONPATH'] = os.pathsep.join(filter(None, [SOURCE_PATH, environment.get('PYTHONPATH')]))
+	environment['PYTHONDONTWRITEBYTECODE'] = "1"
+	result = subprocess.run([sys.executable, "-c", MEASUREMENT_SCRIPT, test_type, mode] + EAGER_MODULES,
+		stdout=subprocess.PIPE, env=environment, check=True)
+	load_time, max_rss, module_number = result.stdout.decode('utf-8').split()
+	return float(load_time), int(max_rss), int(module_number)
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Measures the startup cost of each test class")
+	parser.add_argument('--repeat', type=int, default=5, help="number of measurements for each test class and mode")
+	parser.add_argument('--output', help="JSON file where the results will be saved")
+	arguments = parser.parse_args()
+	sys.path.insert(0, SOURCE_PATH)
+	from ru.ihna.kozhukhov.corefacility_checker.registry import STANDARD_TESTERS
+	results = dict()
+	print("%-24s %12s %12s %10s %10s %8s %8s" %
+		("Test class", "lazy, ms", "eager, ms", "lazy, MB", "eager, MB", "lazy, #", "eager, #"))
+	for test_type in STANDARD_TESTERS:
+		results[test_type] = dict()
+		for mode in ('lazy', 'eager'):
+			samples = [measure(test_type, mode) for _ in range(arguments.repeat)]
+			results[test_type][mode] = {
+				'load_time': statistics.median([sample[0] for sample in samples]),
+				'max_rss': statistics.median([sample[1] for sample in samples]) / 1024,
+				'modules': samples[0][2],
+			}
+		print("%-24s %12.1f %12.1f %10.1f %10.1f %8d %8d" % (
+			test_type,
+			results[test_type]['lazy']['load_time'] * 1000,
+			results[test_type]['eager']['load_time'] * 1000,
+			results[test_type]['lazy']['max_rss'],
+			results[test_type]['eager']['max_rss'],
+			results[test_type]['lazy']['modules'],
+			results[test_type]['eager']['modules'],
+		))
+	if arguments.output is not None:
+		with open(arguments.output, 'w') as output_file:
+			json.dump(results, output_file, indent=4)
+
+
+if __name__ == '__main__':
+	main()
@@ -7,30 +7,31 @@ import logging
 import logging.config
 import argparse
 import shutil
-from django.utils.module_loading import import_string
+import time
 
 from ru.ihna.kozhukhov.corefacility_checker.checker_test import CheckerTest
 from ru.ihna.kozhukhov.corefacility_checker.mail_handler import MailHandler
+from ru.ihna.kozhukhov.corefacility_checker.scheduler import TestScheduler, ScheduledTest
+from ru.ihna.kozhukhov.corefacility_checker.isolation import IsolatedRunner
+from ru.ihna.kozhukhov.corefacility_checker.registry import TesterRegistry
+from ru.ihna.kozhukhov.corefacility_checker.test_result import TestResult
+from ru.ihna.kozhukhov.corefacility_checker.metrics import MetricExporter
 
 
 ALREADY_UNMOUNTED_ERROR_CODE = 32
-STANDARD_TESTERS = {
-	"posix_command": "ru.ihna.kozhukhov.corefacility_checker.command_line_test.CommandLineTest",
-	"cpu_test": "ru.ihna.kozhukhov.corefacility_checker.cpu_test.CpuTest",
-	"memory_test": "ru.ihna.kozhukhov.corefacility_checker.memory_test.MemoryTest",
-	"disk_physical_reading": "ru.ihna.kozhukhov.corefacility_checker.disk_reading_test.DiskReadingTest",
-	"smart_test": "ru.ihna.kozhukhov.corefacility_checker.smart_test.SmartTest",
-	"fail_test": "ru.ihna.kozhukhov.corefacility_checker.fail_test.FailTest",
-	"sql_dump": "ru.ihna.kozhukhov.corefacility_checker.sql_dump.SqlDump",
-}
+EXECUTION_OPTIONS = ['resources', 'isolation', 'time_limit', 'memory_limit', 'schedule']
 CONFIG_FILE_TEMPLATE = Path(__file__).parent / 'config.json.default'
 DEFAULT_CONFIG_FILE = "/etc/corefacility/checker.json"
+tester_registry = TesterRegistry()
 
 def main():
 	"""
 	Represents the general logic of corefacility checker list.
 	The main role of the corefacility checker list is to apply different checkers consequtively.
-	Each checker is executed in a separate Python kernel in order to prevent memory leakage.
+	When the '--isolate' option is given or the 'isolation' property is set, each checker is executed in a separate
+	Python kernel in order to prevent memory leakage.
+	When the '--parallel' option is given, checkers that don't share any resource run concurrently.
+	When the '--daemon' option is given, the checker keeps running and applies each checker according to its schedule.
 	"""
 	try:
 		_check_requirements()
@@ -40,26 +41,42 @@ def main():
 			shutil.copyfile(CONFIG_FILE_TEMPLATE, destination)
 			print("The configuration file has been successfully created")
 			sys.exit(0)
+		if arguments.restore_dump:
+			_restore_dump(arguments.restore_dump, arguments.output)
+			sys.exit(0)
+		if arguments.status or arguments.trigger:
+			_send_daemon_request(arguments)
+			sys.exit(0)
+		if arguments.daemon:
+			_run_daemon(arguments)
+			return
+		if arguments.sample:
+			_run_health_sampler(_load_config(arguments.config))
+			sys.exit(0)
 		config = _load_config(arguments.config)
 		if len(arguments.test_name) == 0:
 			test_list = config['tests'].keys()
 		else:
 			test_list = arguments.test_name
-		CheckerTest.posix_log = config['posix_log']
-		CheckerTest.mail_options = config['mailing']
-		MailHandler.mail_options = config['mailing']
-		_configure_logging(config['logging'])
+		_apply_config(config)
 		_run_config_commands(config['set_up'])
-		for test_name in test_list:
-			if test_name not in config['tests']:
-				print("ERROR: The test '%s' has not been configured" % sys.argv[1])
-			else:
-				_run(config['tests'][test_name])
-				MailHandler.mail_records('error')
+		if arguments.isolate:
+			config['isolation'] = True
+		if arguments.parallel or config.get('parallel', False):
+			_run_parallel(config, test_list)
+		else:
+			for test_name in test_list:
+				if test_name not in config['tests']:
+					print("ERROR: The test '%s' has not been configured" % test_name)
+				else:
+					_run(test_name, config['tests'][test_name], config.get('isolation', False))
+					MailHandler.mail_records('error')
 		_run_config_commands(config['tear_down'])
 		MailHandler.mail_records('message')
 	except Exception as error:
 		print("\033[31mFATAL ERROR: %s\033[0m" % error)
+	finally:
+		MailHandler.close_outbox()
 
 
 def _parse_arguments():
@@ -80,10 +97,50 @@ def _parse_arguments():
 		default=DEFAULT_CONFIG_FILE)
 	parser.add_argument('--copy-config',
 		help="Don't test. Copy default configuration settings to the config file")
+	parser.add_argument('--restore-dump',
+		help="Don't test. Reassemble the SQL dump from its manifest file located in the chunk store")
+	parser.add_argument('--output',
+		help="File where the restored SQL dump will be written. Standard output is used by default")
+	parser.add_argument('--parallel',
+		help="Run tests that don't share any resource concurrently",
+		action='store_true')
+	parser.add_argument('--isolate',
+		help="Run each test in a separate worker process",
+		action='store_true')
+	parser.add_argument('--daemon',
+		help="Keep running and run each test according to its schedule. SIGHUP reloads the configuration file",
+		action='store_true')
+	parser.add_argument('--trigger',
+		help="Don't test. Ask the running daemon to run the given tests (all tests if no test is given) immediately",
+		action='store_true')
+	parser.add_argument('--status',
+		help="Don't test. Print the state of each test run by the daemon",
+		action='store_true')
+	parser.add_argument('--sample',
+		help="Don't test. Sample the hardware health to the file given in the 'health' section until SIGTERM",
+		action='store_true')
 	arguments = parser.parse_args()
 	return arguments
 
 
+def _restore_dump(manifest_file, output_file=None):
+	"""
+	Reassembles the SQL dump stored in the chunk store by the SqlDump test
+
+	:param manifest_file: the dump manifest. The chunk store is located in the same folder
+	:param output_file: the file where the dump will be written, None for the standard output
+	"""
+	from ru.ihna.kozhukhov.corefacility_checker.chunk_store import ChunkStore
+	store = ChunkStore(os.path.dirname(os.path.abspath(manifest_file)))
+	if output_file is None:
+		dump_size = store.restore(manifest_file, sys.stdout.buffer)
+		sys.stdout.buffer.flush()
+	else:
+		with open(output_file, 'wb') as output:
+			dump_size = store.restore(manifest_file, output)
+	print("The SQL dump has been successfully restored: %d bytes" % dump_size, file=sys.stderr)
+
+
 def _load_config(config):
 	"""
 	Loads checker configuration from the external configuration file
@@ -96,6 +153,149 @@ def _load_config(config):
 	return config
 
 
+def _apply_config(config):
+	"""
+	Applies the settings given in the configuration file: the POSIX log, mailing, metrics and logging
+
+	:param config: the checker configuration
+	"""
+	CheckerTest.posix_log = config['posix_log']
+	CheckerTest.mail_options = config['mailing']
+	CheckerTest.health_file = config.get('health', dict()).get('file')
+	MailHandler.mail_options = config['mailing']
+	MetricExporter.configure(config.get('metrics'))
+	_configure_logging(config['logging'])
+	if MailHandler.outbox is not None and MailHandler.outbox.spool_folder != config['mailing'].get('outbox'):
+		logging.getLogger("django.corefacility.checker").warning(
+			"The 'outbox' mail option has been changed. The change will take effect after restart")
+	MailHandler.open_outbox()
+
+
+def _run_daemon(arguments):
+	"""
+	Runs the checker in the daemon mode
+
+	:param arguments: the command line arguments
+	"""
+	from ru.ihna.kozhukhov.corefacility_checker.daemon import CheckerDaemon
+
+	def load_config():
+		config = _load_config(arguments.config)
+		if arguments.isolate:
+			config['isolation'] = True
+		if arguments.parallel:
+			config['parallel'] = True
+		return config
+
+	samplers = list()
+
+	def apply_config(config):
+		_apply_config(config)
+		health_options = config.get('health', dict())
+		if len(samplers) > 0:
+			old_options, old_sampler = samplers[0]
+			if old_options == health_options:
+				return
+			samplers.clear()
+			_stop_health_sampler(old_sampler)
+			try:
+				samplers.append((health_options, _start_health_sampler(config)))
+			except Exception as error:
+				logging.getLogger("django.corefacility.checker").error(
+					"The health sampler has not been restarted due to the following error: %s" % error)
+				samplers.append((None, None))
+		else:
+			samplers.append((health_options, _start_health_sampler(config)))
+
+	daemon = CheckerDaemon(
+		load_config,
+		apply_config,
+		_create_scheduled_test,
+		lambda scheduled_test: _run_tester(scheduled_test.tester, scheduled_test.test_config,
+			scheduled_test.execution_options, scheduled_test.test_name),
+		_run_config_commands,
+	)
+	try:
+		daemon.run()
+	finally:
+		for _, sampler in samplers:
+			_stop_health_sampler(sampler)
+
+
+def _run_health_sampler(config):
+	"""
+	Samples the hardware health in the foreground until SIGTERM or SIGINT is received
+
+	:param config: the checker configuration
+	"""
+	import signal
+	import threading
+	_configure_logging(config['logging'])
+	sampler = _start_health_sampler(config)
+	if sampler is None:
+		raise ValueError("The 'health' section of the configuration file must contain the 'file' property")
+	stop_event = threading.Event()
+	signal.signal(signal.SIGTERM, lambda signal_number, frame: stop_event.set())
+	signal.signal(signal.SIGINT, lambda signal_number, frame: stop_event.set())
+	try:
+		while not stop_event.is_set():
+			stop_event.wait(60)
+	finally:
+		_stop_health_sampler(sampler)
+
+
+def _start_health_sampler(config):
+	"""
+	Starts sampling the hardware health in the background thread
+
+	:param config: the checker configuration
+	:return: the HealthSampler instance or None if the 'health' section is not configured
+	"""
+	health_options = config.get('health', dict())
+	if health_options.get('file') is None:
+		return None
+	from ru.ihna.kozhukhov.corefacility_checker.health_sampler import HealthSampler
+	sampler = HealthSampler(health_options['file'], health_options.get('interval'))
+	channel_number = sampler.open()
+	sampler.start()
+	logging.getLogger("django.corefacility.checker").info(
+		"The health sampler has been started: %d channels are sampled to %s" % (channel_number, sampler.filename))
+	return sampler
+
+
+def _stop_health_sampler(sampler):
+	"""
+	Stops sampling the hardware health
+
+	:param sampler: the HealthSampler instance or None
+	"""
+	if sampler is None:
+		return
+	sampler.stop()
+	sampler.close()
+	if sampler.overhead is not None:
+		logging.getLogger("django.corefacility.checker").info(
+			"The health sampler has been stopped. It took %1.4f%% of one CPU core" % (sampler.overhead * 100))
+
+
+def _send_daemon_request(arguments):
+	"""
+	Asks the running daemon to run the tests immediately or to report the state of the tests
+
+	:param arguments: the command line arguments
+	"""
+	from ru.ihna.kozhukhov.corefacility_checker.daemon import get_socket_path, send_request, format_status
+	socket_path = get_socket_path(_load_config(arguments.config))
+	if arguments.trigger:
+		response = send_request(socket_path, {'command': 'run', 'tests': arguments.test_name})
+		if len(response['queued']) > 0:
+			print("The following tests have been queued: %s" % ", ".join(response['queued']))
+		else:
+			print("All given tests are already queued or running")
+	if arguments.status:
+		print(format_status(send_request(socket_path, {'command': 'status'})))
+
+
 def _check_requirements():
 	"""
 	Checks whether at least one test could be run
@@ -140,28 +340,140 @@ def _run_config_commands(config_commands):
 				raise
 
 
-def _run(test_config):
+def _run(test_name, test_config, isolation=False):
 	"""
 	Starts a particular test
 
-	:param test_name: name of the checker extracted from the command line arguments
+	:param test_name: name of the test (key of the 'tests' dictionary in the configuration file)
+	:param test_config: the test configuration revealed from the 'tests' section of the configuration file
+	:param isolation: True if the test shall be run in a separate worker process unless the test configuration
+		says otherwise
 	"""
 	logger = logging.getLogger("django.corefacility.checker")
-	test_type = test_config['class']
-	del test_config['class']
+	test_type, test_config, execution_options = _split_test_config(test_config, isolation)
 	tester = None
 
 	try:
-		if test_type in STANDARD_TESTERS:
-			test_type = STANDARD_TESTERS[test_type]
-		tester = import_string(test_type)
-		if tester is None:
-			raise ValueError("Unknown tester - %s" % tester_name)
-		logger.info("The test '%s' has been started" % tester.name)
-		tester.run(**test_config)
-		logger.info("The test '%s' has been successfully completed" % tester.name)
+		tester = _load_tester(test_type)
+		_run_tester(tester, test_config, execution_options, test_name)
 	except Exception as error:
-		if tester is not None:
-			logger.error("The test '%s' has failed due to the following error: %s" % (tester.name, error))
-		else:
+		if tester is None:
 			logger.error("Unable to load the tester due to the following reason: %s" % error)
+
+
+def _run_parallel(config, test_list):
+	"""
+	Runs the tests concurrently. Tests that engage the same resources are run consequtively
+
+	:param config: the checker configuration
+	:param test_list: names of all tests to run
+	"""
+	logger = logging.getLogger("django.corefacility.checker")
+	scheduler = TestScheduler(
+		lambda scheduled_test: _run_tester(scheduled_test.tester, scheduled_test.test_config,
+			scheduled_test.execution_options, scheduled_test.test_name),
+		config.get('max_parallel_tests'),
+	)
+	for test_name in test_list:
+		if test_name not in config['tests']:
+			print("ERROR: The test '%s' has not been configured" % test_name)
+			continue
+		test_type, test_config, execution_options = \
+			_split_test_config(config['tests'][test_name], config.get('isolation', False))
+		resources = execution_options['resources']
+		try:
+			tester = _load_tester(test_type)
+			if resources is None:
+				resources = tester.get_resources(**test_config)
+		except Exception as error:
+			logger.error("Unable to load the tester due to the following reason: %s" % error)
+			continue
+		scheduler.add(test_name, tester, test_config, resources, execution_options)
+	scheduler.run(on_complete=lambda scheduled_test: MailHandler.mail_records('error'))
+	logger.info("Test schedule report:\n" + scheduler.report())
+
+
+def _split_test_config(test_config, isolation=False):
+	"""
+	Splits the test configuration into the tester class, the tester arguments and the execution options
+
+	:param test_config: the test configuration revealed from the 'tests' section of the configuration file
+	:param isolation: default value of the 'isolation' execution option
+	:return: a tuple (test_type, tester_arguments, execution_options)
+	"""
+	tester_arguments = dict(test_config)
+	test_type = tester_arguments.pop('class')
+	execution_options = {option: tester_arguments.pop(option, None) for option in EXECUTION_OPTIONS}
+	if execution_options['isolation'] is None:
+		execution_options['isolation'] = isolation or \
+			execution_options['time_limit'] is not None or execution_options['memory_limit'] is not None
+	return test_type, tester_arguments, execution_options
+
+
+def _create_scheduled_test(config, test_name):
+	"""
+	Loads the tester and finds out the resources engaged by the test
+
+	:param config: the checker configuration
+	:param test_name: name of the test (key of the 'tests' dictionary in the configuration file)
+	:return: the ScheduledTest instance
+	"""
+	test_type, test_config, execution_options = \
+		_split_test_config(config['tests'][test_name], config.get('isolation', False))
+	tester = _load_tester(test_type)
+	resources = execution_options['resources']
+	if resources is None:
+		resources = tester.get_resources(**test_config)
+	return ScheduledTest(test_name, tester, test_config, resources, execution_options)
+
+
+def _load_tester(test_type):
+	"""
+	Loads the tester class
+
+	:param test_type: value of the 'class' property of the test configuration
+	:return: the CheckerTest subclass
+	"""
+	return tester_registry.load(test_type)
+
+
+def _run_tester(tester, test_config, execution_options, test_name=None):
+	"""
+	Runs the loaded tester, reports the test results and exports the test metrics
+
+	:param tester: the CheckerTest subclass
+	:param test_config: the test configuration without the 'class' property and the execution options
+	:param execution_options: the execution options revealed by the _split_test_config function
+	:param test_name: name of the test (key of the 'tests' dictionary in the configuration file)
+	:return: True if the test has been passed, False otherwise
+	"""
+	logger = logging.getLogger("django.corefacility.checker")
+	start_time = time.time()
+	start_monotonic_time = time.monotonic()
+	result = None
+	error_message = None
+	try:
+		logger.info("The test '%s' has been started" % tester.name, extra={'summary': True})
+		if execution_options['isolation']:
+			runner = IsolatedRunner(
+				time_limit=execution_options['time_limit'],
+				memory_limit=execution_options['memory_limit'],
+			)
+			result = runner.run(tester, test_config)
+		else:
+			result = tester.run(**test_config)
+		logger.info("The test '%s' has been successfully completed" % tester.name, extra={'summary': True})
+	except Exception as error:
+		logger.error("The test '%s' has failed due to the following error: %s" % (tester.name, error))
+		result = getattr(error, 'result', None)
+		error_message = str(error)
+	if not isinstance(result, TestResult):
+		result = TestResult(tester.name)
+	result.test_name = tester.name if test_name is None else test_name
+	result.test_class = tester.__name__
+	result.is_ok = error_message is None
+	result.start_time = start_time
+	result.duration = time.monotonic() - start_monotonic_time
+	result.error = error_message
+	MetricExporter.export_all(result)
+	return result.is_ok
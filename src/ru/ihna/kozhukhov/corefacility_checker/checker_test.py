@@ -1,4 +1,5 @@
 import logging
+import os
 
 
 class CheckerTest:
@@ -12,10 +13,14 @@ class CheckerTest:
 	This is a base class for all test routines.
 	"""
 
+	EXCLUSIVE_RESOURCE = "exclusive"
+	SIZE_SUFFIXES = {'B': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
 	logger = logging.getLogger("django.corefacility.checker")
 	name = "Sample tester"
 	posix_log = None
 	mail_options = None
+	health_file = None
 
 	@classmethod
 	def run(cls, **kwargs):
@@ -23,5 +28,72 @@ class CheckerTest:
 		Provides a single running of the test
 
 		:param kwargs: The keyword arguments defined by each configuration file
+		:return: the TestResult containing all values measured by the test or None if the test measures nothing. When
+			the test fails, it shall raise the TestFailedError and attach the TestResult to it
 		"""
 		raise NotImplementedError("Please, implement the CheckerTest.run method")
+
+	@classmethod
+	def get_resources(cls, **kwargs):
+		"""
+		Returns all resources engaged by the test. Two tests that engage the same resource will never be run in
+		parallel. The 'exclusive' resource conflicts with any other resource.
+
+		:param kwargs: The keyword arguments defined by each configuration file
+		:return: a set of resource names like 'cpu', 'memory', 'database' or 'device:/dev/sda'
+		"""
+		return {cls.EXCLUSIVE_RESOURCE}
+
+	@classmethod
+	def get_health_history(cls, metrics, objects=None):
+		"""
+		Reports the health history collected by the health sampler between the tests
+
+		:param metrics: list of metrics to report, e.g. ['cpu_temperature']
+		:param objects: list of objects to report, e.g. ['sda']. None for all objects
+		:return: the report or an empty string if the health sampler is not configured or has no history
+		"""
+		if cls.health_file is None or not os.path.isfile(cls.health_file):
+			return ""
+		from .health_sampler import HealthHistory
+		try:
+			history = HealthHistory(cls.health_file)
+			try:
+				return history.report(metrics, objects)
+			finally:
+				history.close()
+		except Exception as error:
+			cls.logger.warning("Unable to read the health history: %s" % error)
+			return ""
+
+	@classmethod
+	def get_device_resource(cls, device):
+		"""
+		Returns the resource name for a given block device
+
+		:param device: the device file
+		:return: the resource name
+		"""
+		return "device:%s" % os.path.realpath(device)
+
+	@classmethod
+	def parse_size(cls, size):
+		"""
+		Converts the memory or disk size from the configuration file to number of bytes
+
+		:param size: either integer (number of bytes) or string like '512M', '15G' etc.
+		:return: number of bytes
+		"""
+		if isinstance(size, int):
+			return size
+		if not isinstance(size, str) or len(size) == 0:
+			raise ValueError("The size must be either integer or string like '15G'")
+		value = size.strip().upper()
+		multiplier = 1
+		if value[-1] in cls.SIZE_SUFFIXES:
+			multiplier = cls.SIZE_SUFFIXES[value[-1]]
+			value = value[:-1]
+		try:
+			return int(float(value) * multiplier)
+		except ValueError:
+			raise ValueError("Bad size: %s" % size)
@@ -0,0 +1,317 @@
+import os
+import json
+import zlib
+import hashlib
+
+
+class ChunkStore:
+	"""
+	Stores the dumps as sequences of content-defined chunks. Each unique chunk is stored only once.
+
+	The chunk boundaries are found by the gear rolling hash over the last WINDOW_SIZE bytes, so an insertion or a
+	deletion in the middle of the dump shifts only the chunks around the changed place while all other chunks remain
+	the same as in the previous dump. Each chunk is compressed by zlib and is stored in the 'chunks' subfolder under
+	its SHA-256 checksum. Each dump is represented by a small JSON manifest that lists checksums of all its chunks.
+	"""
+
+	CHUNK_FOLDER = "chunks"
+	MANIFEST_SUFFIX = ".manifest.json"
+	MANIFEST_VERSION = 1
+	PARTIAL_FILE_SUFFIX = ".part"
+	DEFAULT_COMPRESSION_LEVEL = 6
+
+	def __init__(self, folder, average_chunk_size=262_144, compression_level=None):
+		"""
+		Initializes the store
+
+		:param folder: the folder where manifests and the 'chunks' subfolder are located
+		:param average_chunk_size: the average chunk size in bytes, must be a power of two. Minimum chunk size is
+			one quarter and maximum chunk size is four times of this value
+		:param compression_level: the zlib compression level for new chunks. None for DEFAULT_COMPRESSION_LEVEL
+		"""
+		if average_chunk_size <= 0 or average_chunk_size & (average_chunk_size - 1) != 0:
+			raise ValueError("The average chunk size must be a power of two")
+		self.folder = folder
+		self.chunk_folder = os.path.join(folder, self.CHUNK_FOLDER)
+		self.average_chunk_size = average_chunk_size
+		self.compression_level = self.DEFAULT_COMPRESSION_LEVEL if compression_level is None else compression_level
+
+	def open_writer(self, name):
+		"""
+		Creates the writer that splits the dump into chunks and stores them
+
+		:param name: the dump name. The manifest will be stored as <name>.manifest.json
+		:return: the ChunkWriter instance
+		"""
+		return ChunkWriter(self, name)
+
+	def get_manifest_file(self, name):
+		"""
+		Returns full name of the manifest file
+
+		:param name: the dump name
+		:return: the manifest file name
+		"""
+		return os.path.join(self.folder, name + self.MANIFEST_SUFFIX)
+
+	def get_chunk_file(self, checksum):
+		"""
+		Returns full name of the chunk file
+
+		:param checksum: the chunk SHA-256 checksum as a hexadecimal string
+		:return: the chunk file name. Chunks are distributed among 256 subfolders by first two digits of the checksum
+		"""
+		return os.path.join(self.chunk_folder, checksum[:2], checksum)
+
+	def put_chunk(self, chunk):
+		"""
+		Stores the chunk if it has not been stored before
+
+		:param chunk: the chunk data
+		:return: a tuple (checksum, number of bytes written to the disk). The second element is 0 for the chunk that
+			already exists in the store
+		"""
+		checksum = hashlib.sha256(chunk).hexdigest()
+		chunk_file = self.get_chunk_file(checksum)
+		if os.path.exists(chunk_file):
+			return checksum, 0
+		os.makedirs(os.path.dirname(chunk_file), exist_ok=True)
+		compressed_chunk = zlib.compress(chunk, self.compression_level)
+		partial_chunk_file = chunk_file + self.PARTIAL_FILE_SUFFIX
+		with open(partial_chunk_file, 'wb') as output_file:
+			output_file.write(compressed_chunk)
+		os.rename(partial_chunk_file, chunk_file)
+		return checksum, len(compressed_chunk)
+
+	def get_chunk(self, checksum):
+		"""
+		Reads the chunk and checks its integrity
+
+		:param checksum: the chunk SHA-256 checksum as a hexadecimal string
+		:return: the chunk data
+		"""
+		with open(self.get_chunk_file(checksum), 'rb') as input_file:
+			chunk = zlib.decompress(input_file.read())
+		if hashlib.sha256(chunk).hexdigest() != checksum:
+			raise ValueError("The chunk %s is corrupted" % checksum)
+		return chunk
+
+	def restore(self, manifest_file, output):
+		"""
+		Reassembles the dump by streaming all its chunks to the output
+
+		:param manifest_file: the manifest file name
+		:param output: the binary stream where the dump will be written
+		:return: number of bytes written
+		"""
+		with open(manifest_file, 'r') as input_file:
+			manifest = json.load(input_file)
+		if manifest.get('version') != self.MANIFEST_VERSION:
+			raise ValueError("Unsupported manifest version: %s" % manifest.get('version'))
+		checksum = hashlib.sha256()
+		total_size = 0
+		for chunk_checksum, chunk_size in manifest['chunks']:
+			chunk = self.get_chunk(chunk_checksum)
+			if len(chunk) != chunk_size:
+				raise ValueError("The chunk %s has wrong size" % chunk_checksum)
+			output.write(chunk)
+			checksum.update(chunk)
+			total_size += len(chunk)
+		if total_size != manifest['size'] or checksum.hexdigest() != manifest['sha256']:
+			raise ValueError("The restored dump doesn't match its manifest")
+		return total_size
+
+
+class ChunkWriter:
+	"""
+	Splits the data written into content-defined chunks and puts them into the chunk store.
+
+	The rolling hash is computed by numpy for the whole buffer at once. The 32-bit gear hash of a given position is
+	the sum of the gear table values of the last WINDOW_SIZE bytes shifted by their distance from this position, so
+	it can be computed by log2(WINDOW_SIZE) vector operations: the hash over 2k bytes is the hash over the last k bytes
+	plus the hash over the previous k bytes shifted by k. The gear table is built when the first writer is created, so
+	numpy is not imported until the dump is really written to the chunk store.
+	"""
+
+	WINDOW_SIZE = 32
+	PROCESSING_FACTOR = 8
+	gear_table = None
+
+	def __init__(self, store, name):
+		"""
+		Initializes the writer
+
+		:param store: the ChunkStore instance
+		:param name: the dump name
+		"""
+		import numpy
+		if ChunkWriter.gear_table is None:
+			ChunkWriter.gear_table = numpy.array(
+				[int.from_bytes(hashlib.sha256(bytes([value])).digest()[:4], 'little') for value in range(256)],
+				dtype=numpy.uint32,
+			)
+		self.store = store
+		self.name = name
+		self.min_chunk_size = store.average_chunk_size // 4
+		self.max_chunk_size = store.average_chunk_size * 4
+		self.mask_shift = numpy.uint32(32 - (store.average_chunk_size // 4 * 3).bit_length())
+		self.buffer = bytearray()
+		self.chunks = list()
+		self.new_checksums = list()
+		self.checksum = hashlib.sha256()
+		self.size = 0
+		self.new_chunk_number = 0
+		self.new_size = 0
+		self.written_size = 0
+		self.is_closed = False
+
+	def write(self, data):
+		"""
+		Writes the dump data
+
+		:param data: bytes-like object
+		:return: number of bytes written
+		"""
+		self.buffer += data
+		self.checksum.update(data)
+		self.size += len(data)
+		if len(self.buffer) >= self.PROCESSING_FACTOR * self.max_chunk_size:
+			self._process_buffer(False)
+		return len(data)
+
+	def flush(self):
+		"""
+		Does nothing. Chunks are stored when their boundaries are found
+		"""
+		pass
+
+	def close(self):
+		"""
+		Stores all remaining chunks and writes the manifest. When this fails, the dump is discarded by the abort method
+		"""
+		if self.is_closed:
+			return
+		manifest_file = self.store.get_manifest_file(self.name)
+		partial_manifest_file = manifest_file + self.store.PARTIAL_FILE_SUFFIX
+		try:
+			self._process_buffer(True)
+			manifest = {
+				'version': self.store.MANIFEST_VERSION,
+				'size': self.size,
+				'sha256': self.checksum.hexdigest(),
+				'average_chunk_size': self.store.average_chunk_size,
+				'chunks': self.chunks,
+			}
+			with open(partial_manifest_file, 'w') as output_file:
+				json.dump(manifest, output_file)
+			os.rename(partial_manifest_file, manifest_file)
+		except BaseException:
+			self.abort()
+			raise
+		self.written_size += os.stat(manifest_file).st_size
+		self.is_closed = True
+
+	def abort(self):
+		"""
+		Discards the dump: removes all chunks that have been added to the store by this writer and doesn't write the
+		manifest. Chunks that were already in the store before the writer was opened are kept. The writer must not
+		share the store with another writer running at the same time, because the other writer may refer to the chunks
+		removed here
+		"""
+		if self.is_closed:
+			return
+		partial_manifest_file = self.store.get_manifest_file(self.name) + self.store.PARTIAL_FILE_SUFFIX
+		for chunk_file in [self.store.get_chunk_file(checksum) for checksum in self.new_checksums] + \
+				[partial_manifest_file]:
+			try:
+				os.unlink(chunk_file)
+			except FileNotFoundError:
+				pass
+		self.new_checksums = list()
+		self.buffer = bytearray()
+		self.is_closed = True
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+		else:
+			self.abort()
+
+	@property
+	def dedup_ratio(self):
+		"""
+		Ratio of the dump size to the size of chunks that were absent in the store
+		"""
+		return self.size / self.new_size if self.new_size > 0 else float('inf')
+
+	def report(self):
+		"""
+		Builds the deduplication report
+
+		:return: the report as a string
+		"""
+		return ("Chunk store: %d bytes in %d chunks, %d new chunks (%d bytes), deduplication ratio %1.2f, " +
+			"%d bytes written to the disk") % (self.size, len(self.chunks), self.new_chunk_number, self.new_size,
+			self.dedup_ratio, self.written_size)
+
+	def _process_buffer(self, is_final):
+		"""
+		Finds the chunk boundaries in the buffer and stores all complete chunks
+
+		:param is_final: True if no more data will be written, so the buffer tail is also a chunk
+		"""
+		import numpy
+		buffer_size = len(self.buffer)
+		if buffer_size == 0:
+			return
+		boundaries = self._find_boundaries(numpy.frombuffer(self.buffer, dtype=numpy.uint8))
+		chunk_start = 0
+		boundary_index = 0
+		while True:
+			boundary_index += numpy.searchsorted(boundaries[boundary_index:], chunk_start + self.min_chunk_size)
+			if boundary_index < len(boundaries) and boundaries[boundary_index] <= chunk_start + self.max_chunk_size:
+				chunk_end = int(boundaries[boundary_index])
+			elif buffer_size - chunk_start >= self.max_chunk_size:
+				chunk_end = chunk_start + self.max_chunk_size
+			else:
+				break
+			self._store_chunk(chunk_start, chunk_end)
+			chunk_start = chunk_end
+		if is_final and chunk_start < buffer_size:
+			self._store_chunk(chunk_start, buffer_size)
+			chunk_start = buffer_size
+		del self.buffer[:chunk_start]
+
+	def _find_boundaries(self, data):
+		"""
+		Computes the gear hash for each position of the data and finds positions where the chunk may end
+
+		:param data: numpy array of bytes
+		:return: sorted numpy array of offsets just after the bytes whose hash has all top bits equal to zero
+		"""
+		import numpy
+		hashes = self.gear_table[data]
+		distance = 1
+		while distance < self.WINDOW_SIZE and distance < len(data):
+			hashes[distance:] += hashes[:-distance] << numpy.uint32(distance)
+			distance *= 2
+		return numpy.flatnonzero((hashes >> self.mask_shift) == 0) + 1
+
+	def _store_chunk(self, chunk_start, chunk_end):
+		"""
+		Puts a single chunk into the store and adds it to the manifest
+
+		:param chunk_start: offset of the chunk start within the buffer
+		:param chunk_end: offset of the chunk end within the buffer
+		"""
+		chunk = bytes(self.buffer[chunk_start:chunk_end])
+		checksum, written_size = self.store.put_chunk(chunk)
+		self.chunks.append([checksum, len(chunk)])
+		if written_size > 0:
+			self.new_checksums.append(checksum)
+			self.new_chunk_number += 1
+			self.new_size += len(chunk)
+			self.written_size += written_size
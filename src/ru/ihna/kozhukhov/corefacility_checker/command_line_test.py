@@ -1,42 +1,233 @@
+import os
 import re
+import time
+import codecs
+import select
+import signal
 import subprocess
+from collections import deque
 
 from .checker_test import CheckerTest
 from .exceptions import TestFailedError
+from .test_result import TestResult
+
+
+class TerminalLine:
+	"""
+	Renders a single line of the terminal output: the carriage return moves the cursor to the line beginning and the
+	backspace moves the cursor one character back, so the following characters overwrite the previous ones. Progress
+	bars and spinners drawn by such characters are collapsed to their final state.
+	"""
+
+	control_pattern = re.compile(r'([\r\x08])')
+
+	def __init__(self):
+		self.text = ""
+		self.cursor = 0
+
+	def feed(self, data):
+		"""
+		Feeds a part of the line
+
+		:param data: the line part that doesn't contain the line feed character
+		"""
+		for part in self.control_pattern.split(data):
+			if part == "\r":
+				self.cursor = 0
+			elif part == "\x08":
+				self.cursor = max(self.cursor - 1, 0)
+			elif len(part) > 0:
+				self.text = self.text[:self.cursor] + part + self.text[self.cursor + len(part):]
+				self.cursor += len(part)
+
+	def __len__(self):
+		return len(self.text)
+
+	def pop(self):
+		"""
+		Returns the rendered line and starts a new one
+
+		:return: the line text
+		"""
+		text = self.text
+		self.text = ""
+		self.cursor = 0
+		return text
+
+
+class OutputReader:
+	"""
+	Splits the raw output of the external program into lines, renders each line by the TerminalLine and keeps the last
+	lines that fit into the output limit.
+	"""
+
+	MAX_LINE_LENGTH = 65536
+
+	def __init__(self, output_limit):
+		"""
+		Initializes the reader
+
+		:param output_limit: how many characters from the end of the output shall be kept
+		"""
+		self.output_limit = output_limit
+		self.output_tail = deque()
+		self.tail_size = 0
+		self.omitted_lines = 0
+		self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+		self.terminal_line = TerminalLine()
+
+	def feed(self, data):
+		"""
+		Processes the next portion of the output
+
+		:param data: bytes read from the program output. Empty bytes mean the end of the output
+		:return: list of lines completed by this portion
+		"""
+		is_final = len(data) == 0
+		line_parts = self.decoder.decode(data, final=is_final).split("\n")
+		lines = list()
+		for index, line_part in enumerate(line_parts):
+			self.terminal_line.feed(line_part)
+			is_last_part = index == len(line_parts) - 1
+			if is_last_part and not is_final and len(self.terminal_line) < self.MAX_LINE_LENGTH:
+				continue
+			if is_last_part and is_final and len(self.terminal_line) == 0:
+				continue
+			line = self.terminal_line.pop()
+			lines.append(line)
+			self.output_tail.append(line)
+			self.tail_size += len(line) + 1
+			while self.tail_size > self.output_limit and len(self.output_tail) > 1:
+				self.tail_size -= len(self.output_tail.popleft()) + 1
+				self.omitted_lines += 1
+		return lines
+
+	def get_output(self):
+		"""
+		Returns the kept output
+
+		:return: the last lines of the output joined by the line feed
+		"""
+		output = "\n".join(self.output_tail)
+		if self.omitted_lines > 0:
+			output = "... %d lines omitted ...\n%s" % (self.omitted_lines, output)
+		return output
 
 
 class CommandLineTest(CheckerTest):
 	"""
 	This is the base class for all tests implemented by the external program that shall be run through the command line
 
-	This class will launch such an external program and will copy all its STDOUT and STDERR output to a special buffer.
-	The command return code equal to 0 means that the test will be accomplished successfully. Non-zero return code
-	means that the test has failed.
+	This class will launch such an external program and will read its STDOUT and STDERR output line by line while the
+	program is running. Each line is logged at the DEBUG level as soon as it arrives, while only the last lines that
+	fit into the output limit are kept in memory and are reported at the ERROR level when the program fails. So, the
+	memory consumption doesn't depend on how long the program runs. The command return code equal to 0 means that the
+	test will be accomplished successfully. Non-zero return code means that the test has failed.
 	"""
 
 	name = "POSIX command tester"
-	backspace_pattern = re.compile(r'.\x08')
+
+	READ_SIZE = 65536
+	OUTPUT_LIMIT = 65536
+	POLL_INTERVAL = 1
+	KILL_GRACE_PERIOD = 10
 
 	@classmethod
-	def run(cls, command=None, **command_arguments):
+	def run(cls, command=None, command_timeout=None, command_output_limit=None, **command_arguments):
 		"""
 		Implements the launching routine
 
 		:param command: the command to be executed. This must be bash command represented as a single string, not a list
 							of strings
+		:param command_timeout: maximum running time of the command in seconds. When the command exceeds this time, the
+							command and all its child processes will be terminated and the test fails. None means no
+							limit
+		:param command_output_limit: how many characters of the command output shall be kept and reported when the
+							command fails. None for OUTPUT_LIMIT. The whole output is logged at the DEBUG level
+							anyway
 		:param command_arguments: the previous argument (command) will be passed through the format() method.
-							command_arguments are arguments for this method.
+							command_arguments are arguments for this method. Their names shall not start with
+							'command', such names are reserved for the options of the tester itself
 		"""
 		if command is None:
 			raise ValueError("CommandLineTester: the 'command' option must be specified")
+		output_limit = cls.OUTPUT_LIMIT if command_output_limit is None else command_output_limit
 		command = command.format(**command_arguments)
-		result = subprocess.run(("bash", "-c", command), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-		output = result.stdout.decode('utf-8')
-		output = cls.backspace_pattern.sub('', output)
-		if result.returncode == 0:
-			cls.logger.info(output)
+		result = TestResult(cls.name)
+		return_code, output = cls._execute(command, command_timeout, output_limit)
+		result.add_metric("command_timed_out", return_code is None,
+			"1 if the command has been terminated because of the timeout")
+		result.add_metric("command_exit_code", return_code, "Exit code of the external command")
+		if return_code is None:
+			cls.logger.error(output)
+			raise TestFailedError("The external command '%s' has been terminated because it took longer than %s s" %
+				(command, command_timeout), result)
+		if return_code == 0:
 			cls.logger.info("The external command '%s' has been successfully completed" % command)
 		else:
 			cls.logger.error(output)
 			raise TestFailedError("The external command '%s' has bee failed with status code %d" %
-				(command, result.returncode))
+				(command, return_code), result)
+		return result
+
+	@classmethod
+	def _execute(cls, command, timeout, output_limit):
+		"""
+		Runs the command and reads its output
+
+		:param command: the bash command
+		:param timeout: maximum running time of the command in seconds, None for no limit
+		:param output_limit: how many characters of the output tail shall be returned
+		:return: a tuple (return code, output tail). The return code is None if the command has been terminated
+			because of the timeout
+		"""
+		deadline = None if timeout is None else time.monotonic() + timeout
+		process = subprocess.Popen(("bash", "-c", command), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+			start_new_session=True)
+		output_reader = OutputReader(output_limit)
+		descriptor = process.stdout.fileno()
+		is_timed_out = False
+		try:
+			while True:
+				wait_time = cls.POLL_INTERVAL if deadline is None else min(cls.POLL_INTERVAL, deadline - time.monotonic())
+				if wait_time <= 0:
+					is_timed_out = True
+					break
+				ready_descriptors, _, _ = select.select([descriptor], [], [], wait_time)
+				if len(ready_descriptors) == 0:
+					continue
+				data = os.read(descriptor, cls.READ_SIZE)
+				for line in output_reader.feed(data):
+					cls.logger.debug(line)
+				if len(data) == 0:
+					break
+			if not is_timed_out:
+				try:
+					process.wait(None if deadline is None else max(deadline - time.monotonic(), 0))
+				except subprocess.TimeoutExpired:
+					is_timed_out = True
+			if is_timed_out:
+				cls._kill(process)
+		except BaseException:
+			cls._kill(process)
+			raise
+		finally:
+			process.stdout.close()
+		return None if is_timed_out else process.returncode, output_reader.get_output()
+
+	@classmethod
+	def _kill(cls, process):
+		"""
+		Terminates the command and all its child processes. The processes that don't finish within the
+		KILL_GRACE_PERIOD are killed
+
+		:param process: the subprocess.Popen instance
+		"""
+		try:
+			os.killpg(process.pid, signal.SIGTERM)
+			process.wait(cls.KILL_GRACE_PERIOD)
+		except subprocess.TimeoutExpired:
+			os.killpg(process.pid, signal.SIGKILL)
+			process.wait()
+		except ProcessLookupError:
+			process.wait()
@@ -0,0 +1,218 @@
+import os
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ParallelGzipWriter:
+	"""
+	Compresses the data on a thread pool and writes them as a gzip stream.
+
+	The input is split into blocks of equal size, each block is compressed independently into a separate gzip member
+	(like pigz does) and the members are written in the original order. Any gzip decompressor reads such a stream as
+	a single file. zlib releases the GIL during compression, so all workers run in parallel. The number of blocks being
+	compressed at the same time is bounded, so the memory consumption doesn't depend on the data size.
+	"""
+
+	GZIP_WBITS = 31
+
+	def __init__(self, output, level=6, workers=None, block_size=4_194_304):
+		"""
+		Initializes the writer
+
+		:param output: the binary stream where the compressed data will be written
+		:param level: the compression level, 1 to 9
+		:param workers: number of compression threads. None for the number of logical CPUs
+		:param block_size: size of a single uncompressed block in bytes
+		"""
+		self.output = output
+		self.level = level
+		self.workers = workers if workers is not None else os.cpu_count() or 1
+		self.block_size = block_size
+		self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="compression")
+		self.pending_blocks = deque()
+		self.buffer = bytearray()
+
+	def write(self, data):
+		"""
+		Writes the data to be compressed
+
+		:param data: bytes-like object
+		:return: number of bytes written
+		"""
+		self.buffer += data
+		while len(self.buffer) >= self.block_size:
+			self._submit(bytes(self.buffer[:self.block_size]))
+			del self.buffer[:self.block_size]
+		return len(data)
+
+	def flush(self):
+		"""
+		Does nothing. The data are written when the whole block has been compressed
+		"""
+		pass
+
+	def close(self):
+		"""
+		Compresses the rest of the data and writes all compressed blocks
+		"""
+		if self.executor is None:
+			return
+		try:
+			if len(self.buffer) > 0:
+				self._submit(bytes(self.buffer))
+				self.buffer = bytearray()
+			while len(self.pending_blocks) > 0:
+				self.output.write(self.pending_blocks.popleft().result())
+		finally:
+			self.executor.shutdown(wait=True, cancel_futures=True)
+			self.executor = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def _submit(self, block):
+		"""
+		Submits the block for compression. Writes the oldest compressed block when too many blocks are being compressed
+
+		:param block: the uncompressed block
+		"""
+		self.pending_blocks.append(self.executor.submit(self._compress_block, block, self.level))
+		while len(self.pending_blocks) > 2 * self.workers:
+			self.output.write(self.pending_blocks.popleft().result())
+
+	@classmethod
+	def _compress_block(cls, block, level):
+		"""
+		Compresses a single block into the complete gzip member
+
+		:param block: the uncompressed block
+		:param level: the compression level
+		:return: the gzip member
+		"""
+		compressor = zlib.compressobj(level, zlib.DEFLATED, cls.GZIP_WBITS)
+		return compressor.compress(block) + compressor.flush()
+
+
+class ZstdWriter:
+	"""
+	Compresses the data by the multi-threaded zstd compressor. Requires the 'zstandard' package.
+	"""
+
+	def __init__(self, output, level=3, workers=None):
+		"""
+		Initializes the writer
+
+		:param output: the binary stream where the compressed data will be written
+		:param level: the compression level, 1 to 22
+		:param workers: number of compression threads. None for the number of logical CPUs
+		"""
+		try:
+			import zstandard
+		except ImportError:
+			raise ValueError("The 'zstd' compression format requires the 'zstandard' Python package")
+		workers = workers if workers is not None else os.cpu_count() or 1
+		compressor = zstandard.ZstdCompressor(level=level, threads=workers)
+		self.writer = compressor.stream_writer(output, closefd=False)
+
+	def write(self, data):
+		"""
+		Writes the data to be compressed
+
+		:param data: bytes-like object
+		:return: number of bytes written
+		"""
+		return self.writer.write(data)
+
+	def flush(self):
+		"""
+		Does nothing. The data are written when the compressor decides to do this
+		"""
+		pass
+
+	def close(self):
+		"""
+		Finishes the zstd frame
+		"""
+		self.writer.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+
+class NullWriter:
+	"""
+	Counts all written data and discards them
+	"""
+
+	def __init__(self):
+		self.size = 0
+
+	def write(self, data):
+		self.size += len(data)
+		return len(data)
+
+	def flush(self):
+		pass
+
+
+COMPRESSION_FORMATS = {
+	'gzip': (ParallelGzipWriter, '.gz', 6),
+	'zstd': (ZstdWriter, '.zst', 3),
+}
+
+
+def open_compressor(output, compression_format='gzip', level=None, workers=None):
+	"""
+	Creates the compressing writer
+
+	:param output: the binary stream where the compressed data will be written
+	:param compression_format: either 'gzip' or 'zstd'
+	:param level: the compression level. None for the default level of a given format
+	:param workers: number of compression threads. None for the number of logical CPUs
+	:return: the writer that has write() and close() methods and can be used in the 'with' statement
+	"""
+	if compression_format not in COMPRESSION_FORMATS:
+		raise ValueError("The compression format must be one of: %s" % ", ".join(COMPRESSION_FORMATS.keys()))
+	writer_class, _, default_level = COMPRESSION_FORMATS[compression_format]
+	return writer_class(output, default_level if level is None else level, workers)
+
+
+def get_compression_suffix(compression_format):
+	"""
+	Returns the file name suffix for a given compression format
+
+	:param compression_format: either 'gzip' or 'zstd'
+	:return: the suffix like '.gz'
+	"""
+	if compression_format not in COMPRESSION_FORMATS:
+		raise ValueError("The compression format must be one of: %s" % ", ".join(COMPRESSION_FORMATS.keys()))
+	return COMPRESSION_FORMATS[compression_format][1]
+
+
+def benchmark_compression(sample, settings):
+	"""
+	Measures the compression speed and ratio on a given sample
+
+	:param sample: the uncompressed data
+	:param settings: list of tuples (format, level, workers)
+	:return: list of tuples (format, level, workers, speed in MB/s, compression ratio)
+	"""
+	results = list()
+	for compression_format, level, workers in settings:
+		output = NullWriter()
+		start_time = time.monotonic()
+		with open_compressor(output, compression_format, level, workers) as compressor:
+			compressor.write(sample)
+		elapsed_time = time.monotonic() - start_time
+		speed = len(sample) / elapsed_time / 1_048_576 if elapsed_time > 0 else 0.0
+		ratio = len(sample) / output.size if output.size > 0 else 0.0
+		results.append((compression_format, level, workers, speed, ratio))
+	return results
@@ -0,0 +1,215 @@
+import os
+import time
+import multiprocessing
+import numpy
+import numpy.fft
+import numpy.random
+
+from .exceptions import TestFailedError
+
+
+class CpuStressEngine:
+	"""
+	Engages all logical CPUs by starting one worker process per CPU.
+
+	Each worker is pinned to its own logical CPU and runs the selected workload on buffers that have been allocated
+	before the workload starts:
+	'fft' - forward and inverse Fast Fourier Transform of the complex noise between two preallocated buffers (requires
+		numpy 2.0 or higher);
+	'matmul' - multiplication of two square matrices by means of BLAS;
+	'stream' - the STREAM 'triad' operation that stresses the memory bus.
+
+	Each worker counts the work it did (floating point operations or bytes transferred) in a shared array, so the
+	achieved per-core throughput can be reported next to the temperatures. A worker that died (e.g., killed by the
+	OOM killer or crashed on a faulty core) fails the test, because the corresponding CPU is not loaded any more.
+	"""
+
+	SUPPORTED_WORKLOADS = ['fft', 'matmul', 'stream']
+	WORKLOAD_UNITS = {'fft': 'GFLOP/s', 'matmul': 'GFLOP/s', 'stream': 'GB/s'}
+	BLAS_THREAD_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+	START_METHOD = 'spawn'
+
+	def __init__(self, workload='fft', cpus=None):
+		"""
+		Initializes the engine
+
+		:param workload: one of the SUPPORTED_WORKLOADS
+		:param cpus: list of logical CPUs to engage, None for all CPUs available for the current process
+		"""
+		if workload not in self.SUPPORTED_WORKLOADS:
+			raise ValueError("The 'workload' configuration parameter must be one of: %s" %
+				", ".join(self.SUPPORTED_WORKLOADS))
+		self.workload = workload
+		self.cpus = sorted(os.sched_getaffinity(0)) if cpus is None else list(cpus)
+		self.context = multiprocessing.get_context(self.START_METHOD)
+		self.work_done = self.context.Array('d', len(self.cpus), lock=False)
+		self.work_time = self.context.Array('d', len(self.cpus), lock=False)
+		self.stop_event = self.context.Event()
+		self.processes = list()
+
+	def start(self):
+		"""
+		Starts all worker processes
+		"""
+		saved_environment = {name: os.environ.get(name) for name in self.BLAS_THREAD_VARIABLES}
+		try:
+			for name in self.BLAS_THREAD_VARIABLES:
+				os.environ[name] = "1"
+			for index, cpu in enumerate(self.cpus):
+				process = self.context.Process(
+					target=_stress_worker,
+					args=(cpu, self.workload, self.work_done, self.work_time, index, self.stop_event),
+					name="cpu-stress-%d" % cpu,
+					daemon=True,
+				)
+				process.start()
+				self.processes.append(process)
+		finally:
+			for name, value in saved_environment.items():
+				if value is None:
+					del os.environ[name]
+				else:
+					os.environ[name] = value
+
+	def check(self):
+		"""
+		Checks that all worker processes are still running
+
+		:raises TestFailedError: if at least one worker process has finished before the engine was stopped
+		"""
+		dead_processes = [process for process in self.processes if not process.is_alive()]
+		if len(dead_processes) > 0:
+			raise TestFailedError("The CPU stress workers have finished unexpectedly: %s" %
+				self._format_exit_codes(dead_processes))
+
+	def stop(self):
+		"""
+		Stops all worker processes and waits until they finish
+
+		:raises TestFailedError: if at least one worker process has finished with non-zero exit code
+		"""
+		self.stop_event.set()
+		for process in self.processes:
+			process.join()
+		failed_processes = [process for process in self.processes if process.exitcode != 0]
+		self.processes = list()
+		if len(failed_processes) > 0:
+			raise TestFailedError("The CPU stress workers have failed: %s" % self._format_exit_codes(failed_processes))
+
+	def get_throughput(self):
+		"""
+		Returns the achieved throughput of each worker
+
+		:return: a dictionary logical CPU => throughput in units given by WORKLOAD_UNITS
+		"""
+		return {cpu: self.work_done[index] / self.work_time[index] * 1e-9 if self.work_time[index] > 0 else 0.0
+			for index, cpu in enumerate(self.cpus)}
+
+	def report(self):
+		"""
+		Builds the throughput report
+
+		:return: the report as a string
+		"""
+		unit = self.WORKLOAD_UNITS[self.workload]
+		throughput = self.get_throughput()
+		throughput_str = ["CPU %d: %1.2f %s" % (cpu, value, unit) for cpu, value in throughput.items()]
+		return "Workload '%s' throughput: %s; total %1.2f %s\n" % \
+			(self.workload, "; ".join(throughput_str), sum(throughput.values()), unit)
+
+	def _format_exit_codes(self, processes):
+		"""
+		Formats exit codes of the worker processes for the error message
+
+		:param processes: list of multiprocessing.Process instances
+		:return: a string like 'cpu-stress-3 (exit code -9)'
+		"""
+		return ", ".join("%s (exit code %s)" % (process.name, process.exitcode) for process in processes)
+
+
+def _stress_worker(cpu, workload, work_done, work_time, index, stop_event):
+	"""
+	The main routine of the worker process
+
+	:param cpu: the logical CPU to pin the worker to
+	:param workload: one of the CpuStressEngine.SUPPORTED_WORKLOADS
+	:param work_done: the shared array where the worker accumulates the work done
+	:param work_time: the shared array where the worker accumulates the working time
+	:param index: index of the worker within the shared arrays
+	:param stop_event: the event that stops the worker
+	"""
+	os.sched_setaffinity(0, {cpu})
+	workload_step, work_per_step = _WORKLOAD_FACTORIES[workload]()
+	batch_size = 1
+	start_time = time.monotonic()
+	while not stop_event.is_set():
+		batch_start_time = time.monotonic()
+		for _ in range(batch_size):
+			workload_step()
+		work_done[index] += batch_size * work_per_step
+		work_time[index] = time.monotonic() - start_time
+		if time.monotonic() - batch_start_time < 0.1:
+			batch_size *= 2
+
+
+def _create_fft_workload(length=1_048_576):
+	"""
+	Creates the FFT workload
+
+	:param length: number of points in the signal
+	:return: a tuple where the first element is the function that makes a single step and the second element is
+		number of floating point operations per step
+	"""
+	signal = (numpy.random.randn(length) + 1j * numpy.random.randn(length)).astype(numpy.complex128)
+	spectrum = numpy.empty_like(signal)
+
+	def fft_step():
+		numpy.fft.fft(signal, out=spectrum)
+		numpy.fft.ifft(spectrum, out=signal)
+
+	return fft_step, 2 * 5 * length * numpy.log2(length)
+
+
+def _create_matmul_workload(size=512):
+	"""
+	Creates the matrix multiplication workload
+
+	:param size: number of rows and columns in each matrix
+	:return: a tuple where the first element is the function that makes a single step and the second element is
+		number of floating point operations per step
+	"""
+	left = numpy.random.randn(size, size)
+	right = numpy.random.randn(size, size)
+	product = numpy.empty((size, size))
+
+	def matmul_step():
+		numpy.matmul(left, right, out=product)
+
+	return matmul_step, 2 * size ** 3
+
+
+def _create_stream_workload(length=8_388_608):
+	"""
+	Creates the STREAM 'triad' workload: a = b * scalar + c
+
+	:param length: number of elements in each array
+	:return: a tuple where the first element is the function that makes a single step and the second element is
+		number of bytes transferred through the memory bus per step
+	"""
+	a = numpy.zeros(length)
+	b = numpy.random.randn(length)
+	c = numpy.random.randn(length)
+	scalar = 3.0
+
+	def stream_step():
+		numpy.multiply(b, scalar, out=a)
+		numpy.add(a, c, out=a)
+
+	return stream_step, 5 * length * a.itemsize
+
+
+_WORKLOAD_FACTORIES = {
+	'fft': _create_fft_workload,
+	'matmul': _create_matmul_workload,
+	'stream': _create_stream_workload,
+}
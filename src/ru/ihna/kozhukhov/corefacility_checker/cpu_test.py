@@ -1,17 +1,15 @@
+import os
 import re
 import time
 from datetime import datetime, timedelta
 from threading import Thread
 import json
 import subprocess
-import numpy as np
-import numpy.random
-import scipy.signal
-import scipy.fftpack
-import psutil
 
 from .checker_test import CheckerTest
 from .exceptions import TestFailedError
+from .hwmon import HwmonTemperatureSampler
+from .test_result import TestResult
 
 
 class SampleCalculationThread(Thread):
@@ -37,6 +35,7 @@ class SampleCalculationThread(Thread):
 		"""
 		Method representing the thread’s activity.
 		"""
+		import scipy.signal
 		self.calculation_shall_be_completed = False
 		while not self.calculation_shall_be_completed:
 			result = scipy.signal.hilbert(self.signal)
@@ -55,34 +54,166 @@ class CpuTest(CheckerTest):
 
 	ARRAY_LENGTH = 1_000_000
 	ITERATION_TIME = 1
+	SAMPLING_RATE = 10
 	CORE_TEMPERATURE_TEMPLATE = re.compile(r'^[Cc]ore\s*(\d+)$')
 	CURRENT_VALUE_TEMPLATE = re.compile(r'^temp\d+_input$')
 	TEMPERATURE_LIMIT = 71
+	SUPPORTED_ENGINES = ['threads', 'processes']
+	SERIES_MARGIN = 100
+	MAX_SERIES_LENGTH = 1_000_000
+	STEADY_STATE_WINDOW = 60
+	STEADY_STATE_SLOPE = 0.5
 
 	name = "CPU temperature"
 	temperatures = None
 	threads = None
+	stress_engine = None
+	series = None
+	end_reason = None
 
 	@classmethod
-	def run(cls, duration=1, **kwargs):
+	def run(cls, duration=1, sampling_rate=None, engine="threads", workload="fft", series_folder=None,
+			adaptive=False, steady_state_window=None, steady_state_slope=None, **kwargs):
 		"""
 		Provides a single running of the test
 
 		:param duration: Amount of time (minutes) during which the computation shall last
+		:param sampling_rate: How many times per second the temperatures shall be measured. This option is applicable
+			only when the temperatures are read from the hwmon sysfs interface
+		:param engine: 'threads' to engage the CPU by Python threads, 'processes' to engage the CPU by the
+			CpuStressEngine that starts one pinned worker process per logical CPU
+		:param workload: the workload for the 'processes' engine: 'fft', 'matmul' or 'stream'
+		:param series_folder: a folder where the time series of temperatures, frequencies and thermal throttling
+			counters will be saved as an .npz file. None to don't save the time series
+		:param adaptive: True to finish the test before the duration elapsed: with success when temperatures of all
+			cores became stable, with failure when temperature of at least one core exceeded the limit
+		:param steady_state_window: duration of the time window (seconds) where temperatures must be stable
+		:param steady_state_slope: the temperature is stable when it changes not faster than given number of
+			degrees Celsius per minute
 		:param kwargs: The keyword arguments defined by each configuration file
 		"""
+		import psutil
+		from .thermal_series import ThermalSeries
+		if engine not in cls.SUPPORTED_ENGINES:
+			raise ValueError("The 'engine' configuration parameter must be one of: %s" %
+				", ".join(cls.SUPPORTED_ENGINES))
+		if sampling_rate is not None and (isinstance(sampling_rate, bool) or
+				not isinstance(sampling_rate, (int, float)) or sampling_rate <= 0):
+			raise ValueError("The 'sampling_rate' configuration parameter must be a positive number")
 		cls.temperatures = dict()
-		signal = numpy.random.randn(cls.ARRAY_LENGTH)
-		cls._start_computation_threads(signal)
+		sampler = HwmonTemperatureSampler()
+		if sampler.open() == 0:
+			cls.logger.debug("No CPU temperature sensors were found in the hwmon sysfs. The 'sensors' utility will be used")
+			sampler = None
+			sampling_interval = cls.ITERATION_TIME
+		else:
+			sampling_interval = 1 / (cls.SAMPLING_RATE if sampling_rate is None else sampling_rate)
+		initial_temperatures = cls._get_kernel_temperatures(sampler)
+		series_capacity = min(int(duration * 60 / sampling_interval) + cls.SERIES_MARGIN, cls.MAX_SERIES_LENGTH)
+		cls.series = ThermalSeries(series_capacity, initial_temperatures.keys())
+		series_start = time.monotonic()
+		cls.series.append(0.0, initial_temperatures)
+		cls._start_computation(engine, workload)
+		psutil.cpu_percent(percpu=True)
 		start_time = datetime.now()
 		end_time = start_time + timedelta(minutes=duration)
-		while datetime.now() < end_time:
-			time.sleep(cls.ITERATION_TIME)
-			cls._get_kernel_temperatures()
-			cls.logger.debug("Calculation info: Start time %s; Current time %s; End time %s" %
-				(start_time.isoformat(), datetime.now().isoformat(), end_time.isoformat()))
-		cls._finish_computation_threads()
-		return cls._report_cpu_temperatures()
+		last_report_time = start_time
+		cls.end_reason = "the test duration elapsed"
+		try:
+			while datetime.now() < end_time:
+				time.sleep(sampling_interval)
+				if cls.stress_engine is not None:
+					cls.stress_engine.check()
+				current_temperatures = cls._get_kernel_temperatures(sampler)
+				cls.series.append(time.monotonic() - series_start, current_temperatures)
+				if (datetime.now() - last_report_time).total_seconds() >= cls.ITERATION_TIME:
+					last_report_time = datetime.now()
+					cls.logger.debug("Calculation info: Start time %s; Current time %s; End time %s" %
+						(start_time.isoformat(), last_report_time.isoformat(), end_time.isoformat()))
+					if adaptive and cls._is_test_over(current_temperatures, steady_state_window, steady_state_slope):
+						break
+		finally:
+			if sampler is not None:
+				sampler.close()
+			cls.series.close()
+			cpu_load = psutil.cpu_percent(percpu=True)
+			cls._finish_computation()
+		if series_folder is not None:
+			series_file = os.path.join(series_folder, "cpu_test_%s.npz" % start_time.strftime("%Y%m%d_%H%M%S"))
+			cls.series.save(series_file)
+			cls.logger.debug("The CPU time series has been saved to %s" % series_file)
+		saved_time = (end_time - datetime.now()).total_seconds()
+		if saved_time > 0:
+			cls.end_reason += "; %1.0f s of %1.0f s saved" % (saved_time, duration * 60)
+		return cls._report_cpu_temperatures(cpu_load)
+
+	@classmethod
+	def _is_test_over(cls, current_temperatures, steady_state_window=None, steady_state_slope=None):
+		"""
+		Checks whether the adaptive test can be finished. Sets cls.end_reason when the test is over
+
+		:param current_temperatures: the last temperature sample
+		:param steady_state_window: duration of the time window (seconds) where temperatures must be stable
+		:param steady_state_slope: maximum temperature slope for the stable temperature, degrees Celsius per minute
+		:return: True if the test can be finished, False if the test shall be continued
+		"""
+		import numpy
+		if steady_state_window is None:
+			steady_state_window = cls.STEADY_STATE_WINDOW
+		if steady_state_slope is None:
+			steady_state_slope = cls.STEADY_STATE_SLOPE
+		if len(current_temperatures) > 0 and max(current_temperatures.values()) > cls.TEMPERATURE_LIMIT:
+			cls.end_reason = "the temperature limit was exceeded"
+			return True
+		slopes = cls.series.get_slopes(steady_state_window)
+		if slopes is None or len(slopes) == 0:
+			return False
+		max_slope = numpy.nanmax(numpy.abs(slopes)) * 60
+		if max_slope < steady_state_slope:
+			cls.end_reason = "temperatures of all cores became stable (%1.2f C/min within the last %d s)" % \
+				(max_slope, steady_state_window)
+			return True
+		return False
+
+	@classmethod
+	def get_resources(cls, **kwargs):
+		"""
+		Returns all resources engaged by the test
+
+		:param kwargs: The keyword arguments defined by each configuration file
+		:return: the CPU test engages all CPU cores
+		"""
+		return {"cpu"}
+
+	@classmethod
+	def _start_computation(cls, engine, workload):
+		"""
+		Engages all logical CPU cores
+
+		:param engine: 'threads' or 'processes'
+		:param workload: the workload for the 'processes' engine
+		"""
+		cls.stress_engine = None
+		cls.threads = None
+		if engine == "processes":
+			from .cpu_stress import CpuStressEngine
+			cls.stress_engine = CpuStressEngine(workload)
+			cls.stress_engine.start()
+		else:
+			import numpy.random
+			signal = numpy.random.randn(cls.ARRAY_LENGTH)
+			cls._start_computation_threads(signal)
+
+	@classmethod
+	def _finish_computation(cls):
+		"""
+		Finishes the computation started by the _start_computation method
+		"""
+		if cls.stress_engine is not None:
+			cls.stress_engine.stop()
+			print("Sample calculation completed.")
+		else:
+			cls._finish_computation_threads()
 
 	@classmethod
 	def _start_computation_threads(cls, signal):
@@ -91,16 +222,38 @@ class CpuTest(CheckerTest):
 
 		:param signal: a sample signal to process
 		"""
+		import psutil
 		logical_cores = psutil.cpu_count(logical=True)
 		threads = [SampleCalculationThread(signal) for _ in range(logical_cores)]
 		[thread.start() for thread in threads]
 		cls.threads = threads
 
 	@classmethod
-	def _get_kernel_temperatures(cls):
+	def _get_kernel_temperatures(cls, sampler=None):
+		"""
+		Returns temperature for each physical cores. The maximum temperatures are accumulated in cls.temperatures
+
+		:param sampler: the opened HwmonTemperatureSampler or None to use the 'sensors' utility
+		:return: a dictionary core number => current temperature
+		"""
+		if sampler is not None:
+			current_temperatures = sampler.sample()
+		else:
+			current_temperatures = cls._read_sensors()
+		for core_number, temperature_value in current_temperatures.items():
+			if core_number not in cls.temperatures:
+				cls.temperatures[core_number] = 0
+			cls.temperatures[core_number] = max(cls.temperatures[core_number], temperature_value)
+		return current_temperatures
+
+	@classmethod
+	def _read_sensors(cls):
 		"""
-		Returns temperature for each physical cores
+		Reads the core temperatures by means of the 'sensors' utility
+
+		:return: a dictionary core number => current temperature
 		"""
+		current_temperatures = dict()
 		result = subprocess.run(("sensors", "-j"), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True)
 		temperature_data = json.loads(result.stdout.decode('utf-8'))
 		for local_temperature_data in temperature_data.values():
@@ -112,9 +265,10 @@ class CpuTest(CheckerTest):
 				for value_name, temperature_value in temperature_values.items():
 					if cls.CURRENT_VALUE_TEMPLATE.match(value_name) is None:
 						continue
-					if core_number not in cls.temperatures:
-						cls.temperatures[core_number] = 0
-					cls.temperatures[core_number] = max(cls.temperatures[core_number], temperature_value)
+					if core_number not in current_temperatures:
+						current_temperatures[core_number] = temperature_value
+					current_temperatures[core_number] = max(current_temperatures[core_number], temperature_value)
+		return current_temperatures
 
 	@classmethod
 	def _finish_computation_threads(cls):
@@ -127,17 +281,64 @@ class CpuTest(CheckerTest):
 		print("Sample calculation completed.")
 
 	@classmethod
-	def _report_cpu_temperatures(cls):
+	def _report_cpu_temperatures(cls, cpu_load=None):
 		"""
 		Reports the CPU temperatures to the standard output
+
+		:param cpu_load: list of average loads (in percents) of all logical CPUs during the test
+		:return: the TestResult containing temperatures, loads, throughput and throttling events
 		"""
+		result = cls._create_result(cpu_load)
 		temperatures_str = ["Core %d: %1.1fC" % (core_number, temperatures)
 			for core_number, temperatures in cls.temperatures.items()]
 		temperatures_str = "CPU temperatures: " + "; ".join(temperatures_str) + "\n"
+		if cpu_load is not None and len(cpu_load) > 0:
+			temperatures_str += "CPU load: average %1.1f%%, minimum %1.1f%%\n" % \
+				(sum(cpu_load) / len(cpu_load), min(cpu_load))
+		if cls.stress_engine is not None:
+			temperatures_str += cls.stress_engine.report()
+		if cls.series is not None:
+			temperatures_str += cls.series.report()
+		if cls.end_reason is not None:
+			temperatures_str += "The test ended because %s\n" % cls.end_reason
+		temperatures_str += cls.get_health_history(["cpu_temperature"])
 		max_temperature = max(cls.temperatures.values())
 		if max_temperature > cls.TEMPERATURE_LIMIT:
 			raise TestFailedError("%sCPU test failed: the maximum temperature is %1.1f C that exceeds %1.1f C" %
-				(temperatures_str, max_temperature, cls.TEMPERATURE_LIMIT))
+				(temperatures_str, max_temperature, cls.TEMPERATURE_LIMIT), result)
 		else:
 			cls.logger.info("%sCPU test passed: the maximum temperature is %1.1f C that is good" %
 				(temperatures_str, max_temperature))
+		return result
+
+	@classmethod
+	def _create_result(cls, cpu_load=None):
+		"""
+		Puts all values measured during the test into the test result
+
+		:param cpu_load: list of average loads (in percents) of all logical CPUs during the test
+		:return: the TestResult instance
+		"""
+		result = TestResult(cls.name)
+		if len(cls.temperatures) > 0:
+			result.add_metric("cpu_peak_temperature_celsius", max(cls.temperatures.values()),
+				"Maximum temperature of all CPU cores during the test")
+		for core_number, temperature in cls.temperatures.items():
+			result.add_metric("cpu_core_peak_temperature_celsius", temperature,
+				"Maximum temperature of the CPU core during the test", core=core_number)
+		if cpu_load is not None and len(cpu_load) > 0:
+			result.add_metric("cpu_load_average_percent", sum(cpu_load) / len(cpu_load),
+				"Average load of all logical CPUs during the test")
+			result.add_metric("cpu_load_minimum_percent", min(cpu_load), "Load of the least loaded logical CPU")
+		if cls.stress_engine is not None:
+			for cpu, throughput in cls.stress_engine.get_throughput().items():
+				result.add_metric("cpu_stress_throughput", throughput,
+					"Throughput of the stress worker in GFLOP/s or GB/s depending on the workload",
+					cpu=cpu, workload=cls.stress_engine.workload)
+		if cls.series is not None:
+			throttling_events = cls.series.get_throttling_events()
+			result.add_metric("cpu_throttling_events", sum(throttling_events.values()),
+				"Number of thermal throttling events of all logical CPUs during the test")
+			result.add_metric("cpu_steady_state_seconds", cls.series.get_steady_state_time(),
+				"Time it took to reach the steady-state temperature")
+		return result
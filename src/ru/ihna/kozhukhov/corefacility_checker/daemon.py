@@ -0,0 +1,617 @@
+import os
+import json
+import time
+import select
+import signal
+import socket
+import logging
+import threading
+import socketserver
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from .mail_handler import MailHandler
+
+
+class CronSchedule:
+	"""
+	The test schedule given in the crontab format: 'minute hour day-of-month month day-of-week'.
+
+	Each field may contain '*', a single value, a range like '1-5', a list like '1,15' and a step like '*/10' or
+	'0-30/5'. Months and days of week may be given by their names: 'jan', 'mon' etc. Sunday is either 0 or 7. As in
+	cron, when both the day of month and the day of week are restricted, the test is run when either of them matches.
+	A field starting with '*' (like '*/2') is not treated as restricted.
+	The following aliases are also supported: @hourly, @daily, @midnight, @weekly, @monthly, @yearly, @annually.
+	"""
+
+	FIELDS = [('minute', 0, 59), ('hour', 0, 23), ('day of month', 1, 31), ('month', 1, 12), ('day of week', 0, 7)]
+	ALIASES = {
+		'@hourly': "0 * * * *",
+		'@daily': "0 0 * * *",
+		'@midnight': "0 0 * * *",
+		'@weekly': "0 0 * * 0",
+		'@monthly': "0 0 1 * *",
+		'@yearly': "0 0 1 1 *",
+		'@annually': "0 0 1 1 *",
+	}
+	NAMES = {
+		'month': ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"],
+		'day of week': ["sun", "mon", "tue", "wed", "thu", "fri", "sat"],
+	}
+	MAX_SEARCH_DAYS = 366 * 8
+
+	def __init__(self, expression):
+		"""
+		Parses the schedule
+
+		:param expression: the schedule in the crontab format
+		"""
+		self.expression = expression
+		if not isinstance(expression, str):
+			raise ValueError("The schedule must be a string in the crontab format")
+		fields = self.ALIASES.get(expression.strip().lower(), expression).split()
+		if len(fields) != len(self.FIELDS):
+			raise ValueError("Bad schedule '%s': 5 fields are expected" % expression)
+		values = [self._parse_field(field, *field_info) for field, field_info in zip(fields, self.FIELDS)]
+		self.minutes, self.hours, self.days, self.months, self.weekdays = values
+		if 7 in self.weekdays:
+			self.weekdays = (self.weekdays - {7}) | {0}
+		self.is_day_restricted = not fields[2].startswith("*")
+		self.is_weekday_restricted = not fields[4].startswith("*")
+		if self.next_time(datetime(2000, 1, 1)) is None:
+			raise ValueError("Bad schedule '%s': the date never comes" % expression)
+
+	def next_time(self, after):
+		"""
+		Finds the nearest time matching the schedule
+
+		:param after: the datetime instance. The returned time is strictly later than this time
+		:return: the datetime instance with zero seconds or None if the time is never met
+		"""
+		current_time = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+		last_time = after + timedelta(days=self.MAX_SEARCH_DAYS)
+		while current_time <= last_time:
+			if current_time.month not in self.months:
+				current_time = (current_time.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+			elif not self._matches_day(current_time):
+				current_time = current_time.replace(hour=0, minute=0) + timedelta(days=1)
+			elif current_time.hour not in self.hours:
+				current_time = current_time.replace(minute=0) + timedelta(hours=1)
+			elif current_time.minute not in self.minutes:
+				current_time += timedelta(minutes=1)
+			else:
+				return current_time
+		return None
+
+	def _matches_day(self, current_time):
+		"""
+		Checks whether the test shall be run at a given day
+
+		:param current_time: the datetime instance
+		:return: True if the day matches the schedule
+		"""
+		day_matches = current_time.day in self.days
+		weekday_matches = (current_time.weekday() + 1) % 7 in self.weekdays
+		if self.is_day_restricted and self.is_weekday_restricted:
+			return day_matches or weekday_matches
+		return day_matches and weekday_matches
+
+	def _parse_field(self, field, name, min_value, max_value):
+		"""
+		Parses a single field of the schedule
+
+		:param field: the field text
+		:param name: the field name
+		:param min_value: the minimum allowed value
+		:param max_value: the maximum allowed value
+		:return: set of all values matching the field
+		"""
+		values = set()
+		for item in field.lower().split(","):
+			value_range, _, step = item.partition("/")
+			try:
+				step = int(step) if step else 1
+				if value_range == "*":
+					first_value, last_value = min_value, max_value
+				else:
+					first_text, _, last_text = value_range.partition("-")
+					first_value = self._parse_value(first_text, name)
+					last_value = self._parse_value(last_text, name) if last_text else \
+						(max_value if "/" in item else first_value)
+			except ValueError:
+				raise ValueError("Bad schedule '%s': bad %s '%s'" % (self.expression, name, item))
+			if step <= 0 or first_value < min_value or last_value > max_value or first_value > last_value:
+				raise ValueError("Bad schedule '%s': %s '%s' is out of range" % (self.expression, name, item))
+			values.update(range(first_value, last_value + 1, step))
+		return values
+
+	def _parse_value(self, text, name):
+		"""
+		Parses a single value, either a number or a name of month or day of week
+
+		:param text: the value text
+		:param name: the field name
+		:return: the value as integer
+		"""
+		names = self.NAMES.get(name, list())
+		if text in names:
+			return names.index(text) + (1 if name == 'month' else 0)
+		return int(text)
+
+
+class DaemonTest:
+	"""
+	The state of a single configured test within the daemon.
+	"""
+
+	IDLE = "idle"
+	PENDING = "pending"
+	RUNNING = "running"
+
+	def __init__(self, test_name, schedule=None):
+		"""
+		Initializes the test state
+
+		:param test_name: name of the test (key of the 'tests' dictionary in the configuration file)
+		:param schedule: the CronSchedule instance, None if the test is run on demand only
+		"""
+		self.test_name = test_name
+		self.schedule = schedule
+		self.next_time = None
+		self.state = self.IDLE
+		self.last_start_time = None
+		self.last_duration = None
+		self.last_success = None
+		self.update_next_time(datetime.now())
+
+	def update_next_time(self, current_time):
+		"""
+		Calculates when the test shall be run next time
+
+		:param current_time: the datetime instance
+		"""
+		self.next_time = None if self.schedule is None else self.schedule.next_time(current_time)
+
+	def to_dict(self):
+		"""
+		Represents the test state as a JSON-serializable dictionary
+
+		:return: the dictionary
+		"""
+		return {
+			'schedule': None if self.schedule is None else self.schedule.expression,
+			'next_run': None if self.next_time is None else self.next_time.isoformat(),
+			'state': self.state,
+			'last_start': None if self.last_start_time is None else
+				datetime.fromtimestamp(self.last_start_time).isoformat(timespec='seconds'),
+			'last_duration': self.last_duration,
+			'last_success': self.last_success,
+		}
+
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+	"""
+	Serves a single request sent to the control socket: one JSON line is received and one JSON line is sent back
+	"""
+
+	def handle(self):
+		try:
+			request = json.loads(self.rfile.readline().decode('utf-8'))
+			response = self.server.checker_daemon.process_request(request)
+		except Exception as error:
+			response = {'ok': False, 'error': str(error)}
+		self.wfile.write((json.dumps(response) + "\n").encode('utf-8'))
+
+
+class CheckerDaemon:
+	"""
+	Keeps the checker running and runs each test according to its schedule.
+
+	The schedule of each test is given by the 'schedule' property of the test configuration in the crontab format
+	(see CronSchedule). Tests without this property follow the 'schedule' property of the 'daemon' section; tests
+	whose schedule is null are run on demand only. The due tests are put into the queue and are dispatched to the
+	worker threads in the queue order. Tests that share resources are never run at the same time, and no more than
+	one test is run at a time unless the 'parallel' option is set. The 'set_up' commands are run before the first test
+	when the daemon was idle and the 'tear_down' commands are run after the last test when the queue became empty.
+
+	The daemon reloads its configuration on SIGHUP and stops on SIGTERM or SIGINT, waiting for the running tests to
+	complete. The signal handlers only set the request flags: the main loop is woken up through the self-pipe that
+	is passed to signal.set_wakeup_fd(), since the handler may interrupt the main loop at any point, including the
+	moment when it holds a lock. The worker threads and the control socket wake the main loop through the same pipe.
+	The control socket given by the 'socket' property of the 'daemon' section accepts requests to run the
+	tests immediately and to report the state of each test (see send_request).
+	"""
+
+	DEFAULT_SOCKET = "/run/corefacility-checker.sock"
+	MAX_SLEEP_TIME = 60
+	MAX_WORKERS = 32
+
+	logger = logging.getLogger("django.corefacility.checker")
+
+	def __init__(self, config_loader, config_applier, test_factory, test_runner, command_runner):
+		"""
+		Initializes the daemon
+
+		:param config_loader: a function without arguments that reads the configuration file and returns the
+			configuration
+		:param config_applier: a function that accepts the configuration and applies the mailing, logging and metrics
+			settings. The function is called only when the configuration and all test schedules are valid
+		:param test_factory: a function that accepts the configuration and the test name and returns the ScheduledTest
+			instance. The function throws an exception if the tester can't be loaded
+		:param test_runner: a function that runs the test. The function accepts the ScheduledTest instance and returns
+			True if the test has been passed, False otherwise. The function must not throw any exception
+		:param command_runner: a function that runs the 'set_up' or 'tear_down' commands
+		"""
+		self.config_loader = config_loader
+		self.config_applier = config_applier
+		self.test_factory = test_factory
+		self.test_runner = test_runner
+		self.command_runner = command_runner
+		self.config = None
+		self.tests = dict()
+		self.queue = list()
+		self.running_tests = dict()
+		self.is_active = False
+		self.start_time = None
+		self.lock = threading.RLock()
+		self.wake_reader = None
+		self.wake_writer = None
+		self.reload_requested = False
+		self.stop_requested = False
+		self.is_stopping = False
+		self.server = None
+
+	def run(self):
+		"""
+		Runs the daemon until SIGTERM or SIGINT is received
+		"""
+		self.start_time = time.time()
+		self._load()
+		self.wake_reader, self.wake_writer = os.pipe()
+		os.set_blocking(self.wake_reader, False)
+		os.set_blocking(self.wake_writer, False)
+		previous_wakeup_fd = signal.set_wakeup_fd(self.wake_writer)
+		signal.signal(signal.SIGHUP, self._request_reload)
+		signal.signal(signal.SIGTERM, self._request_stop)
+		signal.signal(signal.SIGINT, self._request_stop)
+		self._start_server()
+		self.logger.info("The corefacility checker daemon has been started")
+		executor = ThreadPoolExecutor(max_workers=self.MAX_WORKERS, thread_name_prefix="checker")
+		try:
+			while not self.stop_requested or len(self.running_tests) > 0:
+				self._clear_wakeups()
+				if self.stop_requested and not self.is_stopping:
+					self.is_stopping = True
+					self.logger.info("The daemon will be stopped when the running tests are completed")
+				self._complete_tests()
+				if self.reload_requested:
+					self.reload_requested = False
+					self._reload()
+				if not self.stop_requested:
+					self._enqueue_due_tests()
+					if not self.is_active and len(self.queue) > 0:
+						self._start_activity()
+					self._dispatch(executor)
+				if self.is_active and len(self.running_tests) == 0 and (len(self.queue) == 0 or self.stop_requested):
+					self._finish_activity()
+				if not self.stop_requested or len(self.running_tests) > 0:
+					select.select([self.wake_reader], [], [], self._get_sleep_time())
+		finally:
+			executor.shutdown(wait=True)
+			self._stop_server()
+			signal.set_wakeup_fd(previous_wakeup_fd)
+			os.close(self.wake_reader)
+			os.close(self.wake_writer)
+			self.wake_reader = self.wake_writer = None
+		self.logger.info("The corefacility checker daemon has been stopped")
+
+	def process_request(self, request):
+		"""
+		Processes the request received through the control socket
+
+		:param request: the request as a dictionary. {'command': 'run', 'tests': [...]} puts given tests into the queue
+			(all tests if the list is empty), {'command': 'status'} reports the state of each test
+		:return: the response as a dictionary
+		"""
+		command = request.get('command')
+		with self.lock:
+			if command == 'status':
+				return {
+					'ok': True,
+					'start_time': datetime.fromtimestamp(self.start_time).isoformat(timespec='seconds'),
+					'queue': [scheduled_test.test_name for scheduled_test in self.queue],
+					'tests': {test_name: test.to_dict() for test_name, test in self.tests.items()},
+				}
+			if command == 'run':
+				if self.stop_requested:
+					return {'ok': False, 'error': "The daemon is being stopped"}
+				test_names = request.get('tests') or list(self.tests.keys())
+				unknown_tests = [test_name for test_name in test_names if test_name not in self.tests]
+				if len(unknown_tests) > 0:
+					return {'ok': False, 'error': "The following tests have not been configured: %s" %
+						", ".join(unknown_tests)}
+				queued_tests = [test_name for test_name in test_names if self._enqueue(test_name)]
+				self._wake()
+				return {'ok': True, 'queued': queued_tests}
+		return {'ok': False, 'error': "Unknown command: %s" % command}
+
+	def _load(self):
+		"""
+		Loads the configuration and builds the test schedule. Existing test states are kept. The configuration is
+		applied only when all test schedules are valid, so the bad configuration is never applied partially
+		"""
+		config = self.config_loader()
+		default_schedule = config.get('daemon', dict()).get('schedule')
+		tests = dict()
+		for test_name, test_config in config['tests'].items():
+			expression = test_config.get('schedule', default_schedule)
+			schedule = None if expression is None else CronSchedule(expression)
+			test = self.tests.get(test_name)
+			if test is None or test.to_dict()['schedule'] != expression:
+				previous_test = test
+				test = DaemonTest(test_name, schedule)
+				if previous_test is not None:
+					test.state = previous_test.state
+					test.last_start_time = previous_test.last_start_time
+					test.last_duration = previous_test.last_duration
+					test.last_success = previous_test.last_success
+			tests[test_name] = test
+		self.config_applier(config)
+		with self.lock:
+			self.config = config
+			self.tests = tests
+			self.queue = [scheduled_test for scheduled_test in self.queue if scheduled_test.test_name in tests]
+
+	def _reload(self):
+		"""
+		Reloads the configuration. The running tests are not affected. When the new configuration is bad, the
+		previous one is kept
+		"""
+		old_socket = self._get_socket_path()
+		try:
+			self._load()
+		except Exception as error:
+			self.logger.error("The configuration has not been reloaded due to the following error: %s" % error)
+			return
+		if self._get_socket_path() != old_socket:
+			self._stop_server()
+			self._start_server()
+		self.logger.info("The configuration has been reloaded")
+
+	def _enqueue_due_tests(self):
+		"""
+		Puts all tests that shall be run at the moment into the queue
+		"""
+		current_time = datetime.now()
+		with self.lock:
+			for test_name, test in self.tests.items():
+				if test.next_time is not None and test.next_time <= current_time:
+					test.update_next_time(current_time)
+					if test.state != DaemonTest.IDLE:
+						self.logger.warning("The test '%s' has been skipped because its previous run is not completed" %
+							test_name)
+					else:
+						self._enqueue(test_name)
+
+	def _enqueue(self, test_name):
+		"""
+		Puts the test into the queue
+
+		:param test_name: name of the test
+		:return: True if the test has been put into the queue, False if the test is already in the queue or is running
+		"""
+		test = self.tests[test_name]
+		if test.state != DaemonTest.IDLE:
+			return False
+		try:
+			scheduled_test = self.test_factory(self.config, test_name)
+		except Exception as error:
+			self.logger.error("Unable to load the tester due to the following reason: %s" % error)
+			return False
+		test.state = DaemonTest.PENDING
+		self.queue.append(scheduled_test)
+		return True
+
+	def _dispatch(self, executor):
+		"""
+		Starts the queued tests that don't conflict with the running tests and with the tests queued before them
+
+		:param executor: the ThreadPoolExecutor that runs the tests
+		"""
+		max_tests = 1
+		if self.config.get('parallel', False):
+			max_tests = min(self.config.get('max_parallel_tests') or self.MAX_WORKERS, self.MAX_WORKERS)
+		with self.lock:
+			blocking_tests = list(self.running_tests.values())
+			for scheduled_test in list(self.queue):
+				if len(self.running_tests) >= max_tests:
+					break
+				if any([scheduled_test.conflicts_with(other_test) for other_test in blocking_tests]):
+					blocking_tests.append(scheduled_test)
+					continue
+				self.queue.remove(scheduled_test)
+				self.tests[scheduled_test.test_name].state = DaemonTest.RUNNING
+				future = executor.submit(self._run_test, scheduled_test)
+				future.add_done_callback(lambda _: self._wake())
+				self.running_tests[future] = scheduled_test
+				blocking_tests.append(scheduled_test)
+
+	def _run_test(self, scheduled_test):
+		"""
+		Runs a single test within the worker thread
+
+		:param scheduled_test: the ScheduledTest instance
+		"""
+		scheduled_test.start_time = time.time()
+		try:
+			scheduled_test.is_ok = self.test_runner(scheduled_test)
+		finally:
+			scheduled_test.end_time = time.time()
+
+	def _complete_tests(self):
+		"""
+		Reports all tests that have been completed since the last check
+		"""
+		with self.lock:
+			completed_futures = [future for future in self.running_tests if future.done()]
+			for future in completed_futures:
+				scheduled_test = self.running_tests.pop(future)
+				test = self.tests.get(scheduled_test.test_name)
+				if test is not None:
+					test.state = DaemonTest.IDLE
+					test.last_start_time = scheduled_test.start_time
+					test.last_duration = scheduled_test.duration
+					test.last_success = bool(scheduled_test.is_ok)
+		if len(completed_futures) > 0:
+			MailHandler.mail_records('error')
+
+	def _start_activity(self):
+		"""
+		Runs the 'set_up' commands before the first test
+		"""
+		self.is_active = True
+		try:
+			self.command_runner(self.config['set_up'])
+		except Exception as error:
+			self.logger.error("The 'set_up' commands have failed: %s" % error)
+
+	def _finish_activity(self):
+		"""
+		Runs the 'tear_down' commands after the last test and mails the test reports
+		"""
+		self.is_active = False
+		try:
+			self.command_runner(self.config['tear_down'])
+		except Exception as error:
+			self.logger.error("The 'tear_down' commands have failed: %s" % error)
+		MailHandler.mail_records('error')
+		MailHandler.mail_records('message')
+
+	def _get_sleep_time(self):
+		"""
+		Calculates how long the daemon may sleep until the next test is due
+
+		:return: the sleep time in seconds
+		"""
+		current_time = datetime.now()
+		with self.lock:
+			next_times = [test.next_time for test in self.tests.values() if test.next_time is not None]
+		if len(next_times) == 0:
+			return self.MAX_SLEEP_TIME
+		return min(max((min(next_times) - current_time).total_seconds(), 0), self.MAX_SLEEP_TIME)
+
+	def _get_socket_path(self):
+		"""
+		Returns the path to the control socket
+
+		:return: the path
+		"""
+		return get_socket_path(self.config)
+
+	def _start_server(self):
+		"""
+		Starts listening the control socket
+		"""
+		socket_path = self._get_socket_path()
+		if os.path.exists(socket_path):
+			os.unlink(socket_path)
+		self.server = socketserver.ThreadingUnixStreamServer(socket_path, DaemonRequestHandler)
+		self.server.daemon_threads = True
+		self.server.checker_daemon = self
+		os.chmod(socket_path, 0o600)
+		threading.Thread(target=self.server.serve_forever, name="checker-socket", daemon=True).start()
+
+	def _stop_server(self):
+		"""
+		Stops listening the control socket and removes it
+		"""
+		if self.server is None:
+			return
+		self.server.shutdown()
+		self.server.server_close()
+		try:
+			os.unlink(self.server.server_address)
+		except FileNotFoundError:
+			pass
+		self.server = None
+
+	def _wake(self):
+		"""
+		Wakes up the main loop
+		"""
+		try:
+			os.write(self.wake_writer, b"\0")
+		except BlockingIOError:
+			pass
+
+	def _clear_wakeups(self):
+		"""
+		Reads all pending wake-ups from the self-pipe
+		"""
+		try:
+			while len(os.read(self.wake_reader, 4096)) > 0:
+				pass
+		except BlockingIOError:
+			pass
+
+	def _request_reload(self, signal_number, frame):
+		self.reload_requested = True
+
+	def _request_stop(self, signal_number, frame):
+		self.stop_requested = True
+
+
+def get_socket_path(config):
+	"""
+	Returns the path to the control socket of the daemon
+
+	:param config: the checker configuration
+	:return: the path
+	"""
+	return config.get('daemon', dict()).get('socket', CheckerDaemon.DEFAULT_SOCKET)
+
+
+def send_request(socket_path, request, timeout=10):
+	"""
+	Sends the request to the running daemon
+
+	:param socket_path: the control socket of the daemon
+	:param request: the request as a dictionary (see CheckerDaemon.process_request)
+	:param timeout: the connection timeout in seconds
+	:return: the response as a dictionary
+	"""
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+		client.settimeout(timeout)
+		try:
+			client.connect(socket_path)
+		except (FileNotFoundError, ConnectionRefusedError):
+			raise RuntimeError("The corefacility checker daemon is not running (no one listens %s)" % socket_path)
+		client.sendall((json.dumps(request) + "\n").encode('utf-8'))
+		with client.makefile('rb') as response_file:
+			response = json.loads(response_file.readline().decode('utf-8'))
+	if not response.get('ok', False):
+		raise RuntimeError(response.get('error', "The daemon has declined the request"))
+	return response
+
+
+def format_status(status):
+	"""
+	Represents the daemon status as a table
+
+	:param status: the response to the 'status' request
+	:return: the table as a string
+	"""
+	lines = ["The daemon is running since %s" % status['start_time'],
+		"%-24s %-16s %-8s %-20s %-20s %10s %-7s" %
+		("Test", "Schedule", "State", "Next run", "Last run", "Duration", "Result")]
+	for test_name, test in status['tests'].items():
+		lines.append("%-24s %-16s %-8s %-20s %-20s %10s %-7s" % (
+			test_name,
+			test['schedule'] or "on demand",
+			test['state'],
+			test['next_run'] or "-",
+			test['last_start'] or "-",
+			"-" if test['last_duration'] is None else "%1.1f s" % test['last_duration'],
+			{True: "passed", False: "failed", None: "-"}[test['last_success']],
+		))
+	return "\n".join(lines)
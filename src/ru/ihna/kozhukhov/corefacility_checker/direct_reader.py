@@ -0,0 +1,230 @@
+import os
+import mmap
+import time
+from array import array
+
+
+class DirectReader:
+	"""
+	Reads the block device with O_DIRECT and measures the read latency for each block.
+
+	The reader uses a single page-aligned buffer for all reads, so the page cache is bypassed and no memory is
+	allocated during the reading. Latency of each block is stored in a compact array of microseconds and is also
+	accumulated in a histogram with logarithmic (power of two) buckets. Blocks that could not be read are skipped
+	and are not counted in the throughput.
+	"""
+
+	SECTOR_SIZE = 512
+	HISTOGRAM_SIZE = 32
+	RANGE_NUMBER = 16
+	SLOW_BLOCK_FACTOR = 10
+	SLOW_BLOCK_MIN_LATENCY = 100_000
+
+	def __init__(self, device, block_size=1_048_576):
+		"""
+		Initializes the reader
+
+		:param device: the block device to read
+		:param block_size: size of a single read in bytes. Must be a multiple of the memory page size
+		"""
+		if block_size % mmap.PAGESIZE != 0:
+			raise ValueError("The block size must be a multiple of %d bytes" % mmap.PAGESIZE)
+		self.device = device
+		self.block_size = block_size
+		self.device_size = None
+		self.read_size = None
+		self.latencies = array('I')
+		self.histogram = array('Q', [0] * self.HISTOGRAM_SIZE)
+		self.range_size = None
+		self.range_times = None
+		self.range_bytes = None
+		self.failed_reads = list()
+		self.elapsed_time = None
+		self.cpu_time = None
+
+	def read(self, size=None, stop_event=None):
+		"""
+		Reads the device
+
+		:param size: number of bytes to read, None to read the whole device
+		:param stop_event: a threading.Event instance. When the event is set the reading will be interrupted
+		:return: offset where the reading has been finished, in bytes
+		"""
+		descriptor = os.open(self.device, os.O_RDONLY | getattr(os, 'O_DIRECT', 0))
+		buffer = mmap.mmap(-1, self.block_size)
+		buffer_view = memoryview(buffer)
+		tail_view = None
+		try:
+			self.device_size = os.lseek(descriptor, 0, os.SEEK_END)
+			read_size = self.device_size if size is None else min(size, self.device_size)
+			self.read_size = read_size
+			self.range_size = max(self._round_up(read_size // self.RANGE_NUMBER), self.block_size)
+			range_number = (read_size + self.range_size - 1) // self.range_size
+			self.range_times = array('d', [0.0] * range_number)
+			self.range_bytes = array('Q', [0] * range_number)
+			block_number = (read_size + self.block_size - 1) // self.block_size
+			self.latencies = array('I', [0]) * block_number
+			full_view = [buffer_view]
+			start_time = time.monotonic()
+			start_cpu_time = time.process_time()
+			offset = 0
+			while offset < read_size:
+				if stop_event is not None and stop_event.is_set():
+					break
+				# After a short read the rest of the block is read separately, so the next reads remain aligned
+				length = min(self.block_size - offset % self.block_size, read_size - offset)
+				if length == self.block_size:
+					views = full_view
+				else:
+					if tail_view is not None:
+						tail_view.release()
+					tail_view = buffer_view[:length]
+					views = [tail_view]
+				block_index = offset // self.block_size
+				range_index = offset // self.range_size
+				request_start = time.perf_counter_ns()
+				try:
+					bytes_read = os.preadv(descriptor, views, offset)
+				except OSError:
+					self.failed_reads.append((offset, length))
+					self.range_times[range_index] += (time.perf_counter_ns() - request_start) * 1e-9
+					offset += length
+					continue
+				latency = (time.perf_counter_ns() - request_start) // 1000
+				if bytes_read == 0:
+					break
+				self.latencies[block_index] = min(self.latencies[block_index] + latency, 0xFFFFFFFF)
+				self.histogram[min(latency.bit_length(), self.HISTOGRAM_SIZE - 1)] += 1
+				self.range_times[range_index] += latency * 1e-6
+				self.range_bytes[range_index] += bytes_read
+				offset += bytes_read
+			self.elapsed_time = time.monotonic() - start_time
+			self.cpu_time = time.process_time() - start_cpu_time
+			del self.latencies[(offset + self.block_size - 1) // self.block_size:]
+			return offset
+		finally:
+			if tail_view is not None:
+				tail_view.release()
+			buffer_view.release()
+			buffer.close()
+			os.close(descriptor)
+
+	def get_median_latency(self):
+		"""
+		Estimates the median latency from the histogram
+
+		:return: upper bound of the histogram bucket containing the median, in microseconds
+		"""
+		total = sum(self.histogram)
+		accumulated = 0
+		for bucket, count in enumerate(self.histogram):
+			accumulated += count
+			if accumulated * 2 >= total:
+				return 1 << bucket
+		return 0
+
+	def get_slow_ranges(self):
+		"""
+		Finds LBA ranges that have been read correctly but too slowly.
+
+		The block is treated as slow when its latency exceeds the median latency by SLOW_BLOCK_FACTOR times and is
+		not less than SLOW_BLOCK_MIN_LATENCY microseconds. Adjacent slow blocks are merged into a single range.
+		Blocks that could not be read have zero latency and are reported by get_error_ranges() instead.
+
+		:return: list of tuples (first LBA, last LBA, maximum latency in microseconds)
+		"""
+		threshold = max(self.get_median_latency() * self.SLOW_BLOCK_FACTOR, self.SLOW_BLOCK_MIN_LATENCY)
+		sectors_per_block = self.block_size // self.SECTOR_SIZE
+		slow_ranges = list()
+		current_range = None
+		for block_index, latency in enumerate(self.latencies):
+			if latency < threshold:
+				current_range = None
+				continue
+			first_lba = block_index * sectors_per_block
+			last_lba = min(first_lba + sectors_per_block, self.read_size // self.SECTOR_SIZE) - 1
+			if current_range is not None and current_range[1] == first_lba - 1:
+				current_range[1] = last_lba
+				current_range[2] = max(current_range[2], latency)
+			else:
+				current_range = [first_lba, last_lba, latency]
+				slow_ranges.append(current_range)
+		return [tuple(slow_range) for slow_range in slow_ranges]
+
+	def get_error_ranges(self):
+		"""
+		Returns LBA ranges that could not be read. Adjacent failed reads are merged into a single range.
+
+		:return: list of tuples (first LBA, last LBA)
+		"""
+		error_ranges = list()
+		for offset, length in self.failed_reads:
+			first_lba = offset // self.SECTOR_SIZE
+			last_lba = (offset + length + self.SECTOR_SIZE - 1) // self.SECTOR_SIZE - 1
+			if len(error_ranges) > 0 and error_ranges[-1][1] == first_lba - 1:
+				error_ranges[-1][1] = last_lba
+			else:
+				error_ranges.append([first_lba, last_lba])
+		return [tuple(error_range) for error_range in error_ranges]
+
+	def get_error_bytes(self):
+		"""
+		Returns total size of the blocks that could not be read
+
+		:return: size in bytes
+		"""
+		return sum(length for _, length in self.failed_reads)
+
+	def get_throughput(self):
+		"""
+		Returns the average reading throughput
+
+		:return: throughput in MB/s
+		"""
+		if not self.elapsed_time:
+			return 0.0
+		return sum(self.range_bytes) / self.elapsed_time / 1_048_576
+
+	def report(self):
+		"""
+		Builds the human-readable report
+
+		:return: the report as a string
+		"""
+		report_lines = ["Direct reading of %s: %d bytes in %1.1f s (%1.1f MB/s, CPU time %1.1f s)" %
+			(self.device, sum(self.range_bytes), self.elapsed_time, self.get_throughput(), self.cpu_time)]
+		if len(self.failed_reads) > 0:
+			report_lines.append("%d bytes could not be read" % self.get_error_bytes())
+		report_lines.append("Throughput over LBA ranges:")
+		for range_index, range_time in enumerate(self.range_times):
+			first_lba = range_index * self.range_size // self.SECTOR_SIZE
+			range_end = min((range_index + 1) * self.range_size, self.read_size)
+			last_lba = (range_end + self.SECTOR_SIZE - 1) // self.SECTOR_SIZE - 1
+			throughput = self.range_bytes[range_index] / range_time / 1_048_576 if range_time > 0 else 0.0
+			report_lines.append("\tLBA %d-%d: %1.1f MB/s" % (first_lba, last_lba, throughput))
+		report_lines.append("Read latency histogram:")
+		for bucket, count in enumerate(self.histogram):
+			if count > 0:
+				report_lines.append("\t< %d us: %d blocks" % (1 << bucket, count))
+		slow_ranges = self.get_slow_ranges()
+		if len(slow_ranges) > 0:
+			report_lines.append("Slow LBA ranges:")
+			for first_lba, last_lba, latency in slow_ranges:
+				report_lines.append("\tLBA %d-%d: %1.1f ms" % (first_lba, last_lba, latency / 1000))
+		else:
+			report_lines.append("No slow LBA ranges have been found")
+		error_ranges = self.get_error_ranges()
+		if len(error_ranges) > 0:
+			report_lines.append("Unreadable LBA ranges:")
+			for first_lba, last_lba in error_ranges:
+				report_lines.append("\tLBA %d-%d" % (first_lba, last_lba))
+		return "\n".join(report_lines)
+
+	def _round_up(self, size):
+		"""
+		Rounds the size up to the block size
+
+		:param size: the size in bytes
+		:return: the rounded size
+		"""
+		return (size + self.block_size - 1) // self.block_size * self.block_size
@@ -1,62 +1,251 @@
+import os
 import random
 import re
+import time
 import subprocess
 
 from .checker_test import CheckerTest
 from .exceptions import TestFailedError
+from .direct_reader import DirectReader
+from .kernel_monitor import KernelLogWatcher
+from .test_result import TestResult
 
 
 class DiskReadingTest(CheckerTest):
 	"""
 	Provides block-by-block disk reading and checks for all necessary errors.
 
-	The block-by-block disk reading will be organized by the DD utility
+	The block-by-block disk reading will be organized by the DD utility or by the DirectReader that measures
+	the read latency for each block and reveals sectors that have been read correctly but slowly
 	"""
 
 	BLOCK_SIZE = 16_777_216
+	DIRECT_BLOCK_SIZE = 1_048_576
+	SUPPORTED_MODES = ['dd', 'direct']
 	ATA_RELATED_LOG_PATTERN = re.compile(r'ata\d')
 	ATA_ERROR_MARKERS = ['exception', 'failed_command', 'bus error', 'hard reset']
+	ATA_ERROR_PATTERN = re.compile("|".join([re.escape(marker) for marker in ATA_ERROR_MARKERS]))
+	ATA_ERROR_BYTES_PATTERN = re.compile(ATA_ERROR_PATTERN.pattern.encode('utf-8'))
+	ATA_PORT_PATH_PATTERN = re.compile(r'/(ata\d+)/')
+	ATA_PORT_LOG_TEMPLATE = r'\b%s[.:]'
+	SYS_BLOCK_PATH = "/sys/class/block"
+	SYS_ATA_PORT_PATH = "/sys/class/ata_port"
+	ROTATED_LOG_SUFFIX = ".1"
+	ABORT_CHECK_INTERVAL = 1
+	HEALTH_METRICS = ['disk_io_errors', 'disk_read_latency_ms', 'disk_write_latency_ms']
 
 	name = "Disk reading test"
 
 	@classmethod
-	def run(cls, device=None, count=None, **kwargs):
+	def run(cls, device=None, count=None, mode="dd", block_size=None, kernel_monitor=True, max_ata_errors=1,
+			**kwargs):
 		"""
 		Provides the main test routine
 
 		:param device: the testing device
 		:param count: number of blocks to be read. Size of each block is 16 Mb
+		:param mode: 'dd' to read the device by the dd utility, 'direct' to read the device by the corefacility-checker
+			itself using O_DIRECT and to measure the read latency for each block
+		:param block_size: size of a single read in the 'direct' mode, in bytes or as a string like '1M'
+		:param kernel_monitor: True to watch the kernel messages during the reading and to abort the reading when
+			the number of ATA errors reaches max_ata_errors
+		:param max_ata_errors: number of ATA errors in the kernel messages that abort the reading
 		:param kwargs: useless
 		"""
+		if mode not in cls.SUPPORTED_MODES:
+			raise ValueError("The 'mode' configuration parameter must be one of: %s" % ", ".join(cls.SUPPORTED_MODES))
 		command = cls._generate_command_from_arguments(device, count)
+		ata_port = cls._get_ata_port(device)
 		test_id = str(random.random()).replace("0.", "")
 		test_mark_start = "disk_physical_reading START %s" % test_id
 		test_mark_end = "disk_physical_reading END %s" % test_id
+		log_position = cls._get_log_position()
 		subprocess.run(("logger", test_mark_start), check=True)
-		result = subprocess.run(command)
+		watcher = None
+		abort_event = None
+		if kernel_monitor:
+			watcher = KernelLogWatcher(lambda message: cls._is_ata_error_message(message, ata_port), max_ata_errors)
+			watcher.start()
+			abort_event = watcher.abort_event
+		result = TestResult(cls.name)
+		try:
+			if mode == "dd":
+				start_time = time.monotonic()
+				return_code = cls._run_dd(command, abort_event)
+				cls._add_dd_metrics(result, device, count, return_code, time.monotonic() - start_time)
+				test_description = " ".join(command)
+				engine_report = ""
+			else:
+				return_code, engine_report = cls._read_directly(device, count, block_size, abort_event, result)
+				test_description = "direct reading of %s" % device
+		finally:
+			if watcher is not None:
+				watcher.stop()
 		subprocess.run(("logger", test_mark_end), check=True)
-		log_lines = cls._read_posix_logs(test_mark_start, test_mark_end)
-		fail_number = cls._search_ata_fails(log_lines)
-		log_report = "\n".join(log_lines)
-		if result.returncode != 0 or fail_number > 0:
+		log_data = cls._read_posix_logs(test_mark_start, test_mark_end, log_position)
+		fail_number = cls._search_ata_fails(log_data, ata_port)
+		health_report = cls.get_health_history(cls.HEALTH_METRICS, [os.path.basename(os.path.realpath(device))])
+		log_report = engine_report + health_report + log_data.decode('utf-8', errors='replace').rstrip("\n")
+		ata_error_number = fail_number if watcher is None else max(fail_number, len(watcher.error_records))
+		result.add_metric("disk_ata_errors", ata_error_number, "Number of ATA errors found in the kernel messages",
+			device=device)
+		if watcher is not None and watcher.is_aborted:
+			raise TestFailedError(
+				("The '{command}' test has been aborted because {number} ATA errors were found in the kernel messages:\n" +
+				"{records}\nLog report:\n{report}")
+				.format(
+					command=test_description,
+					number=len(watcher.error_records),
+					records="\n".join(watcher.error_records),
+					report=log_report
+				),
+				result
+			)
+		if return_code != 0 or fail_number > 0:
 			raise TestFailedError(
 				("Failures during the '{command}' test. " +
 				"The command exited with status code {code}. " +
 				"Log report:\n{report}")
 				.format(
-					command=" ".join(command),
-					code=result.returncode,
+					command=test_description,
+					code=return_code,
 					report=log_report
-				)
+				),
+				result
 			)
 		else:
 			cls.logger.info(
 				"The '{command}' test was successful. Log report:\n{report}"
 				.format(
-					command=" ".join(command),
+					command=test_description,
 					report=log_report
 				)
 			)
+		return result
+
+
+	@classmethod
+	def _run_dd(cls, command, abort_event=None):
+		"""
+		Runs the dd utility
+
+		:param command: the dd command as returned by the _generate_command_from_arguments method
+		:param abort_event: a threading.Event instance. When the event is set the dd utility will be terminated
+		:return: the dd exit code
+		"""
+		process = subprocess.Popen(command)
+		while True:
+			try:
+				return process.wait(timeout=cls.ABORT_CHECK_INTERVAL)
+			except subprocess.TimeoutExpired:
+				if abort_event is not None and abort_event.is_set():
+					process.terminate()
+
+
+	@classmethod
+	def _read_directly(cls, device, count=None, block_size=None, abort_event=None, result=None):
+		"""
+		Reads the device by means of the DirectReader
+
+		:param device: the testing device
+		:param count: number of blocks to be read. Size of each block is 16 Mb
+		:param block_size: size of a single read, in bytes or as a string like '1M'
+		:param abort_event: a threading.Event instance. When the event is set the reading will be interrupted
+		:param result: the TestResult where the reading throughput, latency and number of slow and unreadable ranges
+			will be added. None to don't collect metrics
+		:return: a tuple where the first element is 0 if all blocks have been read successfully or 1 if at least one
+			block can't be read and the second element is the reading report
+		"""
+		block_size = cls.DIRECT_BLOCK_SIZE if block_size is None else cls.parse_size(block_size)
+		reader = DirectReader(device, block_size)
+		reader.read(None if count is None else count * cls.BLOCK_SIZE, abort_event)
+		return_code = 0 if len(reader.failed_reads) == 0 else 1
+		if result is not None:
+			result.add_metric("disk_read_bytes", sum(reader.range_bytes), "Number of bytes read from the disk",
+				device=device)
+			result.add_metric("disk_read_seconds", reader.elapsed_time, "Duration of the disk reading", device=device)
+			result.add_metric("disk_read_throughput_bytes_per_second", reader.get_throughput() * 1_048_576,
+				"Average reading throughput", device=device)
+			result.add_metric("disk_read_median_latency_seconds", reader.get_median_latency() * 1e-6,
+				"Median read latency of a single block (upper bound of the histogram bucket)", device=device)
+			result.add_metric("disk_slow_ranges", len(reader.get_slow_ranges()),
+				"Number of LBA ranges that have been read correctly but too slowly", device=device)
+			result.add_metric("disk_unreadable_blocks", len(reader.failed_reads),
+				"Number of blocks that could not be read", device=device)
+			result.add_metric("disk_unreadable_bytes", reader.get_error_bytes(),
+				"Number of bytes that could not be read", device=device)
+		return return_code, reader.report() + "\n"
+
+
+	@classmethod
+	def _add_dd_metrics(cls, result, device, count, return_code, elapsed_time):
+		"""
+		Adds the reading throughput measured for the dd utility to the test result
+
+		:param result: the TestResult instance
+		:param device: the testing device
+		:param count: number of blocks read by dd, None if the whole device has been read
+		:param return_code: the dd exit code. The throughput is not measured when dd failed
+		:param elapsed_time: the dd running time in seconds
+		"""
+		result.add_metric("disk_read_seconds", elapsed_time, "Duration of the disk reading", device=device)
+		if return_code != 0 or elapsed_time <= 0:
+			return
+		try:
+			descriptor = os.open(device, os.O_RDONLY)
+			try:
+				read_size = os.lseek(descriptor, 0, os.SEEK_END)
+			finally:
+				os.close(descriptor)
+		except OSError:
+			return
+		if count is not None:
+			read_size = min(read_size, count * cls.BLOCK_SIZE)
+		result.add_metric("disk_read_bytes", read_size, "Number of bytes read from the disk", device=device)
+		result.add_metric("disk_read_throughput_bytes_per_second", read_size / elapsed_time,
+			"Average reading throughput", device=device)
+
+
+	@classmethod
+	def get_resources(cls, device=None, **kwargs):
+		"""
+		Returns all resources engaged by the test
+
+		:param device: the testing device
+		:param kwargs: useless
+		:return: the disk reading test engages the tested device and the kernel messages of its ATA port. When the ATA
+			port of the device can't be found, the test counts ATA errors of all ports and hence engages all of them
+		"""
+		if device is None:
+			return {cls.EXCLUSIVE_RESOURCE}
+		ata_port = cls._get_ata_port(device)
+		if ata_port is not None:
+			ata_ports = [ata_port]
+		else:
+			try:
+				ata_ports = os.listdir(cls.SYS_ATA_PORT_PATH)
+			except OSError:
+				ata_ports = list()
+		return {cls.get_device_resource(device)} | {"ata_port:%s" % port for port in ata_ports}
+
+
+	@classmethod
+	def _get_ata_port(cls, device):
+		"""
+		Finds the ATA port the device is attached to
+
+		:param device: the device file or its partition
+		:return: the port name as it appears in the kernel messages (e.g. 'ata3') or None if the device is not an ATA
+			device or the port can't be found
+		"""
+		if not isinstance(device, str):
+			return None
+		device_name = os.path.basename(os.path.realpath(device))
+		sysfs_path = os.path.realpath(os.path.join(cls.SYS_BLOCK_PATH, device_name))
+		match = cls.ATA_PORT_PATH_PATTERN.search(sysfs_path)
+		if match is None:
+			return None
+		return match.group(1)
 
 
 	@classmethod
@@ -81,7 +270,21 @@ class DiskReadingTest(CheckerTest):
 
 
 	@classmethod
-	def _read_posix_logs(cls, test_mark_start, test_mark_end):
+	def _get_log_position(cls):
+		"""
+		Returns the current position of the POSIX log
+
+		:return: a tuple (inode, size) of the POSIX log file or None if the file doesn't exist
+		"""
+		try:
+			log_stat = os.stat(cls.posix_log)
+		except FileNotFoundError:
+			return None
+		return log_stat.st_ino, log_stat.st_size
+
+
+	@classmethod
+	def _read_posix_logs(cls, test_mark_start, test_mark_end, log_position=None):
 		"""
 		Reads all POSIX logs generated during the dd test.
 		This is assumed the the DiskReadingTest wrote the test_mark_start text to the POSIX logs before the dd test and
@@ -89,40 +292,98 @@ class DiskReadingTest(CheckerTest):
 		
 		:param test_mark_start: the text written before the dd test
 		:param test_mark_end: the text written after the dd test
-		:return log_lines: all log record generated during the test
-		"""
-		log_lines = list()
-		with open(cls.posix_log, 'r') as log_file:
-			include_log_record = False
-			for log_record in log_file:
-				log_record = log_record[:-1]
-				is_test_mark = False
-				if log_record.find(test_mark_start) != -1:
-					include_log_record = True
-					is_test_mark = True
-				if log_record.find(test_mark_end) != -1:
-					include_log_record = False
-					is_test_mark = True
-				if include_log_record and not is_test_mark:
-					log_lines.append(log_record)
-		return log_lines
+		:param log_position: position of the POSIX log before the test_mark_start text has been written, as returned by
+			the _get_log_position method. None to read the whole POSIX log
+		:return log_data: all log records generated during the test as bytes, each record is terminated by the newline
+		"""
+		log_data = cls._read_new_log_data(log_position)
+		start_index = log_data.find(test_mark_start.encode('utf-8'))
+		if start_index == -1:
+			return b""
+		start_index = log_data.find(b'\n', start_index) + 1
+		if start_index == 0:
+			return b""
+		end_index = log_data.find(test_mark_end.encode('utf-8'), start_index)
+		if end_index == -1:
+			end_index = len(log_data)
+		else:
+			end_index = log_data.rfind(b'\n', start_index, end_index) + 1
+			if end_index == 0:
+				end_index = start_index
+		return log_data[start_index:end_index]
 
 
 	@classmethod
-	def _search_ata_fails(cls, log_lines):
+	def _read_new_log_data(cls, log_position=None):
+		"""
+		Reads all data appended to the POSIX log since a given position.
+		If the log has been rotated since then, the tail of the rotated log is read first.
+
+		:param log_position: position of the POSIX log as returned by the _get_log_position method. None to read the
+			whole POSIX log
+		:return: the log data as bytes
 		"""
-		Looks for all fails generated during the ATA test
+		if log_position is None:
+			with open(cls.posix_log, 'rb') as log_file:
+				return log_file.read()
+		inode, offset = log_position
+		current_stat = os.stat(cls.posix_log)
+		if current_stat.st_ino == inode:
+			if current_stat.st_size < offset:
+				offset = 0
+			with open(cls.posix_log, 'rb') as log_file:
+				log_file.seek(offset)
+				return log_file.read()
+		log_chunks = list()
+		rotated_log = cls.posix_log + cls.ROTATED_LOG_SUFFIX
+		try:
+			with open(rotated_log, 'rb') as log_file:
+				if os.fstat(log_file.fileno()).st_ino == inode:
+					log_file.seek(offset)
+					log_chunks.append(log_file.read())
+		except FileNotFoundError:
+			pass
+		with open(cls.posix_log, 'rb') as log_file:
+			log_chunks.append(log_file.read())
+		return b"".join(log_chunks)
+
 
-		:param log_lines: all log records generated during the dd test
+	@classmethod
+	def _search_ata_fails(cls, log_data, ata_port=None):
+		"""
+		Looks for all fails generated during the ATA test.
+		The error markers are searched in the whole log data at once, only the records containing them are decoded and
+		checked further.
+
+		:param log_data: all log records generated during the dd test as bytes
+		:param ata_port: the ATA port of the tested device, e.g. 'ata3'. Errors of other ports are not counted. None to
+			count errors of all ports
 		:return: number of fails
 		"""
 		fail_number = 0
-		for log_line in log_lines:
-			if cls.ATA_RELATED_LOG_PATTERN.search(log_line) is not None and 'kernel' in log_line:
-				error_marker_number = 0
-				for error_marker in cls.ATA_ERROR_MARKERS:
-					if log_line.find(error_marker) != -1:
-						error_marker_number += 1
-				if error_marker_number > 0:
-					fail_number += 1
+		line_end = 0
+		for match in cls.ATA_ERROR_BYTES_PATTERN.finditer(log_data):
+			if match.start() < line_end:
+				continue
+			line_start = log_data.rfind(b'\n', 0, match.start()) + 1
+			line_end = log_data.find(b'\n', match.end())
+			if line_end == -1:
+				line_end = len(log_data)
+			log_line = log_data[line_start:line_end].decode('utf-8', errors='replace')
+			if 'kernel' in log_line and cls._is_ata_error_message(log_line, ata_port):
+				fail_number += 1
 		return fail_number
+
+
+	@classmethod
+	def _is_ata_error_message(cls, message, ata_port=None):
+		"""
+		Checks whether the kernel message reports the ATA error
+
+		:param message: the kernel message or the log record
+		:param ata_port: the ATA port of the tested device, e.g. 'ata3'. None to accept errors of all ports
+		:return: True if this is the ATA error, False otherwise
+		"""
+		port_pattern = cls.ATA_RELATED_LOG_PATTERN if ata_port is None else cls.ATA_PORT_LOG_TEMPLATE % ata_port
+		return re.search(port_pattern, message) is not None and \
+			cls.ATA_ERROR_PATTERN.search(message) is not None
@@ -2,4 +2,14 @@ class TestFailedError(RuntimeError):
 	"""
 	Triggers when the test has been failed.
 	"""
-	pass
+
+	def __init__(self, message, result=None):
+		"""
+		Initializes the error
+
+		:param message: the error message
+		:param result: the TestResult containing values that have been measured before the test failed. None if no
+			values have been measured
+		"""
+		super().__init__(message)
+		self.result = result
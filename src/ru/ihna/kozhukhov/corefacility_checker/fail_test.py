@@ -14,3 +14,10 @@ class FailTest(CheckerTest):
 	@classmethod
 	def run(cls, **kwargs):
 		raise TestFailedError("This kind of test always fails.")
+
+	@classmethod
+	def get_resources(cls, **kwargs):
+		"""
+		The fail test engages no resources
+		"""
+		return set()
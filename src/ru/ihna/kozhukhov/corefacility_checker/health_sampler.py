@@ -0,0 +1,737 @@
+import os
+import re
+import json
+import math
+import mmap
+import time
+import struct
+import logging
+import threading
+from datetime import datetime
+
+import numpy
+
+from .hwmon import HwmonTemperatureSampler
+
+
+GAUGE = "gauge"
+COUNTER = "counter"
+
+
+class HealthRing:
+	"""
+	Keeps the health samples in a fixed-size memory-mapped file.
+
+	The file contains three rings: the raw samples, the one-minute rollups and the one-hour rollups. Each ring holds
+	a fixed number of records and the oldest records are overwritten when the ring is full, so the file never grows.
+	Each record is a row of float64 values: the record time (UNIX timestamp) followed by the channel values. Raw
+	records contain the sampled values. Rollup records contain the minimum, the maximum and the mean value of each
+	gauge (e.g. temperature) and the last value of each counter (e.g. number of I/O errors) within the minute or the
+	hour. The rollup time is the beginning of the minute or the hour. Values that couldn't be read are NaN.
+
+	The file starts with a fixed header (magic, version, size of the layout description and the number of records
+	written to each ring so far) followed by the JSON layout description: the channels and the column names, offset
+	and capacity of each ring.
+	"""
+
+	MAGIC = b"CFHEALTH"
+	VERSION = 1
+	HEADER_FORMAT = "<8sII"
+	COUNT_OFFSET = 16
+	DESCRIPTION_OFFSET = 64
+	RAW_LEVEL = 0
+	LEVELS = [(None, 3600), (60, 7 * 24 * 60), (3600, 366 * 24)]
+
+	def __init__(self, filename, channels=None, interval=1):
+		"""
+		Opens the ring file
+
+		:param filename: the ring file
+		:param channels: list of tuples (channel name, GAUGE or COUNTER) to open the file for writing. When the file
+			doesn't exist or contains other channels it is created anew, the old file is renamed to <file>.old and the
+			history of the channels present in both files is copied to the new file. None to open the existing file
+			for reading
+		:param interval: the sampling interval in seconds, applicable only when the file is opened for writing
+		"""
+		self.filename = filename
+		self.is_writable = channels is not None
+		self.file = None
+		self.buffer = None
+		if self.is_writable:
+			description = self._create_description(channels, interval)
+			if not self._open(description):
+				self._create(description)
+		elif not self._open():
+			raise ValueError("%s is not a health ring file" % filename)
+
+	@property
+	def channels(self):
+		"""
+		List of tuples (channel name, GAUGE or COUNTER)
+		"""
+		return [tuple(channel) for channel in self.description['channels']]
+
+	@property
+	def interval(self):
+		"""
+		The sampling interval in seconds
+		"""
+		return self.description['interval']
+
+	def append(self, level, row):
+		"""
+		Appends the record to the ring
+
+		:param level: the ring number: 0 for the raw samples, 1 for the one-minute rollups, 2 for the one-hour rollups
+		:param row: the record values, the record time goes first
+		"""
+		count = self.get_count(level)
+		self.rings[level][count % len(self.rings[level])] = row
+		struct.pack_into("<Q", self.buffer, self.COUNT_OFFSET + 8 * level, count + 1)
+
+	def get_count(self, level):
+		"""
+		Returns how many records have been written to the ring since the file was created
+
+		:param level: the ring number
+		:return: number of records
+		"""
+		return struct.unpack_from("<Q", self.buffer, self.COUNT_OFFSET + 8 * level)[0]
+
+	def get_records(self, level, since=None):
+		"""
+		Returns the records kept in the ring in the chronological order
+
+		:param level: the ring number
+		:param since: the UNIX timestamp. Only records made at or after this time are returned. None for all records
+		:return: a copy of the records as a two-dimensional numpy array, one row per record
+		"""
+		ring = self.rings[level]
+		count = self.get_count(level)
+		if count <= len(ring):
+			records = ring[:count].copy()
+		else:
+			position = count % len(ring)
+			records = numpy.concatenate((ring[position:], ring[:position]))
+		if since is not None:
+			records = records[records[:, 0] >= since]
+		return records
+
+	def get_columns(self, level):
+		"""
+		Returns the column names of the ring
+
+		:param level: the ring number
+		:return: list of column names: 'time', then '<channel>' for the raw samples and counter rollups, and
+			'<channel>/min', '<channel>/max', '<channel>/mean' for the gauge rollups
+		"""
+		return self.description['levels'][level]['columns']
+
+	def close(self):
+		"""
+		Closes the ring file
+		"""
+		self.rings = None
+		if self.buffer is not None:
+			self.buffer.close()
+			self.buffer = None
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+	def _create_description(self, channels, interval):
+		"""
+		Builds the layout description of the ring file
+
+		:param channels: list of tuples (channel name, GAUGE or COUNTER)
+		:param interval: the sampling interval in seconds
+		:return: the layout description as a dictionary
+		"""
+		gauges = [name for name, kind in channels if kind == GAUGE]
+		counters = [name for name, kind in channels if kind == COUNTER]
+		raw_columns = ["time"] + [name for name, _ in channels]
+		rollup_columns = ["time"] + ["%s/%s" % (name, statistic) for statistic in ("min", "max", "mean")
+			for name in gauges] + counters
+		levels = list()
+		offset = None
+		for level, (level_interval, capacity) in enumerate(self.LEVELS):
+			levels.append({
+				'interval': interval if level_interval is None else level_interval,
+				'capacity': capacity,
+				'offset': offset,
+				'columns': raw_columns if level == self.RAW_LEVEL else rollup_columns,
+			})
+		description = {'interval': interval, 'channels': [list(channel) for channel in channels], 'levels': levels}
+		offset = self._align(self.DESCRIPTION_OFFSET + len(json.dumps(description)) + 1024)
+		for level_description in levels:
+			level_description['offset'] = offset
+			offset += self._align(level_description['capacity'] * len(level_description['columns']) * 8)
+		description['size'] = offset
+		return description
+
+	def _open(self, description=None):
+		"""
+		Opens the existing ring file
+
+		:param description: the expected layout description. None to accept any layout
+		:return: True if the file has been opened, False if the file doesn't exist or has another layout
+		"""
+		try:
+			self.file = open(self.filename, 'r+b' if self.is_writable else 'rb')
+		except FileNotFoundError:
+			return False
+		header = self.file.read(self.DESCRIPTION_OFFSET)
+		if len(header) == self.DESCRIPTION_OFFSET:
+			magic, version, description_size = struct.unpack_from(self.HEADER_FORMAT, header)
+		else:
+			magic, version, description_size = None, None, 0
+		stored_description = None
+		if magic == self.MAGIC and version == self.VERSION:
+			try:
+				stored_description = json.loads(self.file.read(description_size).decode('utf-8'))
+			except ValueError:
+				pass
+		if stored_description is None or (description is not None and stored_description['channels'] !=
+				description['channels']) or os.fstat(self.file.fileno()).st_size != stored_description['size']:
+			self.file.close()
+			self.file = None
+			return False
+		self.description = stored_description
+		self._map()
+		return True
+
+	def _create(self, description):
+		"""
+		Creates the new ring file
+
+		:param description: the layout description
+		"""
+		old_ring = None
+		if os.path.exists(self.filename):
+			os.replace(self.filename, self.filename + ".old")
+			try:
+				old_ring = HealthRing(self.filename + ".old")
+			except (OSError, ValueError):
+				old_ring = None
+		os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+		description_data = json.dumps(description).encode('utf-8')
+		self.file = open(self.filename, 'w+b')
+		self.file.truncate(description['size'])
+		self.file.write(struct.pack(self.HEADER_FORMAT, self.MAGIC, self.VERSION, len(description_data)))
+		self.file.seek(self.DESCRIPTION_OFFSET)
+		self.file.write(description_data)
+		self.file.flush()
+		self.description = description
+		self._map()
+		if old_ring is not None:
+			try:
+				self._copy_history(old_ring)
+			finally:
+				old_ring.close()
+
+	def _copy_history(self, old_ring):
+		"""
+		Copies the records of the channels present in both ring files, so the history is not lost when a disk or
+		a network interface is added or removed. Values of the new channels are NaN in the copied records
+
+		:param old_ring: the HealthRing instance opened for reading
+		"""
+		for level, ring in enumerate(self.rings):
+			old_columns = {name: index for index, name in enumerate(old_ring.get_columns(level))}
+			column_pairs = [(index, old_columns[name]) for index, name in enumerate(self.get_columns(level))
+				if name in old_columns]
+			records = old_ring.get_records(level)[-len(ring):]
+			if len(column_pairs) <= 1 or len(records) == 0:
+				continue
+			new_indices, old_indices = [list(indices) for indices in zip(*column_pairs)]
+			ring[:len(records)] = numpy.nan
+			ring[:len(records), new_indices] = records[:, old_indices]
+			struct.pack_into("<Q", self.buffer, self.COUNT_OFFSET + 8 * level, len(records))
+
+	def _map(self):
+		"""
+		Maps the ring file into the memory and creates the numpy views of all rings
+		"""
+		access = mmap.ACCESS_WRITE if self.is_writable else mmap.ACCESS_READ
+		self.buffer = mmap.mmap(self.file.fileno(), self.description['size'], access=access)
+		self.rings = list()
+		for level_description in self.description['levels']:
+			self.rings.append(numpy.ndarray((level_description['capacity'], len(level_description['columns'])),
+				numpy.float64, buffer=self.buffer, offset=level_description['offset']))
+
+	def _align(self, size):
+		"""
+		Rounds the size up to the whole number of memory pages
+
+		:param size: the size in bytes
+		:return: the aligned size
+		"""
+		return -(-size // mmap.PAGESIZE) * mmap.PAGESIZE
+
+
+class HealthRollup:
+	"""
+	Accumulates the minimum, the maximum and the mean of the gauges and the last value of the counters within a single
+	minute or hour
+	"""
+
+	def __init__(self, interval, gauge_number, counter_number):
+		"""
+		Initializes the rollup
+
+		:param interval: the rollup interval in seconds
+		:param gauge_number: number of gauges
+		:param counter_number: number of counters
+		"""
+		self.interval = interval
+		self.gauge_number = gauge_number
+		self.counter_number = counter_number
+		self.bucket = None
+		self._reset()
+
+	def add(self, timestamp, mins, maxs, means, lasts):
+		"""
+		Adds the sample or the finer rollup
+
+		:param timestamp: the sample time or the beginning of the finer rollup, UNIX timestamp
+		:param mins: minimum values of the gauges
+		:param maxs: maximum values of the gauges
+		:param means: mean values of the gauges
+		:param lasts: last values of the counters
+		:return: the completed rollup record as a numpy array when the timestamp belongs to the next minute or hour,
+			None otherwise
+		"""
+		bucket = math.floor(timestamp / self.interval) * self.interval
+		completed_record = None
+		if self.bucket is not None and bucket != self.bucket:
+			if self.count > 0:
+				completed_record = self.get_record()
+			self._reset()
+		self.bucket = bucket
+		self.count += 1
+		numpy.fmin(self.mins, mins, out=self.mins)
+		numpy.fmax(self.maxs, maxs, out=self.maxs)
+		is_valid = ~numpy.isnan(means)
+		self.sums[is_valid] += means[is_valid]
+		self.counts[is_valid] += 1
+		numpy.copyto(self.lasts, lasts, where=~numpy.isnan(lasts))
+		return completed_record
+
+	def get_record(self):
+		"""
+		Returns the rollup record: the beginning of the minute or the hour, the minimums, the maximums and the means of
+		the gauges and the last values of the counters
+
+		:return: the record as a numpy array
+		"""
+		with numpy.errstate(invalid='ignore', divide='ignore'):
+			means = self.sums / self.counts
+		return numpy.concatenate(([self.bucket], self.mins, self.maxs, means, self.lasts))
+
+	def _reset(self):
+		self.count = 0
+		self.mins = numpy.full(self.gauge_number, numpy.nan)
+		self.maxs = numpy.full(self.gauge_number, numpy.nan)
+		self.sums = numpy.zeros(self.gauge_number)
+		self.counts = numpy.zeros(self.gauge_number)
+		self.lasts = numpy.full(self.counter_number, numpy.nan)
+
+
+class HealthSampler:
+	"""
+	Samples the hardware health between the tests.
+
+	The following channels are sampled: the CPU core temperatures (hwmon), the number of completed reads and writes
+	and the time spent for them for each disk (/proc/diskstats) together with the number of failed I/O requests
+	(ioerr_cnt of the SCSI device), the number of corrected and uncorrected memory errors of each memory controller
+	(EDAC) and the error and drop counters of each physical network interface. Virtual interfaces (veth, bridges,
+	docker) come and go, so they are not sampled. All files are opened once and are read by pread() at each sample,
+	so a single sample costs a few system calls and takes a few hundred microseconds.
+
+	The samples are written to the HealthRing file together with the one-minute and one-hour rollups. The sampler
+	runs in a background thread within the daemon or in the foreground by the '--sample' command line option.
+	"""
+
+	DEFAULT_INTERVAL = 1
+	DISKSTATS_PATH = "/proc/diskstats"
+	BLOCK_PATH = "/sys/block"
+	EDAC_PATH = "/sys/devices/system/edac/mc"
+	NET_PATH = "/sys/class/net"
+	IGNORED_BLOCK_DEVICE_TEMPLATE = re.compile(r'^(?:loop|ram|zram|sr|fd|nbd)\d+$')
+	MEMORY_CONTROLLER_TEMPLATE = re.compile(r'^mc\d+$')
+	DISKSTATS_FIELDS = [('disk_reads', 3), ('disk_read_ms', 6), ('disk_writes', 7), ('disk_write_ms', 10)]
+	EDAC_COUNTERS = [('edac_corrected_errors', "ce_count"), ('edac_uncorrected_errors', "ue_count")]
+	NET_COUNTERS = ['rx_errors', 'tx_errors', 'rx_dropped', 'rx_crc_errors']
+	READ_SIZE = 32
+	DISKSTATS_READ_SIZE = 1 << 18
+
+	logger = logging.getLogger("django.corefacility.checker")
+
+	def __init__(self, filename, interval=None):
+		"""
+		Initializes the sampler
+
+		:param filename: the HealthRing file where the samples will be written
+		:param interval: the sampling interval in seconds. None for DEFAULT_INTERVAL
+		"""
+		self.filename = filename
+		self.interval = self.DEFAULT_INTERVAL if interval is None else interval
+		self.channels = list()
+		self.hwmon_sampler = None
+		self.core_positions = list()
+		self.diskstats_descriptor = None
+		self.disk_positions = dict()
+		self.counter_files = list()
+		self.ring = None
+		self.rollups = None
+		self.thread = None
+		self.stop_event = threading.Event()
+		self.sample_number = 0
+		self.cpu_time = 0.0
+		self.error_number = 0
+
+	def open(self):
+		"""
+		Looks for all available channels, opens them and opens the ring file
+
+		:return: number of channels found
+		"""
+		self.close()
+		self.hwmon_sampler = HwmonTemperatureSampler()
+		if self.hwmon_sampler.open() > 0:
+			for core in sorted(self.hwmon_sampler.sample().keys()):
+				self.core_positions.append((core, self._add_channel("cpu_temperature:core%d" % core, GAUGE)))
+		self._open_diskstats()
+		self._open_counters()
+		self.ring = HealthRing(self.filename, self.channels, self.interval)
+		self.gauge_indices = numpy.array([index for index, (_, kind) in enumerate(self.channels) if kind == GAUGE],
+			dtype=int)
+		self.counter_indices = numpy.array([index for index, (_, kind) in enumerate(self.channels)
+			if kind == COUNTER], dtype=int)
+		self.rollups = [HealthRollup(level_interval, len(self.gauge_indices), len(self.counter_indices))
+			for level_interval, _ in HealthRing.LEVELS[1:]]
+		self._restore_rollups()
+		return len(self.channels)
+
+	def sample(self, timestamp=None):
+		"""
+		Reads all channels and writes the sample and the completed rollups to the ring file
+
+		:param timestamp: the sample time, None for the current time
+		"""
+		timestamp = time.time() if timestamp is None else timestamp
+		values = numpy.full(len(self.channels), numpy.nan)
+		temperatures = self.hwmon_sampler.sample()
+		for core, position in self.core_positions:
+			values[position] = temperatures.get(core, numpy.nan)
+		if self.diskstats_descriptor is not None:
+			for line in os.pread(self.diskstats_descriptor, self.DISKSTATS_READ_SIZE, 0).split(b"\n"):
+				fields = line.split()
+				position = self.disk_positions.get(fields[2]) if len(fields) > 10 else None
+				if position is not None:
+					for offset, (_, field) in enumerate(self.DISKSTATS_FIELDS):
+						values[position + offset] = int(fields[field])
+		for position, descriptor in self.counter_files:
+			try:
+				values[position] = int(os.pread(descriptor, self.READ_SIZE, 0), 0)
+			except (OSError, ValueError):
+				pass
+		self.ring.append(HealthRing.RAW_LEVEL, numpy.concatenate(([timestamp], values)))
+		gauges = values[self.gauge_indices]
+		record = self.rollups[0].add(timestamp, gauges, gauges, gauges, values[self.counter_indices])
+		for level, rollup in enumerate(self.rollups, 1):
+			if record is None:
+				break
+			self.ring.append(level, record)
+			if level < len(self.rollups):
+				record = self.rollups[level].add(*self._split_record(record))
+
+	def start(self):
+		"""
+		Starts sampling in the background thread
+		"""
+		self.stop_event.clear()
+		self.thread = threading.Thread(target=self.run, name="checker-health", daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		"""
+		Stops sampling in the background thread
+		"""
+		self.stop_event.set()
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+
+	def run(self):
+		"""
+		Samples all channels at the fixed cadence until the stop() method is called. Missed samples are skipped
+		"""
+		next_time = time.monotonic()
+		while not self.stop_event.is_set():
+			start_cpu_time = time.thread_time()
+			try:
+				self.sample()
+			except Exception as error:
+				if self.error_number == 0:
+					self.logger.warning("The health sampler has failed to take a sample: %s" % error)
+				self.error_number += 1
+			self.cpu_time += time.thread_time() - start_cpu_time
+			self.sample_number += 1
+			next_time += self.interval
+			current_time = time.monotonic()
+			if next_time < current_time:
+				next_time = current_time
+			self.stop_event.wait(next_time - current_time)
+
+	@property
+	def overhead(self):
+		"""
+		The fraction of one CPU core taken by the sampler, None if no samples have been taken
+		"""
+		if self.sample_number == 0:
+			return None
+		return self.cpu_time / (self.sample_number * self.interval)
+
+	def close(self):
+		"""
+		Closes all channels and the ring file
+		"""
+		if self.hwmon_sampler is not None:
+			self.hwmon_sampler.close()
+			self.hwmon_sampler = None
+		if self.diskstats_descriptor is not None:
+			os.close(self.diskstats_descriptor)
+			self.diskstats_descriptor = None
+		for _, descriptor in self.counter_files:
+			os.close(descriptor)
+		if self.ring is not None:
+			self.ring.close()
+			self.ring = None
+		self.channels = list()
+		self.core_positions = list()
+		self.disk_positions = dict()
+		self.counter_files = list()
+
+	def _add_channel(self, name, kind):
+		"""
+		Adds the channel
+
+		:param name: the channel name: '<metric>:<object>', e.g. 'disk_reads:sda'
+		:param kind: GAUGE or COUNTER
+		:return: position of the channel in the sample
+		"""
+		self.channels.append((name, kind))
+		return len(self.channels) - 1
+
+	def _open_diskstats(self):
+		"""
+		Opens the /proc/diskstats and the ioerr_cnt files of all disks except loop devices, RAM disks and optical drives
+		"""
+		try:
+			disks = sorted(os.listdir(self.BLOCK_PATH))
+			self.diskstats_descriptor = os.open(self.DISKSTATS_PATH, os.O_RDONLY)
+		except OSError:
+			return
+		for disk in disks:
+			if self.IGNORED_BLOCK_DEVICE_TEMPLATE.match(disk) is not None:
+				continue
+			self.disk_positions[disk.encode('utf-8')] = len(self.channels)
+			for metric, _ in self.DISKSTATS_FIELDS:
+				self._add_channel("%s:%s" % (metric, disk), COUNTER)
+			self._open_counter(os.path.join(self.BLOCK_PATH, disk, "device", "ioerr_cnt"), "disk_io_errors:%s" % disk)
+
+	def _open_counters(self):
+		"""
+		Opens the EDAC counters of all memory controllers and the error counters of all physical network interfaces.
+		Virtual network interfaces and the loopback don't have the 'device' link in the sysfs
+		"""
+		try:
+			memory_controllers = sorted(os.listdir(self.EDAC_PATH))
+		except OSError:
+			memory_controllers = list()
+		for memory_controller in memory_controllers:
+			if self.MEMORY_CONTROLLER_TEMPLATE.match(memory_controller) is None:
+				continue
+			for metric, file_name in self.EDAC_COUNTERS:
+				self._open_counter(os.path.join(self.EDAC_PATH, memory_controller, file_name),
+					"%s:%s" % (metric, memory_controller))
+		try:
+			interfaces = sorted(os.listdir(self.NET_PATH))
+		except OSError:
+			interfaces = list()
+		for interface in interfaces:
+			if not os.path.exists(os.path.join(self.NET_PATH, interface, "device")):
+				continue
+			for counter in self.NET_COUNTERS:
+				self._open_counter(os.path.join(self.NET_PATH, interface, "statistics", counter),
+					"net_%s:%s" % (counter, interface))
+
+	def _open_counter(self, filename, channel_name):
+		"""
+		Opens the sysfs file containing a single integer counter
+
+		:param filename: the sysfs file
+		:param channel_name: the channel name
+		"""
+		try:
+			descriptor = os.open(filename, os.O_RDONLY)
+		except OSError:
+			return
+		self.counter_files.append((self._add_channel(channel_name, COUNTER), descriptor))
+
+	def _split_record(self, record):
+		"""
+		Splits the rollup record into the parts accepted by the HealthRollup.add method
+
+		:param record: the rollup record
+		:return: a tuple (time, minimums, maximums, means, last counter values)
+		"""
+		gauge_number = len(self.gauge_indices)
+		return (record[0], record[1:gauge_number + 1], record[gauge_number + 1:2 * gauge_number + 1],
+			record[2 * gauge_number + 1:3 * gauge_number + 1], record[3 * gauge_number + 1:])
+
+	def _restore_rollups(self):
+		"""
+		Restores the rollups of the current minute and the current hour from the records written before the sampler
+		has been restarted
+		"""
+		current_time = time.time()
+		for level, rollup in enumerate(self.rollups):
+			bucket = math.floor(current_time / rollup.interval) * rollup.interval
+			for record in self.ring.get_records(level, bucket):
+				if level == HealthRing.RAW_LEVEL:
+					gauges = record[1:][self.gauge_indices]
+					rollup.add(record[0], gauges, gauges, gauges, record[1:][self.counter_indices])
+				else:
+					rollup.add(*self._split_record(record))
+
+
+class HealthHistory:
+	"""
+	Reports the recent health history written by the HealthSampler.
+
+	The report contains the minimum, the mean and the maximum of each gauge, the increase of each counter and the mean
+	and the worst-minute latency of each disk. The one-minute rollups are used when they are available, the raw samples
+	are used otherwise.
+	"""
+
+	HISTORY_HOURS = 24
+	LATENCY_METRICS = {
+		'disk_read_latency_ms': ('disk_read_ms', 'disk_reads'),
+		'disk_write_latency_ms': ('disk_write_ms', 'disk_writes'),
+	}
+
+	def __init__(self, filename):
+		"""
+		Opens the ring file written by the HealthSampler
+
+		:param filename: the ring file
+		"""
+		self.ring = HealthRing(filename)
+
+	def report(self, metrics, objects=None, hours=None):
+		"""
+		Reports the health history
+
+		:param metrics: list of metrics to report, e.g. ['cpu_temperature'] or ['disk_read_latency_ms']
+		:param objects: list of objects to report, e.g. ['sda']. None for all objects
+		:param hours: the history depth in hours, None for HISTORY_HOURS
+		:return: the report or an empty string if there is no history for the given metrics
+		"""
+		hours = self.HISTORY_HOURS if hours is None else hours
+		since = time.time() - hours * 3600
+		level = 1
+		records = self.ring.get_records(level, since)
+		if len(records) < 2:
+			level = HealthRing.RAW_LEVEL
+			records = self.ring.get_records(level, since)
+		if len(records) == 0:
+			return ""
+		columns = {name: index for index, name in enumerate(self.ring.get_columns(level))}
+		lines = list()
+		for name, kind in self.ring.channels:
+			metric, _, health_object = name.partition(":")
+			if metric not in metrics or (objects is not None and health_object not in objects):
+				continue
+			if kind == GAUGE:
+				values = [self._get_values(records, columns, name, statistic) for statistic in ("min", "mean", "max")]
+				if numpy.all(numpy.isnan(values[1])):
+					continue
+				with numpy.errstate(invalid='ignore'):
+					lines.append("%s %s: min %1.1f, mean %1.1f, max %1.1f" % (metric, health_object,
+						numpy.nanmin(values[0]), numpy.nanmean(values[1]), numpy.nanmax(values[2])))
+			else:
+				increase = self._get_increase(self._get_values(records, columns, name))
+				if increase is not None:
+					lines.append("%s %s: +%d" % (metric, health_object, increase))
+		for metric, (time_metric, count_metric) in self.LATENCY_METRICS.items():
+			if metric not in metrics:
+				continue
+			for name, _ in self.ring.channels:
+				count_name, _, health_object = name.partition(":")
+				if count_name != count_metric or (objects is not None and health_object not in objects):
+					continue
+				latency_line = self._report_latency(records, columns, "%s:%s" % (time_metric, health_object), name)
+				if latency_line is not None:
+					lines.append("%s %s: %s" % (metric, health_object, latency_line))
+		if len(lines) == 0:
+			return ""
+		return "Health history from %s to %s (%s resolution):\n%s\n" % (
+			datetime.fromtimestamp(records[0, 0]).isoformat(sep=" ", timespec='seconds'),
+			datetime.fromtimestamp(records[-1, 0]).isoformat(sep=" ", timespec='seconds'),
+			"1 min" if level == 1 else "%s s" % self.ring.interval,
+			"\n".join(lines),
+		)
+
+	def close(self):
+		"""
+		Closes the ring file
+		"""
+		self.ring.close()
+
+	def _get_values(self, records, columns, name, statistic=None):
+		"""
+		Returns the channel values
+
+		:param records: the ring records
+		:param columns: dictionary column name => column index
+		:param name: the channel name
+		:param statistic: 'min', 'max' or 'mean' for gauges, None for counters
+		:return: the values as numpy array
+		"""
+		column = columns.get(name if statistic is None else "%s/%s" % (name, statistic), columns.get(name))
+		return records[:, column]
+
+	def _get_increase(self, values):
+		"""
+		Calculates the counter increase taking into account that the counter may be reset to zero
+
+		:param values: the counter values
+		:return: the increase or None if the counter has not been read
+		"""
+		values = values[~numpy.isnan(values)]
+		if len(values) == 0:
+			return None
+		differences = numpy.diff(values)
+		return int(numpy.sum(numpy.where(differences >= 0, differences, values[1:])))
+
+	def _report_latency(self, records, columns, time_name, count_name):
+		"""
+		Calculates the mean and the worst latency of the disk
+
+		:param records: the ring records
+		:param columns: dictionary column name => column index
+		:param time_name: the channel containing the total time of the I/O requests
+		:param count_name: the channel containing the number of the I/O requests
+		:return: the latency description or None if the disk has not been used
+		"""
+		is_valid = ~(numpy.isnan(records[:, columns[time_name]]) | numpy.isnan(records[:, columns[count_name]]))
+		request_times = numpy.diff(records[is_valid, columns[time_name]])
+		request_counts = numpy.diff(records[is_valid, columns[count_name]])
+		is_used = (request_counts > 0) & (request_times >= 0)
+		if not numpy.any(is_used):
+			return None
+		latencies = request_times[is_used] / request_counts[is_used]
+		mean_latency = numpy.sum(request_times[is_used]) / numpy.sum(request_counts[is_used])
+		return "mean %1.2f ms, worst %1.2f ms" % (mean_latency, numpy.max(latencies))
@@ -0,0 +1,92 @@
+import os
+import re
+
+
+class HwmonTemperatureSampler:
+	"""
+	Reads the CPU core temperatures directly from the hwmon sysfs interface.
+
+	The temperature sensors are looked up only once, when the sampler is opened. All sensor files are kept open during
+	the test and are read by means of pread(), so a single sample costs a few system calls and no process creation.
+	"""
+
+	HWMON_PATH = "/sys/class/hwmon"
+	SUPPORTED_DRIVERS = ['coretemp', 'k10temp', 'zenpower']
+	CORE_LABEL_TEMPLATE = re.compile(r'^(?:[Cc]ore|Tccd)\s*(\d+)$')
+	INPUT_FILE_TEMPLATE = re.compile(r'^temp(\d+)_input$')
+	READ_SIZE = 16
+
+	def __init__(self):
+		"""
+		Initializes the sampler
+		"""
+		self.sensors = list()
+
+	def open(self):
+		"""
+		Looks for all CPU core temperature sensors and opens them
+
+		:return: number of sensors found
+		"""
+		self.close()
+		try:
+			hwmon_names = sorted(os.listdir(self.HWMON_PATH))
+		except OSError:
+			return 0
+		for hwmon_name in hwmon_names:
+			hwmon_path = os.path.join(self.HWMON_PATH, hwmon_name)
+			driver_name = self._read_text(os.path.join(hwmon_path, "name"))
+			if driver_name not in self.SUPPORTED_DRIVERS:
+				continue
+			for file_name in sorted(os.listdir(hwmon_path)):
+				input_matches = self.INPUT_FILE_TEMPLATE.match(file_name)
+				if input_matches is None:
+					continue
+				label = self._read_text(os.path.join(hwmon_path, "temp%s_label" % input_matches.group(1)))
+				label_matches = None if label is None else self.CORE_LABEL_TEMPLATE.match(label)
+				if label_matches is None:
+					continue
+				try:
+					descriptor = os.open(os.path.join(hwmon_path, file_name), os.O_RDONLY)
+				except OSError:
+					continue
+				self.sensors.append((int(label_matches.group(1)), descriptor))
+		return len(self.sensors)
+
+	def sample(self):
+		"""
+		Reads all opened sensors
+
+		:return: a dictionary core number => temperature in degrees Celsius. When several CPU packages have a core with
+			the same number, the maximum temperature is given
+		"""
+		temperatures = dict()
+		for core_number, descriptor in self.sensors:
+			try:
+				temperature = int(os.pread(descriptor, self.READ_SIZE, 0)) / 1000
+			except (OSError, ValueError):
+				continue
+			if core_number not in temperatures or temperatures[core_number] < temperature:
+				temperatures[core_number] = temperature
+		return temperatures
+
+	def close(self):
+		"""
+		Closes all opened sensors
+		"""
+		for _, descriptor in self.sensors:
+			os.close(descriptor)
+		self.sensors = list()
+
+	def _read_text(self, filename):
+		"""
+		Reads a short sysfs text file
+
+		:param filename: full name of the file
+		:return: the file content without leading and trailing whitespaces or None if the file can't be read
+		"""
+		try:
+			with open(filename, 'r') as sysfs_file:
+				return sysfs_file.read().strip()
+		except OSError:
+			return None
@@ -0,0 +1,196 @@
+import os
+import signal
+import time
+import pickle
+import logging
+import resource
+import threading
+import multiprocessing
+
+from .outbox import Outbox
+from .checker_test import CheckerTest
+from .mail_handler import MailHandler
+from .exceptions import TestFailedError
+
+
+class PipeHandler(logging.Handler):
+	"""
+	Sends all log records from the worker process to the parent process through the pipe.
+	"""
+
+	def __init__(self, connection):
+		"""
+		Initializes the handler
+
+		:param connection: the sending end of the pipe
+		"""
+		super().__init__()
+		self.connection = connection
+
+	def emit(self, record):
+		"""
+		Sends the record to the parent process
+
+		:param record: the LogRecord to send
+		"""
+		try:
+			record.msg = record.getMessage()
+			record.args = None
+			record.exc_info = None
+			record.exc_text = None
+			self.connection.send(('log', record))
+		except Exception:
+			self.handleError(record)
+
+
+class IsolatedRunner:
+	"""
+	Runs a single tester in a separate worker process.
+
+	The worker process becomes a leader of its own process group, so all external programs launched by the tester
+	(smartctl, dd, memtester etc.) will be killed together with the worker when the time limit is exceeded.
+	The address space of the worker process is limited by the RLIMIT_AS. All log records and the test result are
+	streamed back to the parent process through the pipe.
+	"""
+
+	POLL_INTERVAL = 1.0
+
+	logger = logging.getLogger("django.corefacility.checker")
+
+	def __init__(self, time_limit=None, memory_limit=None, start_method=None):
+		"""
+		Initializes the runner
+
+		:param time_limit: maximum wall-clock time of the test in seconds, None for no limit
+		:param memory_limit: maximum size of the address space of the worker process, either in bytes or as a string
+			like '4G'. None for no limit
+		:param start_method: 'fork', 'forkserver' or 'spawn'. Refer to the multiprocessing documentation for details.
+			None to fork the worker when the checker process has a single thread and to use 'forkserver' otherwise
+			(e.g., when the tests are run by the TestScheduler or by the daemon): a child forked from a multithreaded
+			process may deadlock on a lock held by another thread at the moment of fork, like the lock of a logging
+			handler
+		"""
+		self.time_limit = time_limit
+		self.memory_limit = None if memory_limit is None else CheckerTest.parse_size(memory_limit)
+		if start_method is None:
+			start_method = 'fork' if threading.active_count() == 1 else 'forkserver'
+		self.context = multiprocessing.get_context(start_method)
+
+	def run(self, tester, test_config):
+		"""
+		Runs the tester in the worker process and waits until it finishes
+
+		:param tester: the CheckerTest subclass
+		:param test_config: the keyword arguments for the tester's run method
+		:return: the value returned by the tester's run method
+		"""
+		receiver, sender = self.context.Pipe(duplex=False)
+		spool_folder = None if MailHandler.outbox is None else MailHandler.outbox.spool_folder
+		process = self.context.Process(
+			target=_worker_main,
+			args=(sender, tester, test_config, self.memory_limit, CheckerTest.posix_log, CheckerTest.mail_options,
+				CheckerTest.health_file, MailHandler.mail_options, spool_folder),
+			name="checker-%s" % tester.__name__,
+		)
+		process.start()
+		sender.close()
+		deadline = None if self.time_limit is None else time.monotonic() + self.time_limit
+		outcome = None
+		try:
+			while True:
+				wait_time = self.POLL_INTERVAL
+				if deadline is not None:
+					wait_time = min(wait_time, deadline - time.monotonic())
+					if wait_time <= 0:
+						self._kill(process)
+						raise TestFailedError("The test has been killed because it exceeded the time limit of %d s" %
+							self.time_limit)
+				if not receiver.poll(wait_time):
+					continue
+				try:
+					message_type, payload = receiver.recv()
+				except EOFError:
+					break
+				if message_type == 'log':
+					self.logger.handle(payload)
+				else:
+					outcome = (message_type, payload)
+		except BaseException:
+			self._kill(process)
+			raise
+		finally:
+			receiver.close()
+			process.join()
+		if outcome is None:
+			raise TestFailedError("The worker process has been terminated unexpectedly with exit code %s" %
+				process.exitcode)
+		message_type, payload = outcome
+		if message_type == 'error':
+			raise payload
+		return payload
+
+	def _kill(self, process):
+		"""
+		Kills the worker process and all processes it started
+
+		:param process: the multiprocessing.Process instance
+		"""
+		try:
+			os.killpg(process.pid, signal.SIGKILL)
+		except ProcessLookupError:
+			pass
+		except PermissionError:
+			process.kill()
+
+
+def _worker_main(sender, tester, test_config, memory_limit, posix_log, mail_options, health_file=None,
+		handler_mail_options=None, spool_folder=None):
+	"""
+	The main routine of the worker process
+
+	A worker started by 'forkserver' or 'spawn' doesn't inherit the class attributes set by the checker from the
+	configuration file, so they are restored here. The outbox of the worker is not started: the mails sent by the
+	tester are only put into the spool folder and are delivered by the sender thread of the checker process.
+
+	:param sender: the sending end of the pipe
+	:param tester: the CheckerTest subclass
+	:param test_config: the keyword arguments for the tester's run method
+	:param memory_limit: maximum size of the address space in bytes, None for no limit
+	:param posix_log: the posix_log property of the configuration file
+	:param mail_options: the mailing section of the configuration file
+	:param health_file: the ring file of the health sampler
+	:param handler_mail_options: mailing options of the MailHandler
+	:param spool_folder: the spool folder of the checker outbox, None if the outbox is not opened
+	"""
+	os.setsid()
+	if memory_limit is not None:
+		resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+	CheckerTest.posix_log = posix_log
+	CheckerTest.mail_options = mail_options
+	CheckerTest.health_file = health_file
+	MailHandler.mail_options = handler_mail_options
+	MailHandler.outbox = None
+	if spool_folder is not None:
+		MailHandler.outbox = Outbox(spool_folder, MailHandler._connect, MailHandler._send_data)
+	logger = logging.getLogger("django.corefacility.checker")
+	for handler in list(logger.handlers):
+		logger.removeHandler(handler)
+	logger.addHandler(PipeHandler(sender))
+	logger.setLevel(logging.DEBUG)
+	logger.propagate = False
+	try:
+		outcome = ('result', tester.run(**test_config))
+	except MemoryError:
+		outcome = ('error', TestFailedError("The worker process has run out of memory. The memory limit is %s bytes" %
+			memory_limit))
+	except BaseException as error:
+		outcome = ('error', error)
+	try:
+		pickle.dumps(outcome)
+	except Exception:
+		if outcome[0] == 'error':
+			outcome = ('error', TestFailedError(str(outcome[1])))
+		else:
+			outcome = ('result', None)
+	sender.send(outcome)
+	sender.close()
@@ -0,0 +1,142 @@
+import os
+import errno
+import select
+import subprocess
+import threading
+
+
+class KernelLogWatcher(threading.Thread):
+	"""
+	Watches the kernel messages in a background thread while the test is running.
+
+	The watcher tails /dev/kmsg or, when /dev/kmsg is not accessible, the kernel part of the systemd journal. Each new
+	kernel message is passed to the matcher function. When the number of matching messages reaches the threshold
+	the abort event is set, so the test may stop stressing the hardware that is already failing.
+	"""
+
+	KMSG_PATH = "/dev/kmsg"
+	JOURNAL_COMMAND = ("journalctl", "--dmesg", "--follow", "--lines=0", "--output=cat")
+	POLL_INTERVAL = 0.5
+	MAX_RECORD_SIZE = 8192
+
+	def __init__(self, matcher, error_threshold=1):
+		"""
+		Initializes the watcher
+
+		:param matcher: a function that accepts the kernel message text and returns True if the message is an error
+		:param error_threshold: number of error messages that cause the abort event to be set
+		"""
+		super().__init__(daemon=True, name="kernel-log-watcher")
+		self.matcher = matcher
+		self.error_threshold = error_threshold
+		self.error_records = list()
+		self.abort_event = threading.Event()
+		self.source = None
+		self._stop_event = threading.Event()
+		self._ready_event = threading.Event()
+
+	@property
+	def is_aborted(self):
+		"""
+		True if the number of error messages has reached the threshold
+		"""
+		return self.abort_event.is_set()
+
+	def start(self):
+		"""
+		Starts the watcher and waits until it begins to follow the kernel messages, so no message written after this
+		method returns will be missed
+		"""
+		super().start()
+		self._ready_event.wait()
+
+	def stop(self):
+		"""
+		Stops the watcher and waits until its thread finishes
+		"""
+		self._stop_event.set()
+		self.join()
+
+	def run(self):
+		"""
+		Method representing the thread's activity.
+		"""
+		try:
+			descriptor = os.open(self.KMSG_PATH, os.O_RDONLY | os.O_NONBLOCK)
+		except OSError:
+			descriptor = None
+		try:
+			if descriptor is not None:
+				self.source = self.KMSG_PATH
+				self._follow_kmsg(descriptor)
+			else:
+				self._follow_journal()
+		finally:
+			self._ready_event.set()
+			if descriptor is not None:
+				os.close(descriptor)
+
+	def _follow_kmsg(self, descriptor):
+		"""
+		Follows the /dev/kmsg device. Each read() from the device returns exactly one kernel record
+
+		:param descriptor: the opened file descriptor
+		"""
+		os.lseek(descriptor, 0, os.SEEK_END)
+		self._ready_event.set()
+		while not self._stop_event.is_set():
+			readable, _, _ = select.select([descriptor], [], [], self.POLL_INTERVAL)
+			if len(readable) == 0:
+				continue
+			while True:
+				try:
+					record = os.read(descriptor, self.MAX_RECORD_SIZE)
+				except OSError as error:
+					if error.errno == errno.EPIPE:
+						continue
+					if error.errno == errno.EAGAIN:
+						break
+					raise
+				if len(record) == 0:
+					break
+				header, _, message = record.decode('utf-8', errors='replace').partition(';')
+				self._process_message(message.split('\n', 1)[0])
+
+	def _follow_journal(self):
+		"""
+		Follows the kernel messages in the systemd journal
+		"""
+		try:
+			process = subprocess.Popen(self.JOURNAL_COMMAND, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+		except OSError:
+			self._ready_event.set()
+			return
+		self.source = "journal"
+		self._ready_event.set()
+		try:
+			buffer = b""
+			while not self._stop_event.is_set():
+				readable, _, _ = select.select([process.stdout], [], [], self.POLL_INTERVAL)
+				if len(readable) == 0:
+					continue
+				chunk = os.read(process.stdout.fileno(), self.MAX_RECORD_SIZE)
+				if len(chunk) == 0:
+					break
+				*messages, buffer = (buffer + chunk).split(b'\n')
+				for message in messages:
+					self._process_message(message.decode('utf-8', errors='replace'))
+		finally:
+			process.terminate()
+			process.wait()
+
+	def _process_message(self, message):
+		"""
+		Checks a single kernel message
+
+		:param message: the message text
+		"""
+		if not self.matcher(message):
+			return
+		self.error_records.append(message)
+		if len(self.error_records) >= self.error_threshold:
+			self.abort_event.set()
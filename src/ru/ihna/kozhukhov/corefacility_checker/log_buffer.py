@@ -0,0 +1,139 @@
+import os
+import gzip
+import tempfile
+import threading
+
+
+class LogBuffer:
+	"""
+	Keeps the formatted log records that will be mailed to the administrator.
+
+	Consecutive records with the same message are collapsed into a single entry with the repetition count. When the
+	buffer size exceeds max_size bytes, the whole log is spilled to the compressed file that will be attached to the
+	mail. After that, each new record is written to this file in full while the buffer keeps only its first line
+	truncated to SUMMARY_LINE_LENGTH characters, and only while such lines don't exceed max_size bytes more. Important
+	records (errors, warnings and test summaries) have their own budget of max_size bytes, so they are kept even when
+	a chatty test exhausted the budget for other records. So, the memory consumption is bounded by approximately
+	3 * max_size bytes regardless of how many records were emitted.
+	"""
+
+	SUMMARY_LINE_LENGTH = 200
+	SPILL_FILE_SUFFIX = ".log.gz"
+
+	def __init__(self, max_size=65536, spill_folder=None):
+		"""
+		Initializes the buffer
+
+		:param max_size: the buffer size in bytes when the log will be spilled to the file
+		:param spill_folder: the folder where the spill file will be created. None for the default temporary folder
+		"""
+		self.max_size = max_size
+		self.spill_folder = spill_folder
+		self.lock = threading.Lock()
+		self._reset()
+
+	def __len__(self):
+		"""
+		Number of records appended since the last take() call
+		"""
+		return self.record_number
+
+	def append(self, text, key=None, is_important=False):
+		"""
+		Appends the formatted record
+
+		:param text: the formatted record
+		:param key: a value that identifies the record regardless of its timestamp, e.g., the unformatted message.
+			Consecutive records with the same key are collapsed. None to use the text itself
+		:param is_important: True if the record shall be kept in the buffer even when the budget for other records
+			has been exhausted
+		"""
+		if key is None:
+			key = text
+		with self.lock:
+			self.record_number += 1
+			if len(self.entries) > 0 and self.last_key == key:
+				self.entries[-1][1] += 1
+				if self.spill_file is not None:
+					self.spill_repetitions += 1
+				return
+			self._flush_repetitions()
+			self.last_key = key
+			if self.spill_file is None and self.size + len(text) > self.max_size:
+				self._open_spill_file()
+			if self.spill_file is None:
+				self.entries.append([text, 1])
+				self.size += len(text)
+				return
+			self.spill_file.write(text.encode('utf-8') + b"\n")
+			summary_line = text.split("\n", 1)[0][:self.SUMMARY_LINE_LENGTH]
+			summary_size = self.important_size if is_important else self.summary_size
+			if summary_size + len(summary_line) > self.max_size:
+				self.omitted_number += 1
+				self.last_key = None
+				return
+			if summary_line != text:
+				summary_line += " [...]"
+			self.entries.append([summary_line, 1])
+			if is_important:
+				self.important_size += len(summary_line)
+			else:
+				self.summary_size += len(summary_line)
+
+	def take(self):
+		"""
+		Returns all buffered records and makes the buffer empty
+
+		:return: a tuple (text, spill file). The spill file is None if the log has not been spilled. Otherwise, the
+			caller is responsible for removing the spill file
+		"""
+		with self.lock:
+			self._flush_repetitions()
+			lines = [text if count == 1 else "%s\n(repeated %d times)" % (text, count) for text, count in self.entries]
+			if self.omitted_number > 0:
+				lines.append("%d records are omitted" % self.omitted_number)
+			spill_filename = None
+			if self.spill_file is not None:
+				self.spill_file.close()
+				self.raw_spill_file.close()
+				spill_filename = self.spill_filename
+				lines.append("The full log is attached: %s" % os.path.basename(spill_filename))
+			self._reset()
+		return "\n".join(lines), spill_filename
+
+	def _reset(self):
+		"""
+		Makes the buffer empty
+		"""
+		self.entries = list()
+		self.size = 0
+		self.summary_size = 0
+		self.important_size = 0
+		self.record_number = 0
+		self.omitted_number = 0
+		self.last_key = None
+		self.spill_file = None
+		self.raw_spill_file = None
+		self.spill_filename = None
+		self.spill_repetitions = 0
+
+	def _open_spill_file(self):
+		"""
+		Creates the spill file and writes all buffered records to it. The buffered records remain in the buffer
+		"""
+		descriptor, self.spill_filename = tempfile.mkstemp(suffix=self.SPILL_FILE_SUFFIX, prefix="corefacility-log-",
+			dir=self.spill_folder)
+		self.raw_spill_file = os.fdopen(descriptor, 'wb')
+		self.spill_file = gzip.GzipFile(fileobj=self.raw_spill_file, mode='wb')
+		for text, count in self.entries:
+			self.spill_file.write(text.encode('utf-8') + b"\n")
+			if count > 1:
+				self.spill_file.write(b"(repeated %d times)\n" % count)
+
+	def _flush_repetitions(self):
+		"""
+		Writes the repetition count of the last spilled record to the spill file
+		"""
+		if self.spill_repetitions > 0:
+			self.spill_file.write(b"(repeated %d times)\n" % (self.spill_repetitions + 1))
+			self.spill_repetitions = 0
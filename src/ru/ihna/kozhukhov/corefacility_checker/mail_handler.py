@@ -1,16 +1,30 @@
+import os
+import re
+import uuid
+import base64
+import socket
 import logging
-import subprocess
 import smtplib, ssl
 from email.message import EmailMessage
+from email.policy import SMTP
+from email.utils import formatdate, make_msgid
+
+from .outbox import Outbox
+from .log_buffer import LogBuffer
 
 
 class MailHandler(logging.Handler):
 	"""
 	Sends all logs to the mail.
+
+	The records are kept in bounded buffers: repeated messages are collapsed and a chatty test can't make the mail
+	much larger than max_log_size bytes. When this limit is exceeded, the full log is attached to the mail as the
+	compressed file. Warnings, errors and records logged with extra={'summary': True} are kept in the mail body
+	preferentially.
 	"""
 
-	error_list = list()
-	message_list = list()
+	error_list = LogBuffer()
+	message_list = LogBuffer()
 
 	error_subject = "[corefacility-checker] Error occured during one of the tests"
 	error_template = \
@@ -26,6 +40,28 @@ class MailHandler(logging.Handler):
 		"Please, find the detailed information below.\n\n{messages}\n\nSincerely yours,\ncorefacility"
 
 	mail_options = None
+	outbox = None
+
+	DEFAULT_OUTBOX_TIMEOUT = 300
+	ATTACHMENT_CHUNK_SIZE = 57 * 1024
+	LEADING_PERIOD_TEMPLATE = re.compile(rb'(?m)^\.')
+
+	def __init__(self, level=logging.NOTSET, max_log_size=None, spill_folder=None):
+		"""
+		Initializes the handler. All instances share the same record buffers
+
+		:param level: the handler level
+		:param max_log_size: maximum size of the log included into the mail body, in bytes. None to keep the default
+			value
+		:param spill_folder: the folder where the full log is saved when the max_log_size is exceeded. None for the
+			default temporary folder
+		"""
+		super().__init__(level)
+		for log_buffer in (self.message_list, self.error_list):
+			if max_log_size is not None:
+				log_buffer.max_size = max_log_size
+			if spill_folder is not None:
+				log_buffer.spill_folder = spill_folder
 
 	@classmethod
 	def mail_records(cls, record_type):
@@ -46,31 +82,118 @@ class MailHandler(logging.Handler):
 			raise ValueError("MailHandler.mail_records: Bad record_type")
 		if len(message_list) == 0:
 			return
+		messages, spill_filename = message_list.take()
 		message_text = template.format(
-			server_name=subprocess.run('hostname', stdout=subprocess.PIPE).stdout.decode('utf-8').replace('\n', ''),
-			messages="\r\n".join(message_list)
+			server_name=socket.gethostname(),
+			messages=messages,
 		)
-		message_list.clear()
 		message_text = message_text.replace("\n", "\r\n")
 
-		message = EmailMessage()
-		message.set_content(message_text)
-		message['From'] = cls.mail_options['sender']
-		message['To'] = cls.mail_options['recipient']
-		message['Subject'] = subject
-		if '_debug' in cls.mail_options and cls.mail_options['_debug']:
-			print("The notification mail will not be sent because mail delivery is in debug mode")
-		else:
-			cls.send_mail(message)
+		try:
+			if '_debug' in cls.mail_options and cls.mail_options['_debug']:
+				print("The notification mail will not be sent because mail delivery is in debug mode")
+			elif spill_filename is not None:
+				cls.send_file(subject, message_text, spill_filename)
+			else:
+				message = EmailMessage()
+				message.set_content(message_text)
+				message['From'] = cls.mail_options['sender']
+				message['To'] = cls.mail_options['recipient']
+				message['Subject'] = subject
+				cls.send_mail(message)
+		finally:
+			if spill_filename is not None:
+				os.unlink(spill_filename)
+
+
+	@classmethod
+	def open_outbox(cls):
+		"""
+		Starts the background mail delivery if the 'outbox' mail option is set. Mails that were not delivered during
+		the previous run are delivered first
+		"""
+		spool_folder = cls.mail_options.get('outbox')
+		if spool_folder is None or cls.outbox is not None:
+			return
+		cls.outbox = Outbox(spool_folder, cls._connect, cls._send_data)
+		cls.outbox.start()
+
+
+	@classmethod
+	def close_outbox(cls):
+		"""
+		Waits until all queued mails will be delivered, but not longer than the 'outbox_timeout' mail option, and stops
+		the background mail delivery. Undelivered mails remain in the outbox until the next run
+		"""
+		if cls.outbox is None:
+			return
+		undelivered_mails = cls.outbox.stop(cls.mail_options.get('outbox_timeout', cls.DEFAULT_OUTBOX_TIMEOUT))
+		cls.outbox = None
+		if undelivered_mails > 0:
+			print("WARNING: %d mails have not been delivered and will be sent during the next run" % undelivered_mails)
 
 
 	@classmethod
 	def send_mail(cls, message):
 		"""
-		Sends the E-mail
+		Sends the E-mail. When the outbox is opened, the mail is put into the outbox and is delivered in background
 
 		:param message: an instance of EmailMessage
 		"""
+		if cls.outbox is not None:
+			cls.outbox.put([message.as_bytes(policy=SMTP)])
+			return
+		mail_server = cls._connect()
+		mail_server.send_message(message)
+		mail_server.quit()
+
+
+	@classmethod
+	def send_file(cls, subject, text, filename, parts=None):
+		"""
+		Sends the file as the mail attachment.
+
+		The file is never loaded into memory at whole: it is read by ATTACHMENT_CHUNK_SIZE bytes, each chunk is base64
+		encoded and is immediately sent to the SMTP server within the DATA command. So, the memory consumption doesn't
+		depend on the file size.
+
+		:param subject: the mail subject
+		:param text: the mail text
+		:param filename: full name of the file to attach
+		:param parts: None to send the whole file in a single mail, or list of tuples (offset, size). In the latter
+			case each part is sent in a separate mail through the same SMTP connection. The attachments are named
+			<file name>.001, <file name>.002 etc. and the whole file can be restored by concatenation of all parts
+
+		When the outbox is opened, the mails are written to the outbox chunk by chunk and are delivered in background
+		"""
+		file_size = os.stat(filename).st_size
+		attachment_name = os.path.basename(filename)
+		if parts is None:
+			mails = [(subject, attachment_name, 0, file_size)]
+		else:
+			mails = [("%s (part %d of %d)" % (subject, index + 1, len(parts)),
+				"%s.%03d" % (attachment_name, index + 1), offset, size) for index, (offset, size) in enumerate(parts)]
+		if cls.outbox is not None:
+			for mail_subject, mail_attachment_name, offset, size in mails:
+				cls.outbox.put(cls._generate_file_message(
+					mail_subject, text, filename, mail_attachment_name, offset, size))
+			return
+		mail_server = cls._connect()
+		try:
+			for mail_subject, mail_attachment_name, offset, size in mails:
+				cls._send_data(mail_server, cls._generate_file_message(
+					mail_subject, text, filename, mail_attachment_name, offset, size))
+		finally:
+			mail_server.quit()
+
+
+	@classmethod
+	def _connect(cls):
+		"""
+		Connects to the SMTP server given in the mail options and logs in
+
+		:return: an instance of smtplib.SMTP
+		"""
 		context = ssl.create_default_context()
 		if cls.mail_options['use_ssl'] and cls.mail_options['use_tls']:
 			raise ValueError("You can use either SSL or TLS")
@@ -81,12 +204,92 @@ class MailHandler(logging.Handler):
 		if cls.mail_options['use_tls']:
 			mail_server.starttls(context=context)
 		auth_result = mail_server.login(cls.mail_options['login'], cls.mail_options['password'])
-		mail_server.send_message(message)
-		mail_server.quit()
+		return mail_server
+
+
+	@classmethod
+	def _send_data(cls, mail_server, message_chunks):
+		"""
+		Sends a single mail, passing the message to the SMTP server chunk by chunk
+
+		:param mail_server: an instance of smtplib.SMTP
+		:param message_chunks: an iterable of message chunks. Each chunk must consist of complete CRLF-terminated lines
+		"""
+		mail_server.ehlo_or_helo_if_needed()
+		code, response = mail_server.mail(cls.mail_options['sender'])
+		if code != 250:
+			raise smtplib.SMTPSenderRefused(code, response, cls.mail_options['sender'])
+		code, response = mail_server.rcpt(cls.mail_options['recipient'])
+		if code not in (250, 251):
+			raise smtplib.SMTPRecipientsRefused({cls.mail_options['recipient']: (code, response)})
+		mail_server.putcmd("data")
+		code, response = mail_server.getreply()
+		if code != 354:
+			raise smtplib.SMTPDataError(code, response)
+		for chunk in message_chunks:
+			mail_server.send(cls.LEADING_PERIOD_TEMPLATE.sub(b'..', chunk))
+		mail_server.send(b".\r\n")
+		code, response = mail_server.getreply()
+		if code != 250:
+			raise smtplib.SMTPDataError(code, response)
+
+
+	@classmethod
+	def _generate_file_message(cls, subject, text, filename, attachment_name, offset, size):
+		"""
+		Generates the multipart MIME message with a single attachment
+
+		:param subject: the mail subject
+		:param text: the mail text
+		:param filename: the file to attach
+		:param attachment_name: the attachment name as seen by the recipient
+		:param offset: position of the first byte of the file to attach
+		:param size: number of bytes to attach
+		:return: generator of message chunks. Each chunk consists of complete CRLF-terminated lines
+		"""
+		boundary = "===============%s==" % uuid.uuid4().hex
+		header_lines = [
+			"From: %s" % cls.mail_options['sender'],
+			"To: %s" % cls.mail_options['recipient'],
+			"Subject: %s" % subject,
+			"Date: %s" % formatdate(localtime=True),
+			"Message-ID: %s" % make_msgid(),
+			"MIME-Version: 1.0",
+			'Content-Type: multipart/mixed; boundary="%s"' % boundary,
+			"",
+			"--%s" % boundary,
+			'Content-Type: text/plain; charset="utf-8"',
+			"Content-Transfer-Encoding: base64",
+			"",
+		]
+		yield ("\r\n".join(header_lines) + "\r\n").encode("utf-8")
+		yield base64.encodebytes(text.replace("\r\n", "\n").replace("\n", "\r\n").encode("utf-8")) \
+			.replace(b"\n", b"\r\n")
+		attachment_lines = [
+			"--%s" % boundary,
+			'Content-Type: application/octet-stream; name="%s"' % attachment_name,
+			"Content-Transfer-Encoding: base64",
+			'Content-Disposition: attachment; filename="%s"' % attachment_name,
+			"",
+		]
+		yield ("\r\n".join(attachment_lines) + "\r\n").encode("utf-8")
+		with open(filename, 'rb') as attached_file:
+			attached_file.seek(offset)
+			remaining_size = size
+			while remaining_size > 0:
+				chunk = attached_file.read(min(cls.ATTACHMENT_CHUNK_SIZE, remaining_size))
+				if len(chunk) == 0:
+					break
+				remaining_size -= len(chunk)
+				yield base64.encodebytes(chunk).replace(b"\n", b"\r\n")
+		yield ("--%s--\r\n" % boundary).encode("utf-8")
 
 
 	def emit(self, record):
+		text = self.format(record)
+		key = (record.levelno, record.getMessage())
+		is_important = record.levelno >= logging.WARNING or getattr(record, 'summary', False)
 		if self.message_list is not None:
-			self.message_list.append(self.format(record))
+			self.message_list.append(text, key, is_important)
 		if self.error_list is not None and record.levelno >= logging.ERROR:
-			self.error_list.append(self.format(record))
+			self.error_list.append(text, key, is_important)
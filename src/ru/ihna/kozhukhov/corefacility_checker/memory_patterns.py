@@ -0,0 +1,302 @@
+import os
+import mmap
+import time
+import ctypes
+import queue
+import multiprocessing
+import numpy
+
+
+class MemoryPatternEngine:
+	"""
+	Tests the operating memory by writing and verifying the test patterns without external utilities.
+
+	The tested memory is split between several worker processes, one worker per CPU. Each worker is pinned to its own
+	CPU and allocates its own buffer by the anonymous mmap(). The buffer is advised to be backed by transparent huge
+	pages and is locked in RAM by mlock(), so it is never swapped out. Since the buffer is first touched by the pinned
+	worker, the kernel allocates it on the NUMA node of the worker's CPU.
+
+	Each pass writes the pattern into the whole buffer and then reads the whole buffer back and compares it with the
+	pattern. Both operations are vectorized by numpy and are made by chunks of CHUNK_SIZE bytes, so the buffer is much
+	larger than the CPU cache and the pattern really goes through the memory bus. The supported passes are:
+	'walking_ones' - 64 patterns, each contains a single bit set;
+	'walking_zeros' - 64 patterns, each contains a single bit reset;
+	'checkerboard' - alternating 0x55... and 0xAA... words, then the inverted ones;
+	'random' - pseudo-random words regenerated from the known seed during the verification;
+	'address' - each word contains its own offset within the buffer.
+	"""
+
+	SUPPORTED_PASSES = ['walking_ones', 'walking_zeros', 'checkerboard', 'random', 'address']
+	START_METHOD = 'spawn'
+	MAX_REPORTED_ERRORS = 32
+	CHUNK_SIZE = 4194304
+	RESULT_POLL_INTERVAL = 1
+
+	def __init__(self, sizes, cpus, passes=None):
+		"""
+		Initializes the engine
+
+		:param sizes: list of buffer sizes in bytes, one size per worker
+		:param cpus: list of logical CPUs to pin the workers to, one CPU per worker
+		:param passes: list of passes to run, None for all SUPPORTED_PASSES
+		"""
+		if passes is None:
+			passes = self.SUPPORTED_PASSES
+		for pass_name in passes:
+			if pass_name not in self.SUPPORTED_PASSES:
+				raise ValueError("The 'passes' configuration parameter must contain only the following items: %s" %
+					", ".join(self.SUPPORTED_PASSES))
+		self.sizes = sizes
+		self.cpus = cpus
+		self.passes = list(passes)
+		self.context = multiprocessing.get_context(self.START_METHOD)
+		self.stop_event = self.context.Event()
+		self.result_queue = self.context.Queue()
+		self.processes = list()
+		self.results = dict()
+
+	def run(self, timeout=None):
+		"""
+		Runs all workers and waits until they finish. When any worker finds a mismatch, all other workers are stopped
+
+		:param timeout: maximum running time in seconds, None for no limit
+		:return: True if all workers completed all passes, False if the test has been stopped because of the timeout
+		"""
+		deadline = None if timeout is None else time.monotonic() + timeout
+		try:
+			for index, (size, cpu) in enumerate(zip(self.sizes, self.cpus)):
+				process = self.context.Process(
+					target=_pattern_worker,
+					args=(index, cpu, size, self.passes, self.stop_event, self.result_queue,
+						self.MAX_REPORTED_ERRORS, self.CHUNK_SIZE),
+					name="memory-pattern-%d" % index,
+					daemon=True,
+				)
+				process.start()
+				self.processes.append(process)
+			while len(self.results) < len(self.processes):
+				if deadline is not None and time.monotonic() >= deadline:
+					self.stop_event.set()
+					return False
+				try:
+					result = self.result_queue.get(timeout=self.RESULT_POLL_INTERVAL)
+				except queue.Empty:
+					self._check_processes()
+					continue
+				self.results[result['index']] = result
+				if result['error_count'] > 0 or result['error_message'] is not None:
+					self.stop_event.set()
+			return True
+		finally:
+			self.stop_event.set()
+			for process in self.processes:
+				process.join()
+			self.processes = list()
+
+	@property
+	def is_failed(self):
+		"""
+		True if any worker found a mismatch or failed to allocate its buffer
+		"""
+		return any([result['error_count'] > 0 or result['error_message'] is not None
+			for result in self.results.values()])
+
+	def report(self):
+		"""
+		Builds the test report
+
+		:return: the report as a string
+		"""
+		report_lines = list()
+		for index, (size, cpu) in enumerate(zip(self.sizes, self.cpus)):
+			worker_name = "pattern worker #%d (%d MB, CPU %d)" % (index, size >> 20, cpu)
+			if index not in self.results:
+				report_lines.append("%s: terminated" % worker_name)
+				continue
+			result = self.results[index]
+			if result['error_message'] is not None:
+				report_lines.append("%s: %s" % (worker_name, result['error_message']))
+				continue
+			features = [feature for feature, is_enabled in (("mlocked", result['is_locked']),
+				("huge pages", result['is_huge'])) if is_enabled]
+			report_lines.append("%s%s: %s, %d passes, write %1.2f GB/s, verify %1.2f GB/s" % (
+				worker_name,
+				"" if len(features) == 0 else " [%s]" % ", ".join(features),
+				"FAILED with %d errors" % result['error_count'] if result['error_count'] > 0 else
+					"stopped" if result['is_stopped'] else "passed",
+				result['pass_number'],
+				result['write_bandwidth'] * 1e-9,
+				result['verify_bandwidth'] * 1e-9,
+			))
+			for pass_name, offset, expected, actual in result['errors']:
+				report_lines.append("\t%s at offset 0x%x: expected 0x%016x, got 0x%016x" %
+					(pass_name, offset, expected, actual))
+		return "\n".join(report_lines)
+
+	def _check_processes(self):
+		"""
+		Puts the error result for each worker that died without reporting its result
+		"""
+		for index, process in enumerate(self.processes):
+			if index not in self.results and process.exitcode is not None:
+				process.join()
+				if index not in self.results and self.result_queue.empty():
+					self.results[index] = _create_result(index)
+					self.results[index]['error_message'] = "the worker died with exit code %d" % process.exitcode
+
+
+def _create_result(index):
+	"""
+	Creates an empty worker result
+
+	:param index: the worker index
+	:return: the result dictionary
+	"""
+	return {
+		'index': index,
+		'error_count': 0,
+		'errors': list(),
+		'error_message': None,
+		'is_locked': False,
+		'is_huge': False,
+		'is_stopped': False,
+		'pass_number': 0,
+		'write_bandwidth': 0.0,
+		'verify_bandwidth': 0.0,
+	}
+
+
+def _pattern_worker(index, cpu, size, passes, stop_event, result_queue, max_reported_errors, chunk_size):
+	"""
+	The main routine of the worker process
+
+	:param index: the worker index
+	:param cpu: the logical CPU to pin the worker to
+	:param size: the buffer size in bytes
+	:param passes: list of passes to run
+	:param stop_event: the event that stops the worker
+	:param result_queue: the queue where the worker result will be put
+	:param max_reported_errors: maximum number of mismatches that will be reported in details
+	:param chunk_size: number of bytes written or verified by a single vector operation
+	"""
+	result = _create_result(index)
+	try:
+		os.sched_setaffinity(0, {cpu})
+		_run_passes(result, size, passes, stop_event, max_reported_errors, chunk_size)
+	except Exception as error:
+		result['error_message'] = "%s: %s" % (error.__class__.__name__, error)
+	result_queue.put(result)
+
+
+def _run_passes(result, size, passes, stop_event, max_reported_errors, chunk_size):
+	"""
+	Allocates the buffer and runs all passes
+
+	:param result: the result dictionary to fill in
+	:param size: the buffer size in bytes
+	:param passes: list of passes to run
+	:param stop_event: the event that stops the worker
+	:param max_reported_errors: maximum number of mismatches that will be reported in details
+	:param chunk_size: number of bytes written or verified by a single vector operation
+	"""
+	buffer_size = size // 8 * 8
+	buffer = mmap.mmap(-1, buffer_size, flags=mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS)
+	libc = ctypes.CDLL(None, use_errno=True)
+	try:
+		if hasattr(mmap, 'MADV_HUGEPAGE'):
+			try:
+				buffer.madvise(mmap.MADV_HUGEPAGE)
+				result['is_huge'] = True
+			except OSError:
+				pass
+		address = ctypes.c_void_p(ctypes.addressof(ctypes.c_char.from_buffer(buffer)))
+		result['is_locked'] = libc.mlock(address, ctypes.c_size_t(buffer_size)) == 0
+		try:
+			_test_buffer(numpy.frombuffer(buffer, dtype=numpy.uint64), result, passes, stop_event,
+				max_reported_errors, chunk_size // 8)
+		finally:
+			if result['is_locked']:
+				libc.munlock(address, ctypes.c_size_t(buffer_size))
+			del address
+	finally:
+		buffer.close()
+
+
+def _test_buffer(words, result, passes, stop_event, max_reported_errors, chunk_words):
+	"""
+	Runs all passes on the allocated buffer
+
+	:param words: the buffer represented as numpy array of 64-bit words
+	:param result: the result dictionary to fill in
+	:param passes: list of passes to run
+	:param stop_event: the event that stops the worker
+	:param max_reported_errors: maximum number of mismatches that will be reported in details
+	:param chunk_words: number of words written or verified by a single vector operation
+	"""
+	word_number = len(words)
+	write_time = 0.0
+	verify_time = 0.0
+	written_bytes = 0
+	for pass_name, pattern_function in _generate_patterns(passes):
+		if stop_event.is_set():
+			result['is_stopped'] = True
+			break
+		start_time = time.perf_counter()
+		for chunk_start in range(0, word_number, chunk_words):
+			chunk = words[chunk_start:chunk_start + chunk_words]
+			chunk[:] = pattern_function(chunk_start, len(chunk))
+		write_time += time.perf_counter() - start_time
+		start_time = time.perf_counter()
+		for chunk_start in range(0, word_number, chunk_words):
+			chunk = words[chunk_start:chunk_start + chunk_words]
+			expected = pattern_function(chunk_start, len(chunk))
+			mismatches = chunk != expected
+			if not mismatches.any():
+				continue
+			mismatch_offsets = numpy.flatnonzero(mismatches)
+			result['error_count'] += len(mismatch_offsets)
+			for offset in mismatch_offsets[:max(max_reported_errors - len(result['errors']), 0)]:
+				expected_word = expected if numpy.ndim(expected) == 0 else expected[offset]
+				result['errors'].append((pass_name, int(chunk_start + offset) * 8, int(expected_word),
+					int(chunk[offset])))
+		verify_time += time.perf_counter() - start_time
+		written_bytes += word_number * 8
+		result['pass_number'] += 1
+		if result['error_count'] > 0:
+			stop_event.set()
+			break
+	result['write_bandwidth'] = written_bytes / write_time if write_time > 0 else 0.0
+	result['verify_bandwidth'] = written_bytes / verify_time if verify_time > 0 else 0.0
+
+
+def _generate_patterns(passes):
+	"""
+	Generates all patterns for given passes
+
+	:param passes: list of passes
+	:return: generator of tuples (pass name, pattern function). The pattern function accepts the offset of the chunk
+		in words and the chunk length in words and returns either a numpy.uint64 scalar or an array of chunk length
+	"""
+	for pass_name in passes:
+		if pass_name == 'walking_ones':
+			for bit in range(64):
+				pattern = numpy.uint64(1 << bit)
+				yield pass_name, lambda chunk_start, length, pattern=pattern: pattern
+		elif pass_name == 'walking_zeros':
+			for bit in range(64):
+				pattern = numpy.uint64(~(1 << bit) & 0xFFFFFFFFFFFFFFFF)
+				yield pass_name, lambda chunk_start, length, pattern=pattern: pattern
+		elif pass_name == 'checkerboard':
+			for first_word, second_word in ((0x5555555555555555, 0xAAAAAAAAAAAAAAAA),
+					(0xAAAAAAAAAAAAAAAA, 0x5555555555555555)):
+				checkerboard = numpy.empty(2, dtype=numpy.uint64)
+				checkerboard[:] = (first_word, second_word)
+				yield pass_name, lambda chunk_start, length, checkerboard=checkerboard: \
+					numpy.resize(checkerboard if chunk_start % 2 == 0 else checkerboard[::-1], length)
+		elif pass_name == 'random':
+			seed = int.from_bytes(os.urandom(8), 'little')
+			yield pass_name, lambda chunk_start, length, seed=seed: numpy.random.default_rng((seed, chunk_start)) \
+				.integers(0, 1 << 64, size=length, dtype=numpy.uint64, endpoint=False)
+		elif pass_name == 'address':
+			yield pass_name, lambda chunk_start, length: \
+				numpy.arange(chunk_start * 8, (chunk_start + length) * 8, 8, dtype=numpy.uint64)
@@ -1,24 +1,348 @@
-from .command_line_test import CommandLineTest
+import os
+import re
+import time
+import shutil
+import selectors
+import subprocess
+
+from .command_line_test import CommandLineTest, OutputReader
+from .exceptions import TestFailedError
+from .test_result import TestResult
+
+
+class MemtesterWorker:
+	"""
+	A single memtester process that tests its own part of the operating memory.
+
+	The worker is pinned to a given CPU and its memory is allocated on a given NUMA node. The memtester output is
+	parsed on the fly: each failure is stored as a dictionary with the test name, the failing offset and the mismatching
+	values.
+	"""
+
+	failure_pattern = re.compile(r'FAILURE: (?:(0x[0-9a-fA-F]+) != (0x[0-9a-fA-F]+) at offset (0x[0-9a-fA-F]+)|' +
+		r'possible bad address line at offset (0x[0-9a-fA-F]+))')
+	test_name_pattern = re.compile(r'^\s*([A-Za-z][A-Za-z0-9 /-]*?)\s*:')
+
+	def __init__(self, index, size, cpu=None, node=None, output_limit=CommandLineTest.OUTPUT_LIMIT):
+		"""
+		Initializes the worker
+
+		:param index: the worker number
+		:param size: amount of memory to test, in megabytes
+		:param cpu: the logical CPU to pin the worker to, None to run the worker on any CPU
+		:param node: the NUMA node where the memory shall be allocated, None for the default memory policy
+		:param output_limit: how many characters from the end of the memtester output shall be kept
+		"""
+		self.index = index
+		self.size = size
+		self.cpu = cpu
+		self.node = node
+		self.output_reader = OutputReader(output_limit)
+		self.process = None
+		self.is_terminated = False
+		self.failures = list()
+
+	def start(self, use_numactl):
+		"""
+		Starts the memtester
+
+		:param use_numactl: True to pin the worker and bind its memory by means of the numactl utility. Otherwise,
+			the worker is pinned by means of sched_setaffinity() and its memory is allocated by the default policy
+		"""
+		command = ["memtester", "%dM" % self.size, "1"]
+		if use_numactl and self.node is not None:
+			command = ["numactl", "--membind=%d" % self.node, "--physcpubind=%d" % self.cpu] + command
+		self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+			start_new_session=True)
+		if self.cpu is not None and not (use_numactl and self.node is not None):
+			try:
+				os.sched_setaffinity(self.process.pid, {self.cpu})
+			except OSError:
+				pass
+
+	@property
+	def is_failed(self):
+		"""
+		True if memtester reported a failure or finished with non-zero exit code
+		"""
+		return len(self.failures) > 0 or (self.process.returncode is not None and self.process.returncode != 0)
+
+	def feed(self, data):
+		"""
+		Processes the next portion of the memtester output
+
+		:param data: bytes read from the memtester output, empty bytes at the end of output
+		:return: list of completed lines
+		"""
+		lines = self.output_reader.feed(data)
+		for line in lines:
+			failure_matches = self.failure_pattern.search(line)
+			if failure_matches is None:
+				continue
+			test_name_matches = self.test_name_pattern.match(line)
+			value1, value2, offset, address_offset = failure_matches.groups()
+			self.failures.append({
+				'test': None if test_name_matches is None else test_name_matches.group(1),
+				'offset': int(offset or address_offset, 16),
+				'values': None if value1 is None else (int(value1, 16), int(value2, 16)),
+			})
+		return lines
+
+	def report(self):
+		"""
+		Builds the worker report
+
+		:return: the report as a single line
+		"""
+		location = "%d MB" % self.size
+		if self.node is not None:
+			location += ", NUMA node %d" % self.node
+		if self.cpu is not None:
+			location += ", CPU %d" % self.cpu
+		if len(self.failures) > 0:
+			status = "failed"
+		elif self.is_terminated:
+			status = "terminated"
+		elif self.process.returncode != 0:
+			status = "failed with exit code %d" % self.process.returncode
+		else:
+			status = "passed"
+		failure_lines = list()
+		for failure in self.failures:
+			failure_line = "%s at offset 0x%x" % (failure['test'] or "unknown test", failure['offset'])
+			if failure['values'] is not None:
+				failure_line += ": 0x%x != 0x%x" % failure['values']
+			failure_lines.append(failure_line)
+		return "memtester #%d (%s): %s%s" % (self.index, location, status,
+			"".join(["\n\t" + failure_line for failure_line in failure_lines]))
 
 
 class MemoryTest(CommandLineTest):
 	"""
 	Checks the operating memory for the I/O errors.
 
-	The memory test will be accomplished by means of the memtester utility
+	The memory test will be accomplished by means of the memtester utility. Since memtester is single-threaded, the
+	tested memory is split between several memtester workers, each worker is pinned to its own CPU and its memory is
+	allocated on the NUMA node of this CPU. The workers are distributed among NUMA nodes evenly. The test stops all
+	workers as soon as one of them reports a failure.
+
+	Alternatively, the memory can be tested by the 'native' engine (see MemoryPatternEngine) that doesn't require
+	memtester and reports the write and verify bandwidth of each worker.
 	"""
 
-	TESTER_COMMAND = "memtester {volume} 1"
+	SUPPORTED_ENGINES = ['memtester', 'native']
+
+	NODE_PATH = "/sys/devices/system/node"
+	NODE_NAME_PATTERN = re.compile(r'^node(\d+)$')
+	MIN_WORKER_SIZE = 256
 	name = "Memory test"
 
 	@classmethod
-	def run(cls, memory_size=None, **kwargs):
+	def run(cls, memory_size=None, workers=None, numa=True, command_timeout=None, command_output_limit=None,
+			engine='memtester', passes=None, **kwargs):
 		"""
 		Starts the memory test
 
-		:param memory_size: amount of operating memory to be tested
+		:param memory_size: amount of operating memory to be tested: number of megabytes (as the memtester utility reads
+			it) or string like '512M', '15G'
+		:param workers: number of memtester processes. None for one worker per available CPU, but each worker tests at
+			least MIN_WORKER_SIZE megabytes
+		:param numa: True to distribute the workers among NUMA nodes and bind their memory to these nodes
+		:param command_timeout: maximum duration of the test in seconds, None for no limit
+		:param command_output_limit: how many characters from the end of the output of each worker shall be kept. None
+			for OUTPUT_LIMIT
+		:param engine: 'memtester' to test the memory by the memtester utility, 'native' to test the memory by the
+			corefacility-checker itself
+		:param passes: list of test passes for the 'native' engine, None for all MemoryPatternEngine.SUPPORTED_PASSES
 		:param kwargs: useless
 		"""
 		if memory_size is None:
 			raise ValueError("The memory size has not been specified")
-		super().run(command=cls.TESTER_COMMAND, volume=memory_size)
+		memory_megabytes = cls._parse_memory_size(memory_size)
+		if memory_megabytes <= 0:
+			raise ValueError("The 'memory_size' configuration parameter must be at least 1M")
+		cpus = cls._get_cpus(numa)
+		if workers is None:
+			workers = max(min(len(cpus), memory_megabytes // cls.MIN_WORKER_SIZE), 1)
+		if not isinstance(workers, int) or workers <= 0:
+			raise ValueError("The 'workers' configuration parameter must be positive integer")
+		if engine not in cls.SUPPORTED_ENGINES:
+			raise ValueError("The 'engine' configuration parameter must be one of: %s" % ", ".join(cls.SUPPORTED_ENGINES))
+		worker_cpus = [cpus[index % len(cpus)] for index in range(workers)]
+		worker_sizes = [memory_megabytes // workers + (1 if index < memory_megabytes % workers else 0)
+			for index in range(workers)]
+		result = TestResult(cls.name)
+		result.add_metric("memory_tested_bytes", memory_megabytes << 20, "Amount of the tested memory")
+		result.add_metric("memory_workers", workers, "Number of processes that tested the memory concurrently")
+		if engine == 'native':
+			return cls._run_native_engine(worker_sizes, [cpu for _, cpu in worker_cpus], passes, command_timeout,
+				result)
+		output_limit = cls.OUTPUT_LIMIT if command_output_limit is None else command_output_limit
+		memory_test_workers = [
+			MemtesterWorker(index, size, cpu, node, output_limit)
+			for index, (size, (node, cpu)) in enumerate(zip(worker_sizes, worker_cpus))
+		]
+		use_numactl = numa and shutil.which("numactl") is not None
+		return cls._run_workers(memory_test_workers, use_numactl, command_timeout, result)
+
+	@classmethod
+	def _parse_memory_size(cls, memory_size):
+		"""
+		Converts the memory size from the configuration file to number of megabytes.
+		The memory size is treated in the same way as the memtester utility does: a bare number means megabytes
+
+		:param memory_size: either integer or string containing digits only (number of megabytes) or string like
+			'512M', '15G', '1073741824B'
+		:return: number of megabytes
+		"""
+		if isinstance(memory_size, bool):
+			raise ValueError("The 'memory_size' configuration parameter must be either integer or string like '15G'")
+		if isinstance(memory_size, int):
+			return memory_size
+		if isinstance(memory_size, str) and memory_size.strip().isdigit():
+			return int(memory_size)
+		return cls.parse_size(memory_size) >> 20
+
+	@classmethod
+	def get_resources(cls, **kwargs):
+		"""
+		Returns all resources engaged by the test
+
+		:param kwargs: The keyword arguments defined by each configuration file
+		:return: the memory test engages the operating memory
+		"""
+		return {"memory"}
+
+	@classmethod
+	def _get_cpus(cls, numa):
+		"""
+		Lists all CPUs available for the test in the order the workers shall be assigned to them: first CPU of each
+		NUMA node, then second CPU of each NUMA node etc.
+
+		:param numa: True to take the NUMA topology into account
+		:return: list of tuples (NUMA node, CPU). The NUMA node is None if the topology is not taken into account
+		"""
+		available_cpus = os.sched_getaffinity(0)
+		node_cpus = dict()
+		if numa and os.path.isdir(cls.NODE_PATH):
+			for node_name in os.listdir(cls.NODE_PATH):
+				node_matches = cls.NODE_NAME_PATTERN.match(node_name)
+				if node_matches is None:
+					continue
+				with open(os.path.join(cls.NODE_PATH, node_name, "cpulist"), 'r') as cpulist_file:
+					cpus = sorted(cls._parse_cpu_list(cpulist_file.read()) & available_cpus)
+				if len(cpus) > 0:
+					node_cpus[int(node_matches.group(1))] = cpus
+		if len(node_cpus) == 0:
+			return [(None, cpu) for cpu in sorted(available_cpus)]
+		ordered_cpus = list()
+		for position in range(max([len(cpus) for cpus in node_cpus.values()])):
+			for node in sorted(node_cpus.keys()):
+				if position < len(node_cpus[node]):
+					ordered_cpus.append((node, node_cpus[node][position]))
+		return ordered_cpus
+
+	@classmethod
+	def _parse_cpu_list(cls, cpu_list):
+		"""
+		Parses the CPU list in the sysfs format
+
+		:param cpu_list: the CPU list like '0-7,16-23'
+		:return: set of CPU numbers
+		"""
+		cpus = set()
+		for cpu_range in cpu_list.strip().split(","):
+			if len(cpu_range) == 0:
+				continue
+			first_cpu, _, last_cpu = cpu_range.partition("-")
+			cpus.update(range(int(first_cpu), int(last_cpu or first_cpu) + 1))
+		return cpus
+
+	@classmethod
+	def _run_native_engine(cls, sizes, cpus, passes, timeout, result):
+		"""
+		Tests the memory by the native engine
+
+		:param sizes: amount of memory to test by each worker, in megabytes
+		:param cpus: the logical CPU of each worker
+		:param passes: list of test passes, None for all passes
+		:param timeout: maximum duration of the test in seconds, None for no limit
+		:param result: the TestResult where the error number and the bandwidth of each worker will be added
+		:return: the test result
+		"""
+		from .memory_patterns import MemoryPatternEngine
+		engine = MemoryPatternEngine([size << 20 for size in sizes], cpus, passes)
+		is_completed = engine.run(timeout)
+		report = engine.report()
+		error_count = sum([worker_result['error_count'] for worker_result in engine.results.values()])
+		result.add_metric("memory_errors", error_count, "Number of mismatching words or memtester failures")
+		for index, worker_result in sorted(engine.results.items()):
+			if worker_result['error_message'] is not None:
+				continue
+			result.add_metric("memory_write_bandwidth_bytes_per_second", worker_result['write_bandwidth'],
+				"Write bandwidth of the native memory test worker", worker=index, cpu=cpus[index])
+			result.add_metric("memory_verify_bandwidth_bytes_per_second", worker_result['verify_bandwidth'],
+				"Verify bandwidth of the native memory test worker", worker=index, cpu=cpus[index])
+		if engine.is_failed:
+			raise TestFailedError("The memory test has failed:\n" + report, result)
+		if not is_completed:
+			raise TestFailedError("The memory test has been terminated because it took longer than %s s:\n%s" %
+				(timeout, report), result)
+		cls.logger.info("Memory test report:\n" + report)
+		return result
+
+	@classmethod
+	def _run_workers(cls, workers, use_numactl, timeout, result):
+		"""
+		Runs all memtester workers concurrently and collects their output
+
+		:param workers: list of MemtesterWorker instances
+		:param use_numactl: True to bind the workers by means of numactl
+		:param timeout: maximum duration of the test in seconds, None for no limit
+		:param result: the TestResult where the number of failures will be added
+		:return: the test result
+		"""
+		deadline = None if timeout is None else time.monotonic() + timeout
+		failed_worker = None
+		is_timed_out = False
+		with selectors.DefaultSelector() as selector:
+			try:
+				for worker in workers:
+					worker.start(use_numactl)
+					selector.register(worker.process.stdout, selectors.EVENT_READ, worker)
+				while len(selector.get_map()) > 0 and failed_worker is None:
+					wait_time = cls.POLL_INTERVAL if deadline is None else \
+						min(cls.POLL_INTERVAL, deadline - time.monotonic())
+					if wait_time <= 0:
+						is_timed_out = True
+						break
+					for key, _ in selector.select(wait_time):
+						worker = key.data
+						data = os.read(key.fd, cls.READ_SIZE)
+						for line in worker.feed(data):
+							cls.logger.debug("memtester #%d: %s" % (worker.index, line))
+						if len(data) == 0:
+							selector.unregister(key.fileobj)
+							worker.process.wait()
+						if worker.is_failed:
+							failed_worker = worker
+							break
+			finally:
+				for worker in workers:
+					if worker.process is None:
+						continue
+					if worker.process.returncode is None:
+						cls._kill(worker.process)
+						worker.is_terminated = True
+					worker.process.stdout.close()
+		report = "\n".join([worker.report() for worker in workers if worker.process is not None])
+		result.add_metric("memory_errors", sum([len(worker.failures) for worker in workers]),
+			"Number of mismatching words or memtester failures")
+		if failed_worker is not None:
+			cls.logger.error(failed_worker.output_reader.get_output())
+			raise TestFailedError("The memory test has failed:\n" + report, result)
+		if is_timed_out:
+			raise TestFailedError("The memory test has been terminated because it took longer than %s s:\n%s" %
+				(timeout, report), result)
+		cls.logger.info("Memory test report:\n" + report)
+		return result
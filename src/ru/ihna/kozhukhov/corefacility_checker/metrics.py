@@ -0,0 +1,197 @@
+import os
+import re
+import json
+import math
+import socket
+import logging
+import tempfile
+import threading
+
+
+class MetricExporter:
+	"""
+	This is a base class for all exporters that send the test results to the monitoring system.
+
+	The exporters are created from the 'metrics' section of the configuration file by the configure() method and
+	are called by the checker after each test.
+	"""
+
+	exporters = list()
+	logger = logging.getLogger("django.corefacility.checker")
+
+	@classmethod
+	def configure(cls, metrics_options):
+		"""
+		Creates all exporters mentioned in the 'metrics' section of the configuration file
+
+		:param metrics_options: the 'metrics' section of the configuration file, None if no metrics shall be exported
+		"""
+		MetricExporter.exporters = list()
+		if metrics_options is None:
+			return
+		if metrics_options.get('textfile_folder') is not None:
+			MetricExporter.exporters.append(PrometheusExporter(metrics_options['textfile_folder']))
+		if metrics_options.get('history_file') is not None:
+			MetricExporter.exporters.append(JsonLinesExporter(metrics_options['history_file']))
+
+	@classmethod
+	def export_all(cls, result):
+		"""
+		Exports the test result by all configured exporters. Export failures are logged but don't fail the test
+
+		:param result: the TestResult instance
+		"""
+		for exporter in MetricExporter.exporters:
+			try:
+				exporter.export(result)
+			except Exception as error:
+				cls.logger.warning("Unable to export metrics of the test '%s' by %s: %s" %
+					(result.test_name, exporter.__class__.__name__, error))
+
+	def export(self, result):
+		"""
+		Exports a single test result
+
+		:param result: the TestResult instance
+		"""
+		raise NotImplementedError("Please, implement the MetricExporter.export method")
+
+
+class PrometheusExporter(MetricExporter):
+	"""
+	Writes the test results to the textfile collector folder of the Prometheus node_exporter.
+
+	Each test has its own .prom file that is replaced atomically each time the test completes, so the node_exporter
+	never reads a partially written file and results of tests that were not run this time are still exported. Each
+	metric gets the 'test' and 'class' labels, and its name is prefixed by METRIC_PREFIX. Besides the metrics added by
+	the tester, the following metrics are exported for each test: whether the test has been passed, its duration and
+	the time it completed.
+	"""
+
+	METRIC_PREFIX = "corefacility_checker_"
+	FILE_PREFIX = "corefacility_checker_"
+	FILE_SUFFIX = ".prom"
+	invalid_name_pattern = re.compile(r'[^a-zA-Z0-9_]')
+
+	def __init__(self, folder):
+		"""
+		Initializes the exporter
+
+		:param folder: the textfile collector folder (the --collector.textfile.directory option of the node_exporter). It
+			will be created if doesn't exist
+		"""
+		self.folder = folder
+
+	def export(self, result):
+		"""
+		Replaces the test's .prom file by the new one
+
+		:param result: the TestResult instance
+		"""
+		os.makedirs(self.folder, exist_ok=True)
+		filename = os.path.join(self.folder, "%s%s%s" %
+			(self.FILE_PREFIX, self.invalid_name_pattern.sub("_", result.test_name), self.FILE_SUFFIX))
+		descriptor, temporary_filename = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=self.folder)
+		try:
+			with os.fdopen(descriptor, 'w') as output_file:
+				output_file.write(self.format(result))
+			os.chmod(temporary_filename, 0o644)
+			os.rename(temporary_filename, filename)
+		except BaseException:
+			os.unlink(temporary_filename)
+			raise
+
+	def format(self, result):
+		"""
+		Represents the test result in the Prometheus text exposition format
+
+		:param result: the TestResult instance
+		:return: the text of the .prom file
+		"""
+		metrics = [
+			{'name': "test_success", 'value': 1 if result.is_ok else 0, 'labels': dict(),
+				'description': "1 if the test has been passed, 0 otherwise"},
+			{'name': "test_duration_seconds", 'value': result.duration, 'labels': dict(),
+				'description': "Duration of the test"},
+			{'name': "test_last_run_timestamp_seconds", 'value': result.start_time + result.duration, 'labels': dict(),
+				'description': "Time when the test has been completed"},
+		] + result.metrics
+		families = dict()
+		for metric in metrics:
+			families.setdefault(self.invalid_name_pattern.sub("_", metric['name']), list()).append(metric)
+		lines = list()
+		for name, family in families.items():
+			full_name = self.METRIC_PREFIX + name
+			description = next((metric['description'] for metric in family if metric['description'] is not None), None)
+			if description is not None:
+				lines.append("# HELP %s %s" % (full_name, description.replace("\\", "\\\\").replace("\n", "\\n")))
+			lines.append("# TYPE %s gauge" % full_name)
+			for metric in family:
+				labels = {'test': result.test_name, 'class': result.test_class}
+				labels.update(metric['labels'])
+				lines.append("%s{%s} %s" % (full_name,
+					",".join(['%s="%s"' % (self.invalid_name_pattern.sub("_", label), self._escape(value))
+						for label, value in labels.items()]),
+					self._format_value(metric['value'])))
+		return "\n".join(lines) + "\n"
+
+	def _format_value(self, value):
+		"""
+		Formats the metric value
+
+		:param value: the metric value
+		:return: the value as a string
+		"""
+		value = float(value)
+		if math.isnan(value):
+			return "NaN"
+		if math.isinf(value):
+			return "+Inf" if value > 0 else "-Inf"
+		return repr(value)
+
+	def _escape(self, value):
+		"""
+		Escapes the label value
+
+		:param value: the label value
+		:return: the escaped value
+		"""
+		return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class JsonLinesExporter(MetricExporter):
+	"""
+	Appends each test result as a single JSON line to the history file.
+
+	Each line contains the host name, the test name and class, the test status, its start time (UNIX timestamp),
+	duration, the error message for failed tests and all metrics added by the tester. Each line is written by a single
+	write() call to the file opened in the append mode, so lines written by the tests running in parallel are never
+	interleaved.
+	"""
+
+	def __init__(self, filename):
+		"""
+		Initializes the exporter
+
+		:param filename: the history file. It will be created together with its folder if doesn't exist
+		"""
+		self.filename = filename
+		self.host = socket.gethostname()
+		self.lock = threading.Lock()
+
+	def export(self, result):
+		"""
+		Appends the test result to the history file
+
+		:param result: the TestResult instance
+		"""
+		record = {'host': self.host}
+		record.update(result.to_dict())
+		line = (json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8')
+		with self.lock:
+			os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+			descriptor = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+			try:
+				os.write(descriptor, line)
+			finally:
+				os.close(descriptor)
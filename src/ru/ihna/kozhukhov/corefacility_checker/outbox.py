@@ -0,0 +1,222 @@
+import os
+import time
+import logging
+import smtplib
+import threading
+
+
+class Outbox:
+	"""
+	Keeps all outgoing mails in the spool folder and delivers them by the background thread.
+
+	Each mail is written to the spool folder as a separate .eml file before the put() method returns, so tests never
+	wait for the mail delivery and mails that were not delivered before the checker exited are delivered at the next
+	run. The sender thread delivers mails in the order they were queued through a single SMTP connection that is
+	kept open for CONNECTION_IDLE_TIME seconds after the last delivery, so mails sent after each test don't require
+	a new TLS handshake and login. When delivery fails, the connection is closed and the delivery is retried
+	after a delay that doubles after each failure. Mails permanently rejected by the SMTP server are renamed to
+	.rejected files and are not retried.
+
+	The outbox logger is not a child of the checker logger, so delivery failures are never mailed through the same
+	outbox.
+	"""
+
+	MESSAGE_SUFFIX = ".eml"
+	REJECTED_SUFFIX = ".rejected"
+	PARTIAL_FILE_SUFFIX = ".part"
+	POLL_INTERVAL = 5
+	INITIAL_RETRY_DELAY = 5
+	MAX_RETRY_DELAY = 600
+	CONNECTION_IDLE_TIME = 60
+	READ_CHUNK_SIZE = 65536
+
+	logger = logging.getLogger("corefacility.checker.outbox")
+
+	def __init__(self, spool_folder, connect, send_data):
+		"""
+		Initializes the outbox
+
+		:param spool_folder: the folder where undelivered mails are kept. It will be created if doesn't exist
+		:param connect: a function without arguments that connects to the SMTP server and returns smtplib.SMTP
+		:param send_data: a function (mail server, message chunks) that sends a single mail. The message chunks
+			consist of complete CRLF-terminated lines
+		"""
+		self.spool_folder = spool_folder
+		self.connect = connect
+		self.send_data = send_data
+		self.mail_server = None
+		self.last_delivery_time = 0.0
+		self.retry_delay = self.INITIAL_RETRY_DELAY
+		self.sequence_number = 0
+		self.lock = threading.Lock()
+		self.queue_event = threading.Event()
+		self.idle_event = threading.Event()
+		self.stop_event = threading.Event()
+		self.thread = None
+		os.makedirs(spool_folder, exist_ok=True)
+
+	def start(self):
+		"""
+		Starts the sender thread. Mails left by the previous run are delivered first
+		"""
+		self.stop_event.clear()
+		self.queue_event.set()
+		self.thread = threading.Thread(target=self._send_all, name="outbox", daemon=True)
+		self.thread.start()
+
+	def put(self, message_chunks):
+		"""
+		Puts the mail into the spool folder
+
+		:param message_chunks: an iterable of bytes containing the whole message with CRLF line endings
+		:return: name of the spool file
+		"""
+		with self.lock:
+			self.sequence_number += 1
+			sequence_number = self.sequence_number
+		spool_file = os.path.join(self.spool_folder, "%020d-%d-%06d%s" %
+			(time.time_ns(), os.getpid(), sequence_number, self.MESSAGE_SUFFIX))
+		partial_spool_file = spool_file + self.PARTIAL_FILE_SUFFIX
+		with open(partial_spool_file, 'wb') as output_file:
+			for chunk in message_chunks:
+				output_file.write(chunk)
+			output_file.flush()
+			os.fsync(output_file.fileno())
+		os.rename(partial_spool_file, spool_file)
+		self.queue_event.set()
+		return spool_file
+
+	def get_queued_files(self):
+		"""
+		Returns all mails that have not been delivered yet
+
+		:return: list of spool file names in the order of delivery
+		"""
+		return [os.path.join(self.spool_folder, filename) for filename in sorted(os.listdir(self.spool_folder))
+			if filename.endswith(self.MESSAGE_SUFFIX)]
+
+	def flush(self, timeout=None):
+		"""
+		Waits until all queued mails will be delivered
+
+		:param timeout: maximum waiting time in seconds, None to wait forever
+		:return: True if all mails have been delivered, False if the timeout expired
+		"""
+		deadline = None if timeout is None else time.monotonic() + timeout
+		while len(self.get_queued_files()) > 0:
+			remaining_time = None if deadline is None else deadline - time.monotonic()
+			if self.thread is None or (remaining_time is not None and remaining_time <= 0):
+				return False
+			self.idle_event.clear()
+			self.queue_event.set()
+			self.idle_event.wait(remaining_time)
+		return True
+
+	def stop(self, timeout=None):
+		"""
+		Waits until all queued mails will be delivered and stops the sender thread. Undelivered mails remain in the
+		spool folder
+
+		:param timeout: maximum time to wait for the delivery in seconds, None to wait forever
+		:return: number of undelivered mails
+		"""
+		self.flush(timeout)
+		if self.thread is not None:
+			self.stop_event.set()
+			self.queue_event.set()
+			self.thread.join()
+			self.thread = None
+		return len(self.get_queued_files())
+
+	def _send_all(self):
+		"""
+		The main routine of the sender thread
+		"""
+		while not self.stop_event.is_set():
+			self.queue_event.wait(self.POLL_INTERVAL)
+			self.queue_event.clear()
+			while not self.stop_event.is_set():
+				queued_files = self.get_queued_files()
+				if len(queued_files) == 0:
+					break
+				if self._send_file(queued_files[0]):
+					self.retry_delay = self.INITIAL_RETRY_DELAY
+				else:
+					self.stop_event.wait(self.retry_delay)
+					self.retry_delay = min(self.retry_delay * 2, self.MAX_RETRY_DELAY)
+			if time.monotonic() - self.last_delivery_time > self.CONNECTION_IDLE_TIME:
+				self._disconnect()
+			if len(self.get_queued_files()) == 0:
+				self.idle_event.set()
+		self._disconnect()
+
+	def _send_file(self, spool_file):
+		"""
+		Delivers a single mail and removes it from the spool folder
+
+		:param spool_file: the spool file
+		:return: True if the mail has been delivered, False otherwise
+		"""
+		try:
+			self._check_connection()
+			if self.mail_server is None:
+				self.mail_server = self.connect()
+			with open(spool_file, 'rb') as input_file:
+				self.send_data(self.mail_server, self._read_chunks(input_file))
+		except FileNotFoundError:
+			return True
+		except smtplib.SMTPResponseException as error:
+			if self.mail_server is None or not 500 <= error.smtp_code < 600:
+				self.logger.warning("Unable to deliver the mail, next attempt in %d seconds: %s" %
+					(self.retry_delay, error))
+				self._disconnect()
+				return False
+			self.logger.error("The mail %s has been rejected by the SMTP server: %s" % (spool_file, error))
+			os.rename(spool_file, spool_file[:-len(self.MESSAGE_SUFFIX)] + self.REJECTED_SUFFIX)
+			self._disconnect()
+			return True
+		except Exception as error:
+			self.logger.warning("Unable to deliver the mail, next attempt in %d seconds: %s" % (self.retry_delay, error))
+			self._disconnect()
+			return False
+		os.unlink(spool_file)
+		self.last_delivery_time = time.monotonic()
+		return True
+
+	def _check_connection(self):
+		"""
+		Closes the SMTP connection if the SMTP server doesn't respond to the NOOP command
+		"""
+		if self.mail_server is None:
+			return
+		try:
+			code, _ = self.mail_server.noop()
+		except Exception:
+			code = None
+		if code != 250:
+			self._disconnect()
+
+	def _read_chunks(self, input_file):
+		"""
+		Reads the spool file by chunks consisting of complete lines
+
+		:param input_file: the opened spool file
+		:return: generator of chunks
+		"""
+		while True:
+			lines = input_file.readlines(self.READ_CHUNK_SIZE)
+			if len(lines) == 0:
+				break
+			yield b"".join(lines)
+
+	def _disconnect(self):
+		"""
+		Closes the SMTP connection if it is opened
+		"""
+		if self.mail_server is None:
+			return
+		try:
+			self.mail_server.quit()
+		except Exception:
+			self.mail_server.close()
+		self.mail_server = None
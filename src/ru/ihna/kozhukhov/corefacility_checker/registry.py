@@ -0,0 +1,89 @@
+import importlib
+import importlib.metadata
+
+
+STANDARD_TESTERS = {
+	"posix_command": "ru.ihna.kozhukhov.corefacility_checker.command_line_test:CommandLineTest",
+	"cpu_test": "ru.ihna.kozhukhov.corefacility_checker.cpu_test:CpuTest",
+	"memory_test": "ru.ihna.kozhukhov.corefacility_checker.memory_test:MemoryTest",
+	"disk_physical_reading": "ru.ihna.kozhukhov.corefacility_checker.disk_reading_test:DiskReadingTest",
+	"smart_test": "ru.ihna.kozhukhov.corefacility_checker.smart_test:SmartTest",
+	"fail_test": "ru.ihna.kozhukhov.corefacility_checker.fail_test:FailTest",
+	"sql_dump": "ru.ihna.kozhukhov.corefacility_checker.sql_dump:SqlDump",
+}
+
+
+class TesterRegistry:
+	"""
+	Resolves the value of the 'class' test property into the tester class.
+
+	The tester class is imported only when it is requested, so the checker doesn't import modules (and their heavy
+	dependencies like numpy or scipy) of the testers that are not going to be run. The value of the 'class' property
+	is looked up in the following order:
+	1. standard testers given by the STANDARD_TESTERS dictionary;
+	2. testers provided by third-party packages through the ENTRY_POINT_GROUP entry point group. The entry point name
+		is the value of the 'class' property, the entry point value is 'module:Class';
+	3. full dotted path to the tester class like 'my_package.my_module.MyTest'.
+	The installed entry points are scanned only when the tester is not a standard one.
+	"""
+
+	ENTRY_POINT_GROUP = "corefacility_checker.testers"
+
+	def __init__(self, testers=None):
+		"""
+		Initializes the registry
+
+		:param testers: dictionary tester name => 'module:Class' string. None for STANDARD_TESTERS
+		"""
+		self.testers = dict(STANDARD_TESTERS if testers is None else testers)
+		self.loaded_testers = dict()
+		self.entry_points = None
+
+	def load(self, name):
+		"""
+		Loads the tester class
+
+		:param name: value of the 'class' property of the test configuration
+		:return: the CheckerTest subclass
+		"""
+		if name not in self.loaded_testers:
+			if name in self.testers:
+				tester = self._import(self.testers[name])
+			elif name in self._get_entry_points():
+				tester = self._get_entry_points()[name].load()
+			elif "." in name:
+				module_name, _, class_name = name.rpartition(".")
+				tester = self._import("%s:%s" % (module_name, class_name))
+			else:
+				raise ValueError("Unknown tester - %s" % name)
+			self.loaded_testers[name] = tester
+		return self.loaded_testers[name]
+
+	def _import(self, path):
+		"""
+		Imports the tester class
+
+		:param path: string like 'module:Class'
+		:return: the imported class
+		"""
+		module_name, _, class_name = path.partition(":")
+		module = importlib.import_module(module_name)
+		try:
+			return getattr(module, class_name)
+		except AttributeError:
+			raise ImportError("Module '%s' doesn't contain the tester '%s'" % (module_name, class_name))
+
+	def _get_entry_points(self):
+		"""
+		Scans the installed entry points once
+
+		:return: dictionary entry point name => entry point
+		"""
+		if self.entry_points is None:
+			entry_points = importlib.metadata.entry_points()
+			if hasattr(entry_points, 'select'):
+				entry_points = entry_points.select(group=self.ENTRY_POINT_GROUP)
+			else:
+				entry_points = entry_points.get(self.ENTRY_POINT_GROUP, [])
+			self.entry_points = {entry_point.name: entry_point for entry_point in entry_points}
+		return self.entry_points
@@ -0,0 +1,166 @@
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .checker_test import CheckerTest
+
+
+class ScheduledTest:
+	"""
+	A single test put into the test schedule.
+
+	The scheduled test knows what resources it engages and which previously scheduled tests it must wait for.
+	"""
+
+	def __init__(self, test_name, tester, test_config, resources, execution_options=None):
+		"""
+		Initializes the scheduled test
+
+		:param test_name: name of the test (key of the 'tests' dictionary in the configuration file)
+		:param tester: the CheckerTest subclass that will run the test
+		:param test_config: the test configuration, without the 'class' key and the execution options
+		:param resources: set of all resources engaged by the test
+		:param execution_options: how the test shall be executed (isolation, time and memory limits etc.)
+		"""
+		self.test_name = test_name
+		self.tester = tester
+		self.test_config = test_config
+		self.execution_options = execution_options
+		self.resources = set(resources)
+		self.dependencies = list()
+		self.start_time = None
+		self.end_time = None
+		self.is_ok = None
+
+	def conflicts_with(self, other):
+		"""
+		Checks whether two tests can't be run in parallel
+
+		:param other: another ScheduledTest instance
+		:return: True if both tests shall be serialized, False if they can overlap
+		"""
+		exclusive = CheckerTest.EXCLUSIVE_RESOURCE
+		if exclusive in self.resources or exclusive in other.resources:
+			return True
+		return len(self.resources & other.resources) > 0
+
+	@property
+	def is_ready(self):
+		"""
+		True if all tests this test depends on have been completed
+		"""
+		return all([dependency.end_time is not None for dependency in self.dependencies])
+
+	@property
+	def duration(self):
+		"""
+		Wall-clock time of the test in seconds, None if the test has not been completed
+		"""
+		if self.start_time is None or self.end_time is None:
+			return None
+		return self.end_time - self.start_time
+
+
+class TestScheduler:
+	"""
+	Runs the tests concurrently.
+
+	Each test declares resources it engages (a block device, all CPUs, the operating memory, the database).
+	The scheduler builds a dependency graph where each test depends on all previously added tests it conflicts with.
+	Conflicting tests are executed in the same order as they were mentioned in the configuration file while
+	the rest of the tests overlap.
+	"""
+
+	logger = logging.getLogger("django.corefacility.checker")
+
+	def __init__(self, run_function, max_workers=None):
+		"""
+		Initializes the scheduler
+
+		:param run_function: a function that runs a given tester. The function accepts the ScheduledTest instance
+			and returns True if the test has been passed, False otherwise. The function must not throw any exception.
+		:param max_workers: maximum number of tests run in parallel, None for no limitation
+		"""
+		self.run_function = run_function
+		self.max_workers = max_workers
+		self.tests = list()
+		self.start_time = None
+		self.end_time = None
+
+	def add(self, test_name, tester, test_config, resources, execution_options=None):
+		"""
+		Adds the test to the schedule
+
+		:param test_name: name of the test (key of the 'tests' dictionary in the configuration file)
+		:param tester: the CheckerTest subclass that will run the test
+		:param test_config: the test configuration, without the 'class' key and the execution options
+		:param resources: set of all resources engaged by the test
+		:param execution_options: how the test shall be executed (isolation, time and memory limits etc.)
+		:return: the ScheduledTest instance
+		"""
+		scheduled_test = ScheduledTest(test_name, tester, test_config, resources, execution_options)
+		for previous_test in self.tests:
+			if scheduled_test.conflicts_with(previous_test):
+				scheduled_test.dependencies.append(previous_test)
+		self.tests.append(scheduled_test)
+		return scheduled_test
+
+	def run(self, on_complete=None):
+		"""
+		Runs all scheduled tests
+
+		:param on_complete: a function that will be called in the calling thread each time a test has been completed.
+			The function accepts the ScheduledTest instance.
+		"""
+		max_workers = self.max_workers
+		if max_workers is None:
+			max_workers = max(len(self.tests), 1)
+		pending_tests = list(self.tests)
+		running_tests = dict()
+		self.start_time = time.monotonic()
+		with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="checker") as executor:
+			while len(pending_tests) > 0 or len(running_tests) > 0:
+				for scheduled_test in [test for test in pending_tests if test.is_ready]:
+					if len(running_tests) >= max_workers:
+						break
+					pending_tests.remove(scheduled_test)
+					future = executor.submit(self._run_test, scheduled_test)
+					running_tests[future] = scheduled_test
+				completed_futures, _ = wait(running_tests.keys(), return_when=FIRST_COMPLETED)
+				for future in completed_futures:
+					scheduled_test = running_tests.pop(future)
+					if on_complete is not None:
+						on_complete(scheduled_test)
+		self.end_time = time.monotonic()
+
+	def report(self):
+		"""
+		Builds the wall-clock report for all completed tests
+
+		:return: the report as a string
+		"""
+		report_lines = list()
+		for scheduled_test in self.tests:
+			report_lines.append("%s: %s, started at +%1.1f s, took %1.1f s" % (
+				scheduled_test.test_name,
+				"passed" if scheduled_test.is_ok else "failed",
+				scheduled_test.start_time - self.start_time,
+				scheduled_test.duration,
+			))
+		wall_clock_time = self.end_time - self.start_time
+		sequential_time = sum([scheduled_test.duration for scheduled_test in self.tests])
+		report_lines.append("Total wall-clock time: %1.1f s. Sequential schedule would take %1.1f s (%1.1f s saved)" %
+			(wall_clock_time, sequential_time, sequential_time - wall_clock_time))
+		return "\n".join(report_lines)
+
+	def _run_test(self, scheduled_test):
+		"""
+		Runs a single test within the worker thread
+
+		:param scheduled_test: the ScheduledTest instance
+		"""
+		scheduled_test.start_time = time.monotonic()
+		try:
+			scheduled_test.is_ok = self.run_function(scheduled_test)
+		finally:
+			scheduled_test.end_time = time.monotonic()
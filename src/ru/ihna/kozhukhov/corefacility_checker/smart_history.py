@@ -0,0 +1,195 @@
+import sqlite3
+import time
+
+
+class SmartHistory:
+	"""
+	Stores the S.M.A.R.T. attributes of all drives in the local SQLite database and looks for the degrading drives.
+
+	Each attribute value is stored as a separate row of the 'measurement' table. The primary key of this table is
+	(serial, attribute, timestamp) and the table is created WITHOUT ROWID, so the rows are clustered by the primary key
+	and reading the latest values of a given attribute of a given drive is a short index range scan regardless of how
+	many years of history the database contains.
+	"""
+
+	SCHEMA = [
+		"""
+		CREATE TABLE IF NOT EXISTS drive (
+			serial TEXT PRIMARY KEY,
+			model TEXT,
+			device TEXT,
+			last_seen INTEGER NOT NULL
+		)
+		""",
+		"""
+		CREATE TABLE IF NOT EXISTS measurement (
+			serial TEXT NOT NULL,
+			attribute TEXT NOT NULL,
+			timestamp INTEGER NOT NULL,
+			value INTEGER NOT NULL,
+			PRIMARY KEY (serial, attribute, timestamp)
+		) WITHOUT ROWID
+		""",
+	]
+
+	WATCHED_ATTRIBUTES = [
+		'Reallocated_Sector_Ct',
+		'Reported_Uncorrect',
+		'Current_Pending_Sector',
+		'Offline_Uncorrectable',
+		'UDMA_CRC_Error_Count',
+		'Reallocated_Event_Count',
+		'media_errors',
+		'num_err_log_entries',
+		'critical_warning',
+	]
+	TREND_POINTS = 4
+	SECONDS_PER_DAY = 86400
+
+	def __init__(self, filename):
+		"""
+		Opens the database and creates all tables if they don't exist
+
+		:param filename: the database file
+		"""
+		self.connection = sqlite3.connect(filename)
+		self.connection.execute("PRAGMA journal_mode=WAL")
+		with self.connection:
+			for statement in self.SCHEMA:
+				self.connection.execute(statement)
+
+	def close(self):
+		"""
+		Closes the database
+		"""
+		self.connection.close()
+
+	def add_smartctl_result(self, device, result, timestamp=None):
+		"""
+		Stores all attributes revealed by the 'smartctl -j -i -A' command
+
+		:param device: the device file
+		:param result: the smartctl output as a Python dictionary
+		:param timestamp: the UNIX time of the measurement. None for the current time
+		:return: the drive serial number or None if the smartctl output doesn't contain the serial number
+		"""
+		serial = result.get('serial_number')
+		if serial is None:
+			return None
+		if timestamp is None:
+			timestamp = int(time.time())
+		attributes = self.parse_attributes(result)
+		with self.connection:
+			self.connection.execute(
+				"INSERT OR REPLACE INTO drive (serial, model, device, last_seen) VALUES (?, ?, ?, ?)",
+				(serial, result.get('model_name'), device, timestamp)
+			)
+			self.connection.executemany(
+				"INSERT OR REPLACE INTO measurement (serial, attribute, timestamp, value) VALUES (?, ?, ?, ?)",
+				[(serial, attribute, timestamp, value) for attribute, value in attributes.items()]
+			)
+		return serial
+
+	@classmethod
+	def parse_attributes(cls, result):
+		"""
+		Extracts all integer attributes from the smartctl output
+
+		:param result: the smartctl output as a Python dictionary
+		:return: a dictionary attribute name => raw value
+		"""
+		attributes = dict()
+		for attribute in result.get('ata_smart_attributes', dict()).get('table', list()):
+			raw_value = attribute.get('raw', dict()).get('value')
+			if 'name' in attribute and isinstance(raw_value, int):
+				attributes[attribute['name']] = raw_value
+		for name, value in result.get('nvme_smart_health_information_log', dict()).items():
+			if isinstance(value, int) and not isinstance(value, bool):
+				attributes[name] = value
+		return attributes
+
+	def get_latest_values(self, serial, attribute, limit=None):
+		"""
+		Returns the latest values of a given attribute
+
+		:param serial: the drive serial number
+		:param attribute: the attribute name
+		:param limit: maximum number of values, None for TREND_POINTS
+		:return: list of tuples (timestamp, value) in chronological order
+		"""
+		if limit is None:
+			limit = self.TREND_POINTS
+		rows = self.connection.execute(
+			"SELECT timestamp, value FROM measurement WHERE serial = ? AND attribute = ? " +
+			"ORDER BY timestamp DESC LIMIT ?",
+			(serial, attribute, limit)
+		).fetchall()
+		rows.reverse()
+		return rows
+
+	def get_growth_rates(self, serial, attribute):
+		"""
+		Computes how fast a given attribute grew between the latest measurements
+
+		:param serial: the drive serial number
+		:param attribute: the attribute name
+		:return: list of growth rates (units per day) in chronological order
+		"""
+		return self._compute_growth_rates(self.get_latest_values(serial, attribute))
+
+	def _compute_growth_rates(self, values):
+		"""
+		Computes growth rates between consecutive measurements
+
+		:param values: list of tuples (timestamp, value) in chronological order
+		:return: list of growth rates (units per day) in chronological order
+		"""
+		growth_rates = list()
+		for (previous_time, previous_value), (current_time, current_value) in zip(values[:-1], values[1:]):
+			if current_time > previous_time:
+				growth_rates.append((current_value - previous_value) * self.SECONDS_PER_DAY /
+					(current_time - previous_time))
+		return growth_rates
+
+	def find_degradation(self, serials):
+		"""
+		Looks for the watched attributes that grow
+
+		:param serials: serial numbers of all drives to check
+		:return: list of tuples (serial, attribute, latest value, growth rates, is_accelerating). The attribute is
+			accelerating when its latest growth rate is positive and exceeds the previous one
+		"""
+		degradation = list()
+		for serial in serials:
+			for attribute in self.WATCHED_ATTRIBUTES:
+				values = self.get_latest_values(serial, attribute)
+				growth_rates = self._compute_growth_rates(values)
+				if len(growth_rates) == 0 or growth_rates[-1] <= 0:
+					continue
+				is_accelerating = len(growth_rates) >= 2 and growth_rates[-1] > growth_rates[-2]
+				latest_value = values[-1][1]
+				degradation.append((serial, attribute, latest_value, growth_rates, is_accelerating))
+		return degradation
+
+	def report(self, serials):
+		"""
+		Builds the degradation report
+
+		:param serials: serial numbers of all drives to check
+		:return: a tuple where the first element is True if no attribute is accelerating and the second element is
+			the report as a string
+		"""
+		degradation = self.find_degradation(serials)
+		if len(degradation) == 0:
+			return True, "S.M.A.R.T. history: no growing error counters were found"
+		report_lines = ["S.M.A.R.T. history: growing error counters were found:"]
+		for serial, attribute, latest_value, growth_rates, is_accelerating in degradation:
+			report_lines.append("%s %s: %d (%s per day)%s" % (
+				serial,
+				attribute,
+				latest_value,
+				", ".join(["%+1.2f" % rate for rate in growth_rates]),
+				" ACCELERATING" if is_accelerating else "",
+			))
+		is_ok = not any([item[4] for item in degradation])
+		return is_ok, "\n".join(report_lines)
@@ -1,9 +1,12 @@
 import subprocess
 import json
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from .checker_test import CheckerTest
 from .exceptions import TestFailedError
+from .smart_history import SmartHistory
+from .test_result import TestResult
 
 
 class SmartTest(CheckerTest):
@@ -13,28 +16,54 @@ class SmartTest(CheckerTest):
 
 	SUPPORTED_TEST_TYPES = ['short', 'long']
 	SMART_WAIT_TIME = 30
+	SMART_MIN_WAIT_TIME = 10
+	SMART_MAX_WAIT_TIME = 300
+	POLLING_MINUTES_KEYS = {'short': 'short', 'long': 'extended'}
 
 	name = "S.M.A.R.T. test"
 	
 	@classmethod
-	def run(cls, devices=None, test_type="long", **kwargs):
+	def run(cls, devices=None, test_type="long", history_database=None, **kwargs):
 		"""
 		Provides the smart test
 
 		:param devices: a list of POSIX devices for which the SMART test shall be performed
 		:param test_type: test type: 'short', 'long'
+		:param history_database: an SQLite database where all S.M.A.R.T. attributes will be stored. The test fails
+			when error counters of at least one drive grow faster and faster. None to don't keep the history
 		:param kwargs: useless
 		"""
 		cls._check_arguments(devices, test_type)
-		for device in devices:
-			cls._run_smartctl(("-t", test_type, device))
-		is_ok, smart_report = cls._check_smart_progress(devices)
+		result = TestResult(cls.name)
+		with ThreadPoolExecutor(max_workers=len(devices)) as executor:
+			list(executor.map(lambda device: cls._run_smartctl(("-t", test_type, device)), devices))
+			is_ok, smart_report = cls._check_smart_progress(devices, test_type, executor, result)
+			if history_database is not None:
+				history_ok, history_report = cls._update_history(devices, history_database, executor, result)
+				is_ok = is_ok and history_ok
+				smart_report += "\n" + history_report
 		if is_ok:
 			cls.logger.info("S.M.A.R.T. test completed for all drives. Here are test reports:\n" + smart_report)
 		else:
 			raise TestFailedError(
-				"S.M.A.R.T. test has been failed for at least one drive. Here are test reports:\n" + smart_report
+				"S.M.A.R.T. test has been failed for at least one drive. Here are test reports:\n" + smart_report,
+				result
 			)
+		return result
+
+
+	@classmethod
+	def get_resources(cls, devices=None, **kwargs):
+		"""
+		Returns all resources engaged by the test
+
+		:param devices: a list of POSIX devices for which the SMART test shall be performed
+		:param kwargs: useless
+		:return: the S.M.A.R.T. test engages all tested devices
+		"""
+		if not isinstance(devices, list):
+			return {cls.EXCLUSIVE_RESOURCE}
+		return {cls.get_device_resource(device) for device in devices}
 
 
 	@classmethod
@@ -49,6 +78,8 @@ class SmartTest(CheckerTest):
 			raise ValueError("The 'devices' configuration parameter is mandatory.")
 		if not isinstance(devices, list):
 			raise ValueError("Value of the 'devices' configuration parameter must be list of strings")
+		if len(devices) == 0:
+			raise ValueError("The 'devices' configuration parameter must contain at least one device")
 		for device in devices:
 			if not isinstance(device, str):
 				raise ValueError("The 'devices' configuration parameter must be list of strings")
@@ -71,31 +102,100 @@ class SmartTest(CheckerTest):
 
 
 	@classmethod
-	def _check_smart_progress(cls, devices):
+	def _check_smart_progress(cls, devices, test_type="long", executor=None, result=None):
 		"""
-		Checks the S.M.A.R.T. progress
+		Checks the S.M.A.R.T. progress.
+
+		All devices that shall be checked at the moment are polled concurrently. Each device is polled at its own
+		interval that depends on the self-test duration advertised by the drive and on the remaining percent. Each
+		device is reported as soon as its self-test is completed.
 
 		:param devices: list of all tested devices
+		:param test_type: test type: 'short', 'long'
+		:param executor: the concurrent.futures.Executor that polls the devices. None to poll them one by one
+		:param result: the TestResult where the self-test status of each device will be added. None to don't collect
+			metrics
 		:return: a tuple where the first element is whether the S.M.A.R.T test is OK and the second element is status
 			of the last S.M.A.R.T. test
 		"""
-		remaining_percent = 100
 		device_info = dict()
 		is_ok = True
-		while remaining_percent > 0:
-			time.sleep(cls.SMART_WAIT_TIME)
-			remaining_percents = []
-			for device in devices:
-				result = cls._run_smartctl(("-c", device))
-				test_info = result['ata_smart_data']['self_test']['status']
+		map_function = map if executor is None else executor.map
+		next_poll_times = {device: time.monotonic() + cls.SMART_MIN_WAIT_TIME for device in devices}
+		remaining_percents = {device: 100 for device in devices}
+		while len(next_poll_times) > 0:
+			time.sleep(max(min(next_poll_times.values()) - time.monotonic(), 0))
+			current_time = time.monotonic()
+			polled_devices = [device for device, poll_time in next_poll_times.items() if poll_time <= current_time]
+			results = map_function(lambda device: cls._run_smartctl(("-c", device)), polled_devices)
+			for device, smartctl_result in zip(polled_devices, results):
+				self_test = smartctl_result['ata_smart_data']['self_test']
+				test_info = self_test['status']
 				if test_info['string'].find('in progress') != -1 and 'remaining_percent' in test_info:
-					remaining_percents.append(test_info['remaining_percent'])
+					remaining_percents[device] = test_info['remaining_percent']
+					next_poll_times[device] = time.monotonic() + \
+						cls._get_poll_interval(self_test, test_type, test_info['remaining_percent'])
 				else:
-					remaining_percents.append(0)
+					remaining_percents[device] = 0
+					del next_poll_times[device]
 					if 'passed' in test_info and not test_info['passed']:
 						is_ok = False
+					if result is not None and 'passed' in test_info:
+						result.add_metric("smart_self_test_passed", test_info['passed'],
+							"1 if the S.M.A.R.T. self-test has been passed, 0 otherwise", device=device)
 					device_info[device] = test_info['string']
-			remaining_percent = max(*remaining_percents)
-			cls.logger.debug("S.M.A.R.T. test: %d percent remained" % remaining_percent)
-		smart_report = "\n".join(["%s: %s" % (key, value) for key, value in device_info.items()])
+					cls.logger.info("S.M.A.R.T. test completed for %s: %s" % (device, test_info['string']))
+			cls.logger.debug("S.M.A.R.T. test: %d percent remained" % max(remaining_percents.values()))
+		smart_report = "\n".join(["%s: %s" % (device, device_info[device]) for device in devices])
 		return is_ok, smart_report
+
+
+	@classmethod
+	def _update_history(cls, devices, history_database, executor=None, test_result=None):
+		"""
+		Collects S.M.A.R.T. attributes of all devices, stores them into the history database and looks for the
+		degrading drives
+
+		:param devices: list of all tested devices
+		:param history_database: the SQLite database file
+		:param executor: the concurrent.futures.Executor that runs smartctl. None to run it for devices one by one
+		:param test_result: the TestResult where the watched error counters of each drive will be added. None to don't
+			collect metrics
+		:return: a tuple where the first element is False if at least one drive degrades faster and faster and the
+			second element is the history report
+		"""
+		map_function = map if executor is None else executor.map
+		results = list(map_function(lambda device: cls._run_smartctl(("-i", "-A", device), check=False), devices))
+		history = SmartHistory(history_database)
+		try:
+			serials = list()
+			for device, result in zip(devices, results):
+				serial = history.add_smartctl_result(device, result)
+				if serial is not None:
+					serials.append(serial)
+				if test_result is None:
+					continue
+				for attribute, value in history.parse_attributes(result).items():
+					if attribute in history.WATCHED_ATTRIBUTES:
+						test_result.add_metric("smart_attribute", value, "Raw value of the watched S.M.A.R.T. attribute",
+							device=device, serial=serial or "", attribute=attribute)
+			return history.report(serials)
+		finally:
+			history.close()
+
+
+	@classmethod
+	def _get_poll_interval(cls, self_test, test_type, remaining_percent):
+		"""
+		Estimates when the device shall be polled next time
+
+		:param self_test: the 'self_test' section of the smartctl output
+		:param test_type: test type: 'short', 'long'
+		:param remaining_percent: the remaining percent of the self-test
+		:return: time to the next poll in seconds
+		"""
+		polling_minutes = self_test.get('polling_minutes', dict()).get(cls.POLLING_MINUTES_KEYS[test_type])
+		if polling_minutes is None:
+			return cls.SMART_WAIT_TIME
+		remaining_time = polling_minutes * 60 * remaining_percent / 100
+		return min(max(remaining_time / 2, cls.SMART_MIN_WAIT_TIME), cls.SMART_MAX_WAIT_TIME)
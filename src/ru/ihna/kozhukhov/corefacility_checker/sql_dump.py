@@ -1,13 +1,58 @@
 import os
+import hashlib
+import tempfile
+import importlib.util
 from datetime import datetime
 import subprocess
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
 
 from .checker_test import CheckerTest
 from .mail_handler import MailHandler
 from .exceptions import TestFailedError
+from .chunk_store import ChunkStore
+from .test_result import TestResult
+from .compression import COMPRESSION_FORMATS, open_compressor, get_compression_suffix, benchmark_compression
+
+
+class ChecksumWriter:
+	"""
+	Writes the data to the file and computes its size and SHA-256 checksum on the fly
+	"""
+
+	def __init__(self, file):
+		"""
+		Initializes the writer
+
+		:param file: the binary file to write to
+		"""
+		self.file = file
+		self.size = 0
+		self.checksum = hashlib.sha256()
+
+	def write(self, data):
+		"""
+		Writes the data
+
+		:param data: bytes-like object
+		:return: number of bytes written
+		"""
+		self.file.write(data)
+		self.checksum.update(data)
+		self.size += len(data)
+		return len(data)
+
+	def flush(self):
+		"""
+		Flushes the file
+		"""
+		self.file.flush()
+
+	def hexdigest(self):
+		"""
+		Returns the SHA-256 checksum of all written data
+
+		:return: the checksum as a hexadecimal string
+		"""
+		return self.checksum.hexdigest()
 
 
 class SqlDump(CheckerTest):
@@ -19,6 +64,13 @@ class SqlDump(CheckerTest):
 	"""
 
 	TEMPORARY_DUMP_FILE_PLACEHOLDER = "$output"
+	STREAMING_OUTPUT = "/dev/stdout"
+	STREAMING_CHUNK_SIZE = 1_048_576
+	PARTIAL_FILE_SUFFIX = ".part"
+	DEFAULT_COMPRESSION_FORMAT = "gzip"
+	SUPPORTED_OUTPUT_FORMATS = ['archive', 'chunks']
+	BENCHMARK_SAMPLE_SIZE = 67_108_864
+	BENCHMARK_LEVELS = {'gzip': [1, 6, 9], 'zstd': [1, 3, 9]}
 
 	MESSAGE_SUBJECT = "[corefacility-checker] SQL dump file"
 	MESSAGE_TEXT = """
@@ -33,7 +85,9 @@ corefacility
 	name = "SQL dump"
 	
 	@classmethod
-	def run(cls, command=None, temporary_dump_folder=None, permanent_dump_folder=None, max_backup_size=None):
+	def run(cls, command=None, temporary_dump_folder=None, permanent_dump_folder=None, max_backup_size=None,
+			streaming=False, compression_format=None, compression_level=None, compression_workers=None,
+			compression_benchmark=False, output_format='archive', chunk_size=262_144, split_mail=False):
 		"""
 		Runs the test routine
 
@@ -46,19 +100,77 @@ corefacility
 			packed by the tar/gz.
 		:param max_backup_size: The backup size in bytes. If the packed SQL dump doesn't exceed this value, the dump
 			will be sent to the system administrator by E-mail. Otherwise, the dump will be just stored on the drive.
+		:param streaming: True to pass the dump through the pipe directly to the compressor and then to the permanent
+			dump folder. The temporary dump folder is not used in this case and the dump is stored as .sql.gz file
+		:param compression_format: 'gzip' to compress the dump on all CPUs into the multi-member gzip stream, 'zstd'
+			to compress the dump by the multi-threaded zstd (requires the 'zstandard' package). None for 'tar czf' in
+			the non-streaming mode and 'gzip' in the streaming mode
+		:param compression_level: the compression level. None for the default level of a given format
+		:param compression_workers: number of compression threads. None for the number of logical CPUs
+		:param compression_benchmark: True to measure the compression speed and ratio on the first
+			BENCHMARK_SAMPLE_SIZE bytes of the dump for several compression levels and worker numbers
+		:param output_format: 'archive' to store each dump as a separate compressed file, 'chunks' to split the dump
+			into content-defined chunks and store each unique chunk only once in the chunk store located in the
+			permanent dump folder. The dump is represented by the sqldump_<timestamp>.manifest.json file in the latter
+			case and is never mailed
+		:param chunk_size: the average chunk size in bytes for the 'chunks' output format, must be a power of two
+		:param split_mail: True to send the dump that exceeds max_backup_size by several mails, each mail contains
+			max_backup_size bytes of the dump at most
+		:return: the TestResult containing the dump size
 		"""
-		cls._check_arguments(command, temporary_dump_folder, permanent_dump_folder, max_backup_size)
+		cls._check_arguments(command, temporary_dump_folder, permanent_dump_folder, max_backup_size, streaming,
+			compression_format, output_format)
 		timestamp = datetime.now().strftime("%Y%m%d_%H%M")
-		temporary_dump_file = os.path.join(temporary_dump_folder, "sqldump_%s.sql" % timestamp)
-		permanent_dump_file = os.path.join(permanent_dump_folder, "sqldump_%s.tar.gz" % timestamp)
-		cls._create_dump(command, temporary_dump_file)
-		cls._compress_dump(temporary_dump_file, permanent_dump_file)
-		if os.stat(permanent_dump_file).st_size < max_backup_size:
+		result = TestResult(cls.name)
+		if output_format == 'chunks':
+			cls._dump_to_chunks(command, temporary_dump_folder, permanent_dump_folder, timestamp, streaming,
+				chunk_size, compression_level, compression_workers, compression_benchmark, result)
+			return result
+		if streaming or compression_format is not None:
+			if compression_format is None:
+				compression_format = cls.DEFAULT_COMPRESSION_FORMAT
+			compressor_options = (compression_format, compression_level, compression_workers)
+			permanent_dump_file = os.path.join(permanent_dump_folder, "sqldump_%s.sql%s" %
+				(timestamp, get_compression_suffix(compression_format)))
+		if streaming:
+			sample = cls._stream_dump(command, permanent_dump_file, compressor_options, compression_benchmark)
+		else:
+			temporary_dump_file = os.path.join(temporary_dump_folder, "sqldump_%s.sql" % timestamp)
+			cls._create_dump(command, temporary_dump_file)
+			if compression_format is None:
+				permanent_dump_file = os.path.join(permanent_dump_folder, "sqldump_%s.tar.gz" % timestamp)
+				sample = cls._read_sample(temporary_dump_file) if compression_benchmark else None
+				cls._compress_dump(temporary_dump_file, permanent_dump_file)
+			else:
+				sample = cls._compress_dump_in_process(temporary_dump_file, permanent_dump_file, compressor_options,
+					compression_benchmark)
+		if sample is not None:
+			cls._benchmark(sample, compression_workers)
+		dump_size = os.stat(permanent_dump_file).st_size
+		result.add_metric("sql_dump_stored_bytes", dump_size, "Size of the compressed dump")
+		result.add_metric("sql_dump_mailed", dump_size < max_backup_size or (split_mail and max_backup_size > 0),
+			"1 if the dump has been sent by E-mail, 0 otherwise")
+		if dump_size < max_backup_size:
 			cls._mail_file(permanent_dump_file)
+		elif split_mail and max_backup_size > 0:
+			cls._mail_file(permanent_dump_file, max_backup_size)
+		return result
 
 
 	@classmethod
-	def _check_arguments(cls, command, temporary_dump_folder, permanent_dump_folder, max_backup_size):
+	def get_resources(cls, **kwargs):
+		"""
+		Returns all resources engaged by the test
+
+		:param kwargs: The keyword arguments defined by each configuration file
+		:return: the SQL dump engages the database
+		"""
+		return {"database"}
+
+
+	@classmethod
+	def _check_arguments(cls, command, temporary_dump_folder, permanent_dump_folder, max_backup_size, streaming=False,
+			compression_format=None, output_format='archive'):
 		"""
 		Checks the configuration parameters for the SQL dump.
 
@@ -71,15 +183,25 @@ corefacility
 			packed by the tar/gz.
 		:param max_backup_size: The backup size in bytes. If the packed SQL dump doesn't exceed this value, the dump
 			will be sent to the system administrator by E-mail. Otherwise, the dump will be just stored on the drive.
+		:param streaming: True if the dump will be passed directly to the compressor. The temporary dump folder is
+			not required in this case
+		:param compression_format: 'gzip', 'zstd' or None
+		:param output_format: one of the SUPPORTED_OUTPUT_FORMATS
 		"""
 		if not isinstance(command, str):
 			raise ValueError("The 'command' configuration parameter is not set or not string")
-		if not isinstance(temporary_dump_folder, str):
+		if not streaming and not isinstance(temporary_dump_folder, str):
 			raise ValueError("The 'temporary_dump_folder' configuration parameter is not set or not string")
 		if not isinstance(permanent_dump_folder, str):
 			raise ValueError("The 'permanent_dump_folder' configuration parameter is not set or not string")
 		if not isinstance(max_backup_size, int):
 			raise ValueError("The 'max_backup_size' configuration parameter is not set or not integer")
+		if compression_format is not None and compression_format not in COMPRESSION_FORMATS:
+			raise ValueError("The 'compression_format' configuration parameter must be one of: %s" %
+				", ".join(COMPRESSION_FORMATS.keys()))
+		if output_format not in cls.SUPPORTED_OUTPUT_FORMATS:
+			raise ValueError("The 'output_format' configuration parameter must be one of: %s" %
+				", ".join(cls.SUPPORTED_OUTPUT_FORMATS))
 
 
 	@classmethod
@@ -108,6 +230,144 @@ corefacility
 		cls.logger.debug("The database has been successfully dumped to %s" % temporary_dump_file)
 
 
+	@classmethod
+	def _stream_dump(cls, command, permanent_dump_file, compressor_options, keep_sample=False):
+		"""
+		Creates the SQL dump and compresses it on the fly.
+
+		The $output placeholder is replaced by /dev/stdout, so the dump goes through the pipe directly to the
+		compressor. The archive is written under a temporary name and is renamed when the whole pipeline succeeds.
+
+		:param command: a command that creates the dump. Use the $output placeholder as the dump file
+		:param permanent_dump_file: the compressed dump file
+		:param compressor_options: a tuple (format, level, workers) passed to the open_compressor function
+		:param keep_sample: True to keep the first BENCHMARK_SAMPLE_SIZE bytes of the dump for the benchmark
+		:return: the dump sample or None if keep_sample is False
+		"""
+		sample = bytearray() if keep_sample else None
+		command = command.replace(cls.TEMPORARY_DUMP_FILE_PLACEHOLDER, cls.STREAMING_OUTPUT)
+		partial_dump_file = permanent_dump_file + cls.PARTIAL_FILE_SUFFIX
+		with tempfile.TemporaryFile() as error_file:
+			process = subprocess.Popen(("bash", "-c", command), stdout=subprocess.PIPE, stderr=error_file)
+			try:
+				with open(partial_dump_file, 'wb') as archive_file:
+					output = ChecksumWriter(archive_file)
+					with open_compressor(output, *compressor_options) as compressor:
+						raw_size = cls._copy_stream(process.stdout, compressor, sample)
+				return_code = process.wait()
+			except BaseException:
+				process.kill()
+				process.wait()
+				os.unlink(partial_dump_file)
+				raise
+			error_file.seek(0)
+			error_output = error_file.read().decode('utf-8', errors='replace')
+		if return_code != 0 or raw_size == 0:
+			os.unlink(partial_dump_file)
+			raise TestFailedError("The SQL dump command '%s' failed with status code %d and produced %d bytes:\n%s" %
+				(command, return_code, raw_size, error_output))
+		os.rename(partial_dump_file, permanent_dump_file)
+		if len(error_output) > 0:
+			cls.logger.info(error_output)
+		cls.logger.info("The database has been dumped to %s: %d bytes uncompressed, %d bytes compressed, SHA-256 %s" %
+			(permanent_dump_file, raw_size, output.size, output.hexdigest()))
+		return sample
+
+
+	@classmethod
+	def _dump_to_chunks(cls, command, temporary_dump_folder, permanent_dump_folder, timestamp, streaming, chunk_size,
+			compression_level, compression_workers, compression_benchmark, result=None):
+		"""
+		Creates the SQL dump and puts it into the chunk store
+
+		:param command: a command that creates the dump. Use the $output placeholder as the dump file
+		:param temporary_dump_folder: a folder where the uncompressed dump will be created in the non-streaming mode
+		:param permanent_dump_folder: a folder where the chunk store is located
+		:param timestamp: the dump timestamp
+		:param streaming: True to pass the dump through the pipe directly to the chunk store
+		:param chunk_size: the average chunk size in bytes
+		:param compression_level: the zlib compression level for new chunks. None for the default level
+		:param compression_workers: the configured number of compression threads, used by the benchmark only
+		:param compression_benchmark: True to run the compression benchmark on the beginning of the dump
+		:param result: the TestResult where the dump size and the deduplication ratio will be added. None to don't
+			collect metrics
+		"""
+		store = ChunkStore(permanent_dump_folder, chunk_size, compression_level)
+		sample = bytearray() if compression_benchmark else None
+		with store.open_writer("sqldump_%s" % timestamp) as writer:
+			if streaming:
+				cls._stream_to_chunks(command, writer, sample)
+			else:
+				temporary_dump_file = os.path.join(temporary_dump_folder, "sqldump_%s.sql" % timestamp)
+				try:
+					cls._create_dump(command, temporary_dump_file)
+					with open(temporary_dump_file, 'rb') as dump_file:
+						cls._copy_stream(dump_file, writer, sample)
+				finally:
+					if os.path.isfile(temporary_dump_file):
+						os.unlink(temporary_dump_file)
+		cls.logger.info("The database has been dumped to %s\n%s" %
+			(store.get_manifest_file(writer.name), writer.report()))
+		if result is not None:
+			result.add_metric("sql_dump_bytes", writer.size, "Size of the uncompressed dump")
+			result.add_metric("sql_dump_stored_bytes", writer.written_size, "Size of new chunks written to the disk")
+			result.add_metric("sql_dump_dedup_ratio", writer.dedup_ratio if writer.new_size > 0 else None,
+				"Dump size divided by size of new chunks")
+		if sample is not None:
+			cls._benchmark(sample, compression_workers)
+
+
+	@classmethod
+	def _stream_to_chunks(cls, command, writer, sample=None):
+		"""
+		Creates the SQL dump and passes it through the pipe directly to the chunk writer. The manifest is not written
+		by this method, so the failed dump never appears in the chunk store
+
+		:param command: a command that creates the dump. Use the $output placeholder as the dump file
+		:param writer: the ChunkWriter instance
+		:param sample: a bytearray where the beginning of the dump will be copied, or None
+		"""
+		command = command.replace(cls.TEMPORARY_DUMP_FILE_PLACEHOLDER, cls.STREAMING_OUTPUT)
+		with tempfile.TemporaryFile() as error_file:
+			process = subprocess.Popen(("bash", "-c", command), stdout=subprocess.PIPE, stderr=error_file)
+			try:
+				raw_size = cls._copy_stream(process.stdout, writer, sample)
+				return_code = process.wait()
+			except BaseException:
+				process.kill()
+				process.wait()
+				raise
+			error_file.seek(0)
+			error_output = error_file.read().decode('utf-8', errors='replace')
+		if return_code != 0 or raw_size == 0:
+			raise TestFailedError("The SQL dump command '%s' failed with status code %d and produced %d bytes:\n%s" %
+				(command, return_code, raw_size, error_output))
+		if len(error_output) > 0:
+			cls.logger.info(error_output)
+
+
+	@classmethod
+	def _copy_stream(cls, source, destination, sample=None):
+		"""
+		Copies all data from the source stream to the destination stream by fixed-size chunks
+
+		:param source: the binary stream to read from
+		:param destination: the binary stream to write to
+		:param sample: a bytearray where the first BENCHMARK_SAMPLE_SIZE bytes will be copied, or None
+		:return: number of bytes copied
+		"""
+		total_size = 0
+		while True:
+			chunk = source.read(cls.STREAMING_CHUNK_SIZE)
+			if len(chunk) == 0:
+				break
+			destination.write(chunk)
+			if sample is not None and len(sample) < cls.BENCHMARK_SAMPLE_SIZE:
+				sample += chunk[:cls.BENCHMARK_SAMPLE_SIZE - len(sample)]
+			total_size += len(chunk)
+		return total_size
+
+
 	@classmethod
 	def _compress_dump(cls, temporary_dump_file, permanent_dump_file):
 		"""
@@ -129,23 +389,85 @@ corefacility
 
 
 	@classmethod
-	def _mail_file(cls, filename):
+	def _compress_dump_in_process(cls, temporary_dump_file, permanent_dump_file, compressor_options,
+			keep_sample=False):
+		"""
+		Compresses the dump file on the thread pool and removes it
+
+		:param temporary_dump_file: the uncompressed dump file
+		:param permanent_dump_file: the compressed dump file
+		:param compressor_options: a tuple (format, level, workers) passed to the open_compressor function
+		:param keep_sample: True to keep the first BENCHMARK_SAMPLE_SIZE bytes of the dump for the benchmark
+		:return: the dump sample or None if keep_sample is False
 		"""
-		Sends the SQL dump file to E-mail
+		sample = bytearray() if keep_sample else None
+		partial_dump_file = permanent_dump_file + cls.PARTIAL_FILE_SUFFIX
+		try:
+			with open(temporary_dump_file, 'rb') as dump_file, open(partial_dump_file, 'wb') as archive_file:
+				output = ChecksumWriter(archive_file)
+				with open_compressor(output, *compressor_options) as compressor:
+					raw_size = cls._copy_stream(dump_file, compressor, sample)
+		except BaseException:
+			if os.path.exists(partial_dump_file):
+				os.unlink(partial_dump_file)
+			raise
+		os.rename(partial_dump_file, permanent_dump_file)
+		os.unlink(temporary_dump_file)
+		cls.logger.debug("The SQL dump has been compressed to %s: %d bytes uncompressed, %d bytes compressed, SHA-256 %s" %
+			(permanent_dump_file, raw_size, output.size, output.hexdigest()))
+		return sample
+
+
+	@classmethod
+	def _read_sample(cls, filename):
+		"""
+		Reads the beginning of the dump file for the compression benchmark
+
+		:param filename: the uncompressed dump file
+		:return: the first BENCHMARK_SAMPLE_SIZE bytes of the file
+		"""
+		with open(filename, 'rb') as dump_file:
+			return dump_file.read(cls.BENCHMARK_SAMPLE_SIZE)
+
+
+	@classmethod
+	def _benchmark(cls, sample, compression_workers):
+		"""
+		Measures the compression speed and ratio for several compression settings and writes the results to the log
+
+		:param sample: the beginning of the dump
+		:param compression_workers: the configured number of compression threads. None for the number of logical CPUs
+		"""
+		if len(sample) == 0:
+			return
+		workers = compression_workers if compression_workers is not None else os.cpu_count() or 1
+		worker_numbers = sorted({1, workers})
+		settings = list()
+		for compression_format, levels in cls.BENCHMARK_LEVELS.items():
+			if compression_format == 'zstd' and importlib.util.find_spec('zstandard') is None:
+				continue
+			settings += [(compression_format, level, worker_number)
+				for level in levels for worker_number in worker_numbers]
+		report_lines = ["Compression benchmark on %d bytes of the dump:" % len(sample)]
+		for compression_format, level, worker_number, speed, ratio in benchmark_compression(bytes(sample), settings):
+			report_lines.append("%s level %d, %d workers: %1.1f MB/s, ratio %1.2f" %
+				(compression_format, level, worker_number, speed, ratio))
+		cls.logger.info("\n".join(report_lines))
+
+
+	@classmethod
+	def _mail_file(cls, filename, part_size=None):
+		"""
+		Sends the SQL dump file to E-mail. The file is read and sent by small chunks, so it is never loaded into
+		memory at whole
 
 		:param filename: the file to be sent to the E-mail
+		:param part_size: None to send the file by a single mail, otherwise the file will be split into parts of this
+			size and each part will be sent by a separate mail
 		"""
-		message = MIMEMultipart()
-		message['From'] = cls.mail_options['sender']
-		message['To'] = cls.mail_options['recipient']
-		message['Subject'] = cls.MESSAGE_SUBJECT
-		message.attach(MIMEText(cls.MESSAGE_TEXT.replace("\n", "\r\n")))
-		with open(filename, 'rb') as attached_file:
-			part = MIMEApplication(
-				attached_file.read(),
-				Name=os.path.basename(filename)
-			)
-		part['Content-Disposition'] = 'attachment; filename="%s"' % os.path.basename(filename)
-		message.attach(part)
-
-		MailHandler.send_mail(message)
+		if part_size is None:
+			parts = None
+		else:
+			file_size = os.stat(filename).st_size
+			parts = [(offset, min(part_size, file_size - offset)) for offset in range(0, file_size, part_size)]
+		MailHandler.send_file(cls.MESSAGE_SUBJECT, cls.MESSAGE_TEXT, filename, parts)
@@ -0,0 +1,62 @@
+class TestResult:
+	"""
+	The outcome of a single test run: whether the test has been passed, how long it took and all measured values.
+
+	Each measured value is a metric with a name, a numeric value, optional labels (e.g., the device or the CPU core the
+	value relates to) and a short description. The tester adds metrics while it runs and returns the result from its
+	run() method. When the test fails, the result shall be attached to the TestFailedError, so the values measured
+	before the failure are exported too. The test name, the test class, the timing and the status are filled in by the
+	checker itself.
+	"""
+
+	def __init__(self, tester_name=None):
+		"""
+		Initializes the result
+
+		:param tester_name: the human-readable tester name (the 'name' property of the CheckerTest subclass)
+		"""
+		self.tester_name = tester_name
+		self.test_name = None
+		self.test_class = None
+		self.is_ok = None
+		self.start_time = None
+		self.duration = None
+		self.error = None
+		self.metrics = list()
+
+	def add_metric(self, name, value, description=None, **labels):
+		"""
+		Adds the measured value
+
+		:param name: the metric name in the snake case with the base unit at the end, like 'disk_read_bytes' or
+			'cpu_temperature_celsius'
+		:param value: the measured value, int, float or bool (that is stored as 1.0 or 0.0). None values are ignored
+		:param description: a short human-readable description of the metric
+		:param labels: labels that distinguish values of the same metric, like device='/dev/sda'
+		"""
+		if value is None:
+			return
+		self.metrics.append({
+			'name': name,
+			'value': value if isinstance(value, int) and not isinstance(value, bool) else float(value),
+			'description': description,
+			'labels': {label: str(label_value) for label, label_value in labels.items()},
+		})
+
+	def to_dict(self):
+		"""
+		Represents the result as a JSON-serializable dictionary
+
+		:return: the dictionary
+		"""
+		return {
+			'test': self.test_name,
+			'class': self.test_class,
+			'tester': self.tester_name,
+			'success': self.is_ok,
+			'start_time': self.start_time,
+			'duration': self.duration,
+			'error': self.error,
+			'metrics': [{'name': metric['name'], 'labels': metric['labels'], 'value': metric['value']}
+				for metric in self.metrics],
+		}
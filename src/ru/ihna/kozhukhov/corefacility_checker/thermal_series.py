@@ -0,0 +1,261 @@
+import os
+import numpy
+import psutil
+
+
+class SysfsCounterReader:
+	"""
+	Reads a set of integer sysfs files. All files are opened once and are read by means of pread().
+	"""
+
+	READ_SIZE = 32
+
+	def __init__(self, filenames):
+		"""
+		Opens all files
+
+		:param filenames: list of file names. Files that don't exist are ignored
+		"""
+		self.descriptors = list()
+		for filename in filenames:
+			try:
+				self.descriptors.append(os.open(filename, os.O_RDONLY))
+			except OSError:
+				self.descriptors.append(None)
+
+	@property
+	def is_available(self):
+		"""
+		True if at least one file has been opened
+		"""
+		return any([descriptor is not None for descriptor in self.descriptors])
+
+	def read(self, output):
+		"""
+		Reads all files
+
+		:param output: a numpy array where the values will be written. Values of files that can't be read are not
+			changed
+		"""
+		for index, descriptor in enumerate(self.descriptors):
+			if descriptor is None:
+				continue
+			try:
+				output[index] = int(os.pread(descriptor, self.READ_SIZE, 0))
+			except (OSError, ValueError):
+				pass
+
+	def close(self):
+		"""
+		Closes all files
+		"""
+		for descriptor in self.descriptors:
+			if descriptor is not None:
+				os.close(descriptor)
+		self.descriptors = list()
+
+
+class ThermalSeries:
+	"""
+	Keeps the time series of the CPU temperatures, frequencies and thermal throttling counters.
+
+	All samples are stored in preallocated numpy arrays that work as a ring buffer: when the buffer is full, the oldest
+	samples are overwritten.
+	"""
+
+	FREQUENCY_FILE_TEMPLATE = "/sys/devices/system/cpu/cpu%d/cpufreq/scaling_cur_freq"
+	THROTTLE_COUNT_FILE_TEMPLATE = "/sys/devices/system/cpu/cpu%d/thermal_throttle/core_throttle_count"
+	STEADY_STATE_TOLERANCE = 1.0
+	STEADY_STATE_FRACTION = 0.1
+
+	def __init__(self, capacity, core_numbers):
+		"""
+		Initializes the time series
+
+		:param capacity: maximum number of samples in the buffer
+		:param core_numbers: numbers of all physical cores reported by the temperature sensors
+		"""
+		self.cpu_number = psutil.cpu_count(logical=True)
+		self.capacity = capacity
+		self.core_numbers = sorted(core_numbers)
+		self._core_columns = {core_number: column for column, core_number in enumerate(self.core_numbers)}
+		self.timestamps = numpy.zeros(capacity)
+		self.temperatures = numpy.full((capacity, len(self.core_numbers)), numpy.nan, dtype=numpy.float32)
+		self.frequencies = numpy.full((capacity, self.cpu_number), numpy.nan, dtype=numpy.float32)
+		self.throttle_counts = numpy.zeros((capacity, self.cpu_number), dtype=numpy.int64)
+		self.size = 0
+		self.position = 0
+		self._frequency_reader = SysfsCounterReader(
+			[self.FREQUENCY_FILE_TEMPLATE % cpu for cpu in range(self.cpu_number)])
+		self._throttle_reader = SysfsCounterReader(
+			[self.THROTTLE_COUNT_FILE_TEMPLATE % cpu for cpu in range(self.cpu_number)])
+		self._frequency_buffer = numpy.full(self.cpu_number, numpy.nan)
+		self._throttle_buffer = numpy.zeros(self.cpu_number, dtype=numpy.int64)
+
+	def append(self, timestamp, temperatures):
+		"""
+		Appends a single sample. The CPU frequencies and the throttling counters are read at this moment
+
+		:param timestamp: the sample time in seconds
+		:param temperatures: a dictionary core number => temperature in degrees Celsius
+		"""
+		position = self.position
+		self.timestamps[position] = timestamp
+		self.temperatures[position, :] = numpy.nan
+		for core_number, temperature in temperatures.items():
+			if core_number in self._core_columns:
+				self.temperatures[position, self._core_columns[core_number]] = temperature
+		if self._frequency_reader.is_available:
+			self._frequency_reader.read(self._frequency_buffer)
+			self.frequencies[position, :] = self._frequency_buffer / 1000
+		else:
+			frequencies = psutil.cpu_freq(percpu=True)
+			for cpu, frequency in enumerate(frequencies[:self.cpu_number]):
+				self.frequencies[position, cpu] = frequency.current
+		self._throttle_reader.read(self._throttle_buffer)
+		self.throttle_counts[position, :] = self._throttle_buffer
+		self.position = (position + 1) % self.capacity
+		self.size = min(self.size + 1, self.capacity)
+
+	def close(self):
+		"""
+		Closes all sysfs files opened by the series
+		"""
+		self._frequency_reader.close()
+		self._throttle_reader.close()
+
+	def get_timestamps(self):
+		"""
+		Returns the sample times in chronological order
+
+		:return: a numpy array
+		"""
+		return self._ordered(self.timestamps)
+
+	def get_temperatures(self):
+		"""
+		Returns the core temperatures in chronological order
+
+		:return: a numpy array samples x cores. Columns correspond to the core_numbers property
+		"""
+		return self._ordered(self.temperatures)
+
+	def get_frequencies(self):
+		"""
+		Returns the logical CPU frequencies in MHz in chronological order
+
+		:return: a numpy array samples x logical CPUs
+		"""
+		return self._ordered(self.frequencies)
+
+	def get_throttle_counts(self):
+		"""
+		Returns the thermal throttling counters in chronological order
+
+		:return: a numpy array samples x logical CPUs
+		"""
+		return self._ordered(self.throttle_counts)
+
+	def get_throttling_events(self):
+		"""
+		Counts the thermal throttling events that happened during the test
+
+		:return: a dictionary logical CPU => number of throttling events. CPUs that were not throttled are omitted
+		"""
+		if self.size < 2:
+			return dict()
+		throttle_counts = self.get_throttle_counts()
+		events = throttle_counts[-1] - throttle_counts[0]
+		return {int(cpu): int(events[cpu]) for cpu in numpy.flatnonzero(events > 0)}
+
+	def get_steady_state_time(self):
+		"""
+		Estimates how long it took to reach the steady-state temperature.
+
+		The steady-state temperature is the average maximum core temperature over the last STEADY_STATE_FRACTION of
+		the series. The steady state is reached when the maximum core temperature stays within STEADY_STATE_TOLERANCE
+		degrees from the steady-state temperature until the end of the series.
+
+		:return: time in seconds since the first sample or None if there are no temperature samples
+		"""
+		if self.size == 0 or len(self.core_numbers) == 0:
+			return None
+		timestamps = self.get_timestamps()
+		max_temperatures = numpy.nanmax(self.get_temperatures(), axis=1)
+		tail_length = max(int(self.size * self.STEADY_STATE_FRACTION), 1)
+		steady_temperature = numpy.nanmean(max_temperatures[-tail_length:])
+		unsteady_samples = numpy.flatnonzero(numpy.abs(max_temperatures - steady_temperature) >
+			self.STEADY_STATE_TOLERANCE)
+		if len(unsteady_samples) == 0:
+			return 0.0
+		steady_index = min(unsteady_samples[-1] + 1, self.size - 1)
+		return float(timestamps[steady_index] - timestamps[0])
+
+	def get_slopes(self, window):
+		"""
+		Estimates how fast the temperature of each core changes within the last samples.
+		The slope is estimated by the linear least squares fit.
+
+		:param window: duration of the time window in seconds
+		:return: a numpy array containing the slope for each core in degrees Celsius per second or None if the series
+			is shorter than the window
+		"""
+		if self.size < 3:
+			return None
+		timestamps = self.get_timestamps()
+		window_start = numpy.searchsorted(timestamps, timestamps[-1] - window)
+		if window_start == 0 and timestamps[-1] - timestamps[0] < window:
+			return None
+		times = timestamps[window_start:]
+		temperatures = self.get_temperatures()[window_start:]
+		centered_times = times - times.mean()
+		centered_temperatures = temperatures - numpy.nanmean(temperatures, axis=0)
+		return numpy.nansum(centered_times[:, numpy.newaxis] * centered_temperatures, axis=0) / \
+			numpy.sum(centered_times ** 2)
+
+	def save(self, filename):
+		"""
+		Saves the series to the .npz file
+
+		:param filename: the file name
+		"""
+		numpy.savez_compressed(filename,
+			timestamps=self.get_timestamps(),
+			core_numbers=numpy.array(self.core_numbers, dtype=numpy.int32),
+			temperatures=self.get_temperatures(),
+			frequencies=self.get_frequencies(),
+			throttle_counts=self.get_throttle_counts(),
+		)
+
+	def report(self):
+		"""
+		Builds the throttling and steady-state report
+
+		:return: the report as a string
+		"""
+		report_lines = list()
+		throttling_events = self.get_throttling_events()
+		if len(throttling_events) > 0:
+			report_lines.append("Thermal throttling detected: " +
+				"; ".join(["CPU %d: %d events" % (cpu, events) for cpu, events in throttling_events.items()]))
+		else:
+			report_lines.append("No thermal throttling events were detected")
+		steady_state_time = self.get_steady_state_time()
+		if steady_state_time is not None:
+			report_lines.append("Steady-state temperature was reached in %1.1f s" % steady_state_time)
+		frequencies = self.get_frequencies()
+		if self.size > 0 and not numpy.all(numpy.isnan(frequencies)):
+			report_lines.append("CPU frequency: minimum %1.0f MHz, average %1.0f MHz" %
+				(numpy.nanmin(frequencies), numpy.nanmean(frequencies)))
+		return "\n".join(report_lines) + "\n"
+
+	def _ordered(self, array):
+		"""
+		Returns the filled part of the ring buffer in chronological order
+
+		:param array: one of the ring buffer arrays
+		:return: the ordered array
+		"""
+		if self.size < self.capacity:
+			return array[:self.size]
+		return numpy.concatenate((array[self.position:], array[:self.position]))
@@ -0,0 +1,7 @@
+import sys
+from pathlib import Path
+
+
+SOURCE_PATH = str(Path(__file__).absolute().parent.parent / "src")
+if SOURCE_PATH not in sys.path:
+	sys.path.insert(0, SOURCE_PATH)
@@ -0,0 +1,97 @@
+import io
+import os
+import random
+import zlib
+import tempfile
+import unittest
+
+from ru.ihna.kozhukhov.corefacility_checker.chunk_store import ChunkStore
+
+
+class TestChunkStore(unittest.TestCase):
+	"""
+	Tests how the ChunkStore splits the dumps into chunks, deduplicates and restores them
+	"""
+
+	AVERAGE_CHUNK_SIZE = 1024
+
+	def setUp(self):
+		self.temporary_folder = tempfile.TemporaryDirectory()
+		self.store = ChunkStore(self.temporary_folder.name, self.AVERAGE_CHUNK_SIZE)
+		self.data = random.Random(0).randbytes(200_000)
+
+	def tearDown(self):
+		self.temporary_folder.cleanup()
+
+	def write_dump(self, name, data, piece_size=7000):
+		with self.store.open_writer(name) as writer:
+			for offset in range(0, len(data), piece_size):
+				writer.write(data[offset:offset + piece_size])
+		return writer
+
+	def restore_dump(self, name):
+		output = io.BytesIO()
+		self.store.restore(self.store.get_manifest_file(name), output)
+		return output.getvalue()
+
+	def get_chunk_files(self):
+		return {os.path.join(folder, filename) for folder, _, filenames in os.walk(self.store.chunk_folder)
+			for filename in filenames}
+
+	def test_restore(self):
+		writer = self.write_dump("dump", self.data)
+		self.assertEqual(writer.size, len(self.data))
+		self.assertEqual(self.restore_dump("dump"), self.data)
+
+	def test_restore_empty_dump(self):
+		self.write_dump("dump", b"")
+		self.assertEqual(self.restore_dump("dump"), b"")
+
+	def test_chunk_sizes(self):
+		writer = self.write_dump("dump", self.data)
+		chunk_sizes = [chunk_size for _, chunk_size in writer.chunks]
+		self.assertGreater(len(chunk_sizes), 1)
+		for chunk_size in chunk_sizes[:-1]:
+			self.assertGreaterEqual(chunk_size, writer.min_chunk_size)
+			self.assertLessEqual(chunk_size, writer.max_chunk_size)
+
+	def test_chunks_dont_depend_on_write_size(self):
+		first_writer = self.write_dump("first", self.data, 7000)
+		second_writer = self.write_dump("second", self.data, 65536)
+		self.assertEqual(first_writer.chunks, second_writer.chunks)
+		self.assertEqual(second_writer.new_chunk_number, 0)
+
+	def test_insertion_changes_only_neighbouring_chunks(self):
+		first_writer = self.write_dump("first", self.data)
+		changed_data = self.data[:100_000] + b"inserted data" + self.data[100_000:]
+		second_writer = self.write_dump("second", changed_data)
+		self.assertLessEqual(second_writer.new_chunk_number, 3)
+		self.assertLess(second_writer.new_size, first_writer.size // 10)
+		self.assertEqual(self.restore_dump("first"), self.data)
+		self.assertEqual(self.restore_dump("second"), changed_data)
+
+	def test_abort_keeps_existing_chunks(self):
+		self.write_dump("first", self.data)
+		existing_chunk_files = self.get_chunk_files()
+		with self.assertRaises(RuntimeError):
+			with self.store.open_writer("second") as writer:
+				writer.write(self.data + random.Random(1).randbytes(50_000))
+				raise RuntimeError("The dump has failed")
+		self.assertEqual(self.get_chunk_files(), existing_chunk_files)
+		self.assertFalse(os.path.exists(self.store.get_manifest_file("second")))
+		self.assertEqual(self.restore_dump("first"), self.data)
+
+	def test_corrupted_chunk(self):
+		writer = self.write_dump("dump", self.data)
+		with open(self.store.get_chunk_file(writer.chunks[0][0]), 'wb') as output_file:
+			output_file.write(zlib.compress(b"corrupted chunk"))
+		with self.assertRaisesRegex(ValueError, "corrupted"):
+			self.restore_dump("dump")
+
+	def test_bad_average_chunk_size(self):
+		with self.assertRaises(ValueError):
+			ChunkStore(self.temporary_folder.name, 1000)
+
+
+if __name__ == "__main__":
+	unittest.main()
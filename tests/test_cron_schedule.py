@@ -0,0 +1,72 @@
+import unittest
+from datetime import datetime
+
+from ru.ihna.kozhukhov.corefacility_checker.daemon import CronSchedule
+
+
+class TestCronSchedule(unittest.TestCase):
+	"""
+	Tests how the CronSchedule finds the next time of the test
+	"""
+
+	def assertNextTime(self, expression, after, expected_time):
+		self.assertEqual(CronSchedule(expression).next_time(after), expected_time)
+
+	def test_every_minute(self):
+		self.assertNextTime("* * * * *", datetime(2026, 10, 17, 10, 7, 30), datetime(2026, 10, 17, 10, 8))
+
+	def test_next_time_is_strictly_later(self):
+		self.assertNextTime("0 3 * * *", datetime(2026, 10, 17, 3, 0), datetime(2026, 10, 18, 3, 0))
+
+	def test_minute_step(self):
+		self.assertNextTime("*/15 * * * *", datetime(2026, 10, 17, 10, 7), datetime(2026, 10, 17, 10, 15))
+		self.assertNextTime("*/15 * * * *", datetime(2026, 10, 17, 10, 45), datetime(2026, 10, 17, 11, 0))
+
+	def test_range_with_step(self):
+		self.assertNextTime("0-30/10 8 * * *", datetime(2026, 10, 17, 8, 25), datetime(2026, 10, 17, 8, 30))
+		self.assertNextTime("0-30/10 8 * * *", datetime(2026, 10, 17, 8, 30), datetime(2026, 10, 18, 8, 0))
+
+	def test_list(self):
+		self.assertNextTime("0 9,18 * * *", datetime(2026, 10, 17, 9, 0), datetime(2026, 10, 17, 18, 0))
+
+	def test_year_boundary(self):
+		self.assertNextTime("0 0 1 1 *", datetime(2026, 10, 17, 12, 0), datetime(2027, 1, 1, 0, 0))
+
+	def test_leap_day(self):
+		self.assertNextTime("0 0 29 2 *", datetime(2026, 3, 1), datetime(2028, 2, 29, 0, 0))
+
+	def test_month_and_day_names(self):
+		self.assertNextTime("0 0 * feb mon", datetime(2026, 10, 17), datetime(2027, 2, 1, 0, 0))
+
+	def test_sunday_is_either_0_or_7(self):
+		for expression in ("0 0 * * 0", "0 0 * * 7", "0 0 * * sun", "@weekly"):
+			self.assertNextTime(expression, datetime(2026, 10, 17), datetime(2026, 10, 18, 0, 0))
+
+	def test_aliases(self):
+		self.assertNextTime("@hourly", datetime(2026, 10, 17, 10, 7), datetime(2026, 10, 17, 11, 0))
+		self.assertNextTime("@daily", datetime(2026, 10, 17, 10, 7), datetime(2026, 10, 18, 0, 0))
+		self.assertNextTime("@monthly", datetime(2026, 10, 17, 10, 7), datetime(2026, 11, 1, 0, 0))
+		self.assertNextTime("@yearly", datetime(2026, 10, 17, 10, 7), datetime(2027, 1, 1, 0, 0))
+
+	def test_day_of_month_or_day_of_week(self):
+		self.assertNextTime("0 0 1 * mon", datetime(2026, 10, 17), datetime(2026, 10, 19, 0, 0))
+		self.assertNextTime("0 0 1 * mon", datetime(2026, 10, 26), datetime(2026, 11, 1, 0, 0))
+
+	def test_day_of_month_step_is_not_restricted(self):
+		self.assertNextTime("0 0 */2 * mon", datetime(2026, 10, 17), datetime(2026, 10, 19, 0, 0))
+		self.assertNextTime("0 0 */2 * mon", datetime(2026, 10, 19), datetime(2026, 11, 9, 0, 0))
+
+	def test_day_of_week_step_is_not_restricted(self):
+		self.assertNextTime("0 0 1 * */2", datetime(2026, 10, 17), datetime(2026, 11, 1, 0, 0))
+		self.assertNextTime("0 0 1 * */2", datetime(2026, 11, 1), datetime(2026, 12, 1, 0, 0))
+
+	def test_bad_schedules(self):
+		for expression in ("0 0 * *", "60 * * * *", "* 24 * * *", "0 0 0 * *", "0 0 * 13 *", "0 0 * * 8",
+				"*/0 * * * *", "5-1 * * * *", "0 0 * foo *", "0 0 30 2 *", None):
+			with self.subTest(expression=expression):
+				with self.assertRaises(ValueError):
+					CronSchedule(expression)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,106 @@
+import os
+import tempfile
+import unittest
+
+import numpy
+
+from ru.ihna.kozhukhov.corefacility_checker.health_sampler import HealthRing, HealthRollup, GAUGE, COUNTER
+
+
+class TestHealthRing(unittest.TestCase):
+	"""
+	Tests how the HealthRing keeps the records in the ring file
+	"""
+
+	CHANNELS = [("cpu_temperature", GAUGE), ("disk_reads", COUNTER)]
+
+	def setUp(self):
+		self.temporary_folder = tempfile.TemporaryDirectory()
+		self.filename = os.path.join(self.temporary_folder.name, "health", "health.ring")
+
+	def tearDown(self):
+		self.temporary_folder.cleanup()
+
+	def open_ring(self, channels=None, interval=1):
+		ring = HealthRing(self.filename, channels, interval)
+		self.addCleanup(ring.close)
+		return ring
+
+	def test_columns(self):
+		ring = self.open_ring(self.CHANNELS)
+		self.assertEqual(ring.channels, self.CHANNELS)
+		self.assertEqual(ring.interval, 1)
+		self.assertEqual(ring.get_columns(HealthRing.RAW_LEVEL), ["time", "cpu_temperature", "disk_reads"])
+		self.assertEqual(ring.get_columns(1),
+			["time", "cpu_temperature/min", "cpu_temperature/max", "cpu_temperature/mean", "disk_reads"])
+
+	def test_read_written_records(self):
+		ring = self.open_ring(self.CHANNELS)
+		for timestamp in range(10):
+			ring.append(HealthRing.RAW_LEVEL, [timestamp, 40.0 + timestamp, timestamp * 100])
+		ring.close()
+		ring = self.open_ring()
+		records = ring.get_records(HealthRing.RAW_LEVEL)
+		self.assertEqual(records.shape, (10, 3))
+		numpy.testing.assert_array_equal(records[:, 0], numpy.arange(10))
+		numpy.testing.assert_array_equal(records[:, 1], 40.0 + numpy.arange(10))
+		numpy.testing.assert_array_equal(ring.get_records(HealthRing.RAW_LEVEL, since=7)[:, 0], [7, 8, 9])
+		self.assertEqual(len(ring.get_records(1)), 0)
+
+	def test_ring_overwrites_oldest_records(self):
+		ring = self.open_ring(self.CHANNELS)
+		capacity = HealthRing.LEVELS[HealthRing.RAW_LEVEL][1]
+		for timestamp in range(capacity + 100):
+			ring.append(HealthRing.RAW_LEVEL, [timestamp, 0.0, 0.0])
+		records = ring.get_records(HealthRing.RAW_LEVEL)
+		self.assertEqual(ring.get_count(HealthRing.RAW_LEVEL), capacity + 100)
+		numpy.testing.assert_array_equal(records[:, 0], numpy.arange(100, capacity + 100))
+
+	def test_reopen_keeps_records(self):
+		ring = self.open_ring(self.CHANNELS)
+		ring.append(HealthRing.RAW_LEVEL, [1.0, 40.0, 100.0])
+		ring.close()
+		ring = self.open_ring(self.CHANNELS)
+		ring.append(HealthRing.RAW_LEVEL, [2.0, 41.0, 200.0])
+		numpy.testing.assert_array_equal(ring.get_records(HealthRing.RAW_LEVEL)[:, 0], [1.0, 2.0])
+		self.assertFalse(os.path.exists(self.filename + ".old"))
+
+	def test_channel_change_keeps_history(self):
+		ring = self.open_ring(self.CHANNELS)
+		ring.append(HealthRing.RAW_LEVEL, [1.0, 40.0, 100.0])
+		ring.append(1, [0.0, 39.0, 41.0, 40.0, 100.0])
+		ring.close()
+		ring = self.open_ring([("cpu_temperature", GAUGE), ("net_errors", COUNTER)])
+		self.assertTrue(os.path.exists(self.filename + ".old"))
+		numpy.testing.assert_array_equal(ring.get_records(HealthRing.RAW_LEVEL), [[1.0, 40.0, numpy.nan]])
+		numpy.testing.assert_array_equal(ring.get_records(1), [[0.0, 39.0, 41.0, 40.0, numpy.nan]])
+
+	def test_not_a_ring_file(self):
+		os.makedirs(os.path.dirname(self.filename))
+		with open(self.filename, 'wb') as output_file:
+			output_file.write(b"not a ring file")
+		with self.assertRaises(ValueError):
+			HealthRing(self.filename)
+
+
+class TestHealthRollup(unittest.TestCase):
+	"""
+	Tests how the HealthRollup aggregates the samples within a minute
+	"""
+
+	def add_sample(self, rollup, timestamp, gauge, counter):
+		return rollup.add(timestamp, numpy.array([gauge]), numpy.array([gauge]), numpy.array([gauge]),
+			numpy.array([counter]))
+
+	def test_rollup(self):
+		rollup = HealthRollup(60, 1, 1)
+		self.assertIsNone(self.add_sample(rollup, 120.0, 40.0, 100.0))
+		self.assertIsNone(self.add_sample(rollup, 130.0, 44.0, numpy.nan))
+		self.assertIsNone(self.add_sample(rollup, 140.0, numpy.nan, 110.0))
+		record = self.add_sample(rollup, 180.0, 50.0, 120.0)
+		numpy.testing.assert_array_equal(record, [120.0, 40.0, 44.0, 42.0, 110.0])
+		numpy.testing.assert_array_equal(rollup.get_record(), [180.0, 50.0, 50.0, 50.0, 120.0])
+
+
+if __name__ == "__main__":
+	unittest.main()
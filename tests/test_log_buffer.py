@@ -0,0 +1,85 @@
+import os
+import gzip
+import tempfile
+import unittest
+
+from ru.ihna.kozhukhov.corefacility_checker.log_buffer import LogBuffer
+
+
+class TestLogBuffer(unittest.TestCase):
+	"""
+	Tests how the LogBuffer collapses repeated records and spills the large log to the file
+	"""
+
+	def setUp(self):
+		self.temporary_folder = tempfile.TemporaryDirectory()
+		self.log_buffer = LogBuffer(100, self.temporary_folder.name)
+
+	def tearDown(self):
+		self.temporary_folder.cleanup()
+
+	def read_spill_file(self, spill_filename):
+		with gzip.open(spill_filename, 'rb') as input_file:
+			return input_file.read().decode('utf-8')
+
+	def test_take(self):
+		self.log_buffer.append("first record")
+		self.log_buffer.append("second record")
+		self.assertEqual(len(self.log_buffer), 2)
+		self.assertEqual(self.log_buffer.take(), ("first record\nsecond record", None))
+		self.assertEqual(len(self.log_buffer), 0)
+		self.assertEqual(self.log_buffer.take(), ("", None))
+
+	def test_repeated_records(self):
+		for _ in range(3):
+			self.log_buffer.append("repeated record")
+		self.log_buffer.append("other record")
+		self.log_buffer.append("repeated record")
+		self.assertEqual(len(self.log_buffer), 5)
+		text, _ = self.log_buffer.take()
+		self.assertEqual(text, "repeated record\n(repeated 3 times)\nother record\nrepeated record")
+
+	def test_repeated_keys(self):
+		self.log_buffer.append("10:00 disk is slow", key="disk is slow")
+		self.log_buffer.append("10:01 disk is slow", key="disk is slow")
+		text, _ = self.log_buffer.take()
+		self.assertEqual(text, "10:00 disk is slow\n(repeated 2 times)")
+
+	def test_spill(self):
+		records = ["record number %d" % index for index in range(8)]
+		for record in records:
+			self.log_buffer.append(record)
+		self.log_buffer.append(records[-1])
+		text, spill_filename = self.log_buffer.take()
+		self.assertIsNotNone(spill_filename)
+		self.assertEqual(os.path.dirname(spill_filename), self.temporary_folder.name)
+		self.assertEqual(self.read_spill_file(spill_filename), "\n".join(records) + "\n(repeated 2 times)\n")
+		self.assertEqual(text, "\n".join(records) + "\n(repeated 2 times)\nThe full log is attached: %s" %
+			os.path.basename(spill_filename))
+
+	def test_bounded_size(self):
+		records = ["record number %d" % index for index in range(1000)]
+		for record in records:
+			self.log_buffer.append(record)
+		text, spill_filename = self.log_buffer.take()
+		self.assertEqual(self.read_spill_file(spill_filename), "\n".join(records) + "\n")
+		self.assertIn("records are omitted", text)
+		self.assertLess(len(text), 3 * self.log_buffer.max_size + 100)
+
+	def test_summary_line(self):
+		self.log_buffer.append("x" * 100)
+		self.log_buffer.append("first line\nsecond line")
+		text, spill_filename = self.log_buffer.take()
+		self.assertEqual(text.split("\n")[1], "first line [...]")
+		self.assertIn("first line\nsecond line\n", self.read_spill_file(spill_filename))
+
+	def test_important_records(self):
+		for index in range(50):
+			self.log_buffer.append("record number %d" % index)
+		self.log_buffer.append("the test has failed", is_important=True)
+		text, _ = self.log_buffer.take()
+		self.assertIn("the test has failed", text)
+
+
+if __name__ == "__main__":
+	unittest.main()